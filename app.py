@@ -1,36 +1,49 @@
-﻿from flask import Flask, render_template, request, redirect, url_for, session
-from email_utils import fetch_unapproved_senders, load_safe_list, save_safe_list, delete_unapproved_emails, delete_unapproved_emails_dry_run
+﻿from flask import Flask, render_template, request, redirect, url_for, session, abort
+from deletion_plan import DeletionPlan, get_plan_store
+import email_utils
+import imap_async
+from job_routes import jobs_blueprint
+from jobs import get_runner, JobQueueFull, DONE
+from metrics_routes import metrics_blueprint
+from safe_list_store import get_safe_list_store
+from scan_routes import scans_blueprint
+from scan_store import find_scan, run_scan, PAGE_SIZE
 import os
 
+IMAP_ENGINE = os.environ.get("IMAP_ENGINE", "threads")  # "asyncio" sweeps on imap_async's pipelined connections
+imap = imap_async if IMAP_ENGINE == "asyncio" else email_utils
+
 app = Flask(__name__)
 app.secret_key = os.urandom(24)
+app.register_blueprint(jobs_blueprint)
+app.register_blueprint(scans_blueprint)
+app.register_blueprint(metrics_blueprint)
 
 @app.route('/', methods=['GET', 'POST'])
 def index():
     if request.method == 'POST':
         session['email'] = request.form['email']
         session['password'] = request.form['password']
-        stored_safe = load_safe_list()
-        user_safe = request.form['safe_list'].splitlines()
-        user_safe = [email.strip() for email in user_safe if email.strip()]
-        merged_safe = list(set(stored_safe + user_safe))
-        session['safe_list'] = merged_safe
-
-        save_safe_list(merged_safe)
-
-        # Get unapproved senders
-        unapproved = fetch_unapproved_senders(
-            session['email'], session['password'], session['safe_list'], '500'
-        )
-        session['unapproved'] = unapproved
+        store = get_safe_list_store()
+        store.add(request.form['safe_list'].splitlines())
+        merged_safe = store.snapshot()
+
+        # Get unapproved senders, in the background
+        try:
+            job = get_runner().submit(
+                'scan', run_scan, imap.fetch_unapproved_senders, session['email'], session['password'], merged_safe, '500'
+            )
+        except JobQueueFull as e:
+            return f"Too many jobs running: {e}", 503
+        session['scan_id'] = job.id
+        session.pop('plan_id', None)
         return redirect(url_for('preview'))
     return render_template('index.html')
 
 @app.route('/preview', methods=['GET', 'POST'])
 def preview():
     # Load values
-    stored_safe = load_safe_list()
-    unapproved_senders = session.get('unapproved', [])
+    store = get_safe_list_store()
     email_user = session.get('email_user')
     email_pass = session.get('email_pass')
     scan_limit = session.get('scan_limit', '500')
@@ -40,50 +53,64 @@ def preview():
         newly_added_safe = request.form.getlist('keep')
 
         if(newly_added_safe):
-            #Add to json stored safe list
-            stored_safe.extend(newly_added_safe)
-            stored_safe = list(set(stored_safe))  # Remove duplicates
-            save_safe_list(stored_safe)
-
-            #Filter out newly safe senders from unapproved list
-            original_count = len(unapproved_senders)
-
-            unapproved_senders = [
-                sender for sender in unapproved_senders
-                if not any(safe.lower() in sender.lower() for safe in newly_added_safe)
-            ]
-
-            session['unapproved'] = unapproved_senders
-
-            print(f"Filtered unapproved list: {original_count} -> {len(unapproved_senders)} senders")
+            #Add to the stored safe list; scan results are filtered against it as it changes
+            store.add(newly_added_safe)
             print(f"Newly added safe senders: {newly_added_safe}")
 
+    #A finished scan's senders stay on the server and the page loads them a page at a time
+    stored_safe = store.snapshot()
+    result, scan = find_scan(session.get('scan_id'), stored_safe)
+    if result is not None:
+        found = result.count(stored_safe)
+    else:
+        found = len(scan['found']) if scan else 0
+
     return render_template(
         "preview.html",
-        unapproved=unapproved_senders,
+        result=result,
+        found=found,
+        indexed=result is not None and result.index is not None,
+        page_size=PAGE_SIZE,
         safe_list=stored_safe,
         email_user=email_user,
         email_pass=email_pass,
-        scan_limit=scan_limit
+        scan_limit=scan_limit,
+        scan=scan
     )
 
+def scan_index(safe_list):
+    """This session's scan index without senders the safe list now matches, or None to scan again."""
+    result, _ = find_scan(session.get('scan_id'), safe_list)
+    return result.view(safe_list) if result is not None else None
+
 @app.route('/delete_emails', methods=['POST'])
 def delete_emails():
     email_user = session.get('email')
     email_pass = session.get('password')
     scan_limit = session.get('scan_limit', '500')
 
-    safe_list = load_safe_list()  # Pull fresh from file
+    safe_list = get_safe_list_store().snapshot()  # Current version, cached until it changes
 
     if not email_user or not email_pass:
         return "Session expired. Please re-enter your email credentials.", 400
 
-    deleted_count = delete_unapproved_emails(email_user, email_pass, safe_list, scan_limit)
+    index = scan_index(safe_list)
+    plan_id = session.pop('plan_id', None)
 
-    session.clear()
+    try:
+        if plan_id is not None:
+            # Act on what the dry run reported, checking only mail that arrived since
+            job = get_runner().submit('delete', imap.execute_deletion_plan, email_user, email_pass, plan_id, safe_list)
+        elif index is not None:
+            # Delete exactly what the preview showed, without scanning again
+            job = get_runner().submit('delete', imap.delete_indexed_emails, email_user, email_pass,
+                                      index.message_ids(), index.uidvalidity)
+        else:
+            job = get_runner().submit('delete', imap.delete_unapproved_emails, email_user, email_pass, safe_list, scan_limit)
+    except JobQueueFull as e:
+        return f"Too many jobs running: {e}", 503
 
-    return (f"<h1>Deleted {deleted_count} emails not from the safe list addresses</h1><br>"
-            f"<a href='/'>Return home</a>")
+    return redirect(url_for('jobs.job_progress', job_id=job.id))
 
 @app.route('/delete_emails_dry_run', methods=['POST'])
 def delete_emails_dry_run():
@@ -91,16 +118,44 @@ def delete_emails_dry_run():
     email_pass = session.get('password')
     scan_limit = session.get('scan_limit', '500')
 
-    safe_list = load_safe_list()  # Pull fresh from file
+    safe_list = get_safe_list_store().snapshot()  # Current version, cached until it changes
 
     if not email_user or not email_pass:
         return "Session expired. Please re-enter your email credentials.", 400
 
-    deleted_count = delete_unapproved_emails_dry_run(email_user, email_pass, safe_list, scan_limit)
+    index = scan_index(safe_list)
+    if index is not None:
+        plan = get_plan_store().save(DeletionPlan.from_index(index, safe_list.digest))
+        session['plan_id'] = plan.id
+        return (f"<h1>Would delete {len(plan)} emails not from the safe list addresses</h1><br>"
+                f"<a href='/preview'>Back to preview</a>")
+
+    try:
+        job = get_runner().submit('dry run', imap.delete_unapproved_emails_dry_run, email_user, email_pass, safe_list, scan_limit)
+    except JobQueueFull as e:
+        return f"Too many jobs running: {e}", 503
+
+    return redirect(url_for('jobs.job_progress', job_id=job.id))
+
+@app.route('/jobs/<job_id>/result')
+def job_result(job_id):
+    job = get_runner().get(job_id)
+    if job is None:
+        abort(404)
+    if job.status != DONE:
+        return redirect(url_for('jobs.job_progress', job_id=job_id))
+
+    if job.kind == 'scan':
+        session['scan_id'] = job_id
+        return redirect(url_for('preview'))
+    if job.kind == 'dry run':
+        session['plan_id'] = job.result.id
+        return (f"<h1>Would delete {len(job.result)} emails not from the safe list addresses</h1><br>"
+                f"<a href='/preview'>Back to preview</a>")
 
     session.clear()
 
-    return (f"<h1>Deleted {deleted_count} emails not from the safe list addresses</h1><br>"
+    return (f"<h1>Deleted {job.result} emails not from the safe list addresses</h1><br>"
             f"<a href='/'>Return home</a>")
 
 if __name__ == '__main__':
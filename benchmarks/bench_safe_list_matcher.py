@@ -0,0 +1,74 @@
+﻿"""Classification throughput of SafeListMatcher against the old any(safe in sender) scan.
+
+Run from the repository root:
+
+    python benchmarks/bench_safe_list_matcher.py
+"""
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from safe_list_matcher import SafeListMatcher
+
+SAFE_LIST_SIZES = [10, 100, 1000, 5000]
+MESSAGES = 20000
+DISTINCT_SENDERS = 2000
+
+
+def random_word(rng, length):
+    return "".join(rng.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(length))
+
+
+def make_safe_list(rng, size):
+    safe_list = []
+    for _ in range(size):
+        kind = rng.random()
+        if kind < 0.6:
+            safe_list.append(f"{random_word(rng, 8)}@{random_word(rng, 6)}.com")
+        elif kind < 0.9:
+            safe_list.append(f"@{random_word(rng, 7)}.org")
+        else:
+            safe_list.append(random_word(rng, 5))
+    return safe_list
+
+
+def make_senders(rng, safe_list):
+    pool = [f"{random_word(rng, 8)}@{random_word(rng, 6)}.net" for _ in range(DISTINCT_SENDERS)]
+    # About a third of the mail comes from safe senders
+    pool += [entry if "@" in entry[1:] else f"someone{entry}" for entry in rng.sample(safe_list, min(len(safe_list), DISTINCT_SENDERS // 2))]
+    return [rng.choice(pool) for _ in range(MESSAGES)]
+
+
+def naive(safe_list, senders):
+    return sum(1 for sender in senders if not any(safe.lower() in sender.lower() for safe in safe_list))
+
+
+def compiled(safe_list, senders):
+    matcher = SafeListMatcher(safe_list)
+    return sum(1 for sender in senders if not matcher.matches(sender))
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start
+
+
+def main():
+    rng = random.Random(42)
+    print(f"{'safe list':>10} {'naive msg/s':>14} {'matcher msg/s':>14} {'speedup':>9}")
+    for size in SAFE_LIST_SIZES:
+        safe_list = make_safe_list(rng, size)
+        senders = make_senders(rng, safe_list)
+        expected, naive_time = timed(naive, safe_list, senders)
+        actual, compiled_time = timed(compiled, safe_list, senders)
+        assert expected == actual, "matcher disagrees with the naive scan"
+        print(f"{size:>10} {MESSAGES / naive_time:>14,.0f} {MESSAGES / compiled_time:>14,.0f} "
+              f"{naive_time / compiled_time:>8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,229 @@
+﻿"""Scan, dry run and delete throughput of both backends against local fakes, with no account or network.
+
+The IMAP backends, threaded (email_utils) and asyncio (imap_async), talk to
+a local fake IMAP server (fake_imap_server.py) over a real socket, plain or
+TLS; the Gmail backend talks to an in-process
+stand-in for the API (fake_gmail.py). Both serve the same synthetic mailbox.
+Run from the repository root:
+
+    python benchmarks/bench_sweeps.py
+    python benchmarks/bench_sweeps.py --messages 50000 --latency 0.02 --error-rate 0.01 --tls
+    python benchmarks/bench_sweeps.py --folders INBOX Receipts Updates --overlap 0.3 --gmail-extensions
+
+Operations run in order on each backend, so the dry run finds the header
+cache the scan filled and the delete empties the mailbox of unapproved mail.
+With several --folders, the messages are spread over IMAP folders and Gmail
+labels, --overlap of them filed under two; the messages column counts each
+message once.
+Peak memory is what tracemalloc sees during the operation, which includes the
+in-process fakes' response buffers. Tracing slows Python code down several
+times over, so pass --no-memory for representative msg/s, and compare runs
+made with the same flags.
+"""
+import argparse
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from synthetic_mailbox import assign_folders, make_mailbox, make_safe_list
+
+BENCH_USER = "bench@example.com"
+BENCH_PASSWORD = "bench"
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n", 1)[0])
+    parser.add_argument("--messages", type=int, default=20000, help="mailbox size")
+    parser.add_argument("--senders", type=int, default=2000, help="distinct senders")
+    parser.add_argument("--skew", type=float, default=1.1, help="Zipf exponent of sender popularity (0 = uniform)")
+    parser.add_argument("--safe-fraction", type=float, default=0.3, help="share of senders on the safe list")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every round trip")
+    parser.add_argument("--error-rate", type=float, default=0.0,
+                        help="chance an IMAP FETCH drops its connection or a Gmail call fails")
+    parser.add_argument("--tls", action="store_true", help="serve IMAP over TLS with a self-signed certificate")
+    parser.add_argument("--gmail-extensions", action="store_true",
+                        help="advertise X-GM-EXT-1 so the safe list is pushed down with X-GM-RAW")
+    parser.add_argument("--connections", type=int, default=4,
+                        help="IMAP fetch connections, or FETCHes pipelined on one connection for imap-async")
+    parser.add_argument("--folders", nargs="+", default=["INBOX"],
+                        help="IMAP folders (and Gmail labels) to spread the messages over and sweep")
+    parser.add_argument("--overlap", type=float, default=0.2,
+                        help="share of messages filed under a second folder when there are several")
+    parser.add_argument("--gmail-quota", type=float, default=None,
+                        help="Gmail quota units per second (default: unlimited; the real per-user quota is 250)")
+    parser.add_argument("--backends", nargs="+", choices=["imap", "imap-async", "gmail"],
+                        default=["imap", "imap-async", "gmail"])
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--no-memory", dest="memory", action="store_false",
+                        help="skip tracemalloc, which slows the sweep down, and report no peak memory")
+    parser.add_argument("--verbose", action="store_true", help="show the sweep's own output")
+    return parser.parse_args()
+
+
+def measure(operation, stats, messages, args):
+    """Run operation() and return (result, row of measurements)."""
+    before = stats()
+    output = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO())
+    if args.memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    with output:
+        result = operation()
+    elapsed = time.perf_counter() - start
+    peak = None
+    if args.memory:
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    after = stats()
+    return result, {
+        'messages': messages,
+        'seconds': elapsed,
+        'rate': messages / elapsed if elapsed else 0.0,
+        'round_trips': after['round_trips'] - before['round_trips'],
+        'bytes': after['bytes'] - before['bytes'],
+        'peak': peak,
+    }
+
+
+def bench_imap(args, mailbox, safe_list, engine=None):
+    import email_utils
+    from fake_imap_server import FakeImapServer, self_signed_context
+
+    from header_cache import get_cache
+
+    engine = engine or email_utils
+    get_cache().clear()  # Each engine starts from a cold cache
+    server = FakeImapServer(
+        mailbox,
+        latency=args.latency,
+        error_rate=args.error_rate,
+        gmail_extensions=args.gmail_extensions,
+        ssl_context=self_signed_context() if args.tls else None,
+        seed=args.seed,
+        folders=folders(args, mailbox),
+    )
+    email_utils.IMAP_SERVER = "127.0.0.1"
+    email_utils.IMAP_PORT = server.start()
+    email_utils.IMAP_SSL = args.tls
+    email_utils.IMAP_FOLDERS = args.folders
+
+    def stats():
+        counts = server.stats.snapshot()
+        return {'round_trips': counts['round_trips'], 'bytes': counts['bytes_in'] + counts['bytes_out']}
+
+    def size():
+        return server.message_count()
+
+    operations = [
+        ("scan", lambda: engine.fetch_unapproved_senders(
+            BENCH_USER, BENCH_PASSWORD, safe_list, 'all', args.connections)),
+        ("dry run", lambda: engine.delete_unapproved_emails_dry_run(
+            BENCH_USER, BENCH_PASSWORD, safe_list, 'all', args.connections)),
+        ("delete", lambda: engine.delete_unapproved_emails(
+            BENCH_USER, BENCH_PASSWORD, safe_list, 'all', args.connections)),
+    ]
+    try:
+        return run_operations(operations, stats, size, args)
+    finally:
+        server.stop()
+
+
+def bench_imap_async(args, mailbox, safe_list):
+    import ssl
+    import imap_async
+
+    if args.tls:
+        imap_async.SSL_CONTEXT = ssl._create_unverified_context()  # The fake server's certificate is self-signed
+    return bench_imap(args, mailbox, safe_list, imap_async)
+
+
+def bench_gmail(args, mailbox, safe_list):
+    import gmail_utils
+    from fake_gmail import FakeGmail
+    from gmail_executor import GmailExecutor
+
+    gmail = FakeGmail(mailbox, latency=args.latency, error_rate=args.error_rate, seed=args.seed,
+                      labels=folders(args, mailbox))
+    gmail_utils.GMAIL_LABELS = args.folders if len(args.folders) > 1 else []
+    gmail_utils.SERVICE_FACTORY = lambda token_file: gmail.service()
+    gmail_utils._executors[gmail_utils.TOKEN_FILE] = GmailExecutor(
+        gmail_utils.authenticate_gmail, units_per_second=args.gmail_quota or 1e9)
+
+    def stats():
+        counts = gmail.stats()
+        return {'round_trips': counts['round_trips'], 'bytes': counts['bytes_out']}
+
+    def size():
+        return len(gmail.messages)
+
+    operations = [
+        ("scan", lambda: gmail_utils.fetch_unapproved_senders(safe_list, 'all')),
+        ("dry run", lambda: gmail_utils.delete_unapproved_emails_dry_run(safe_list, 'all')),
+        ("delete", lambda: gmail_utils.delete_unapproved_emails(safe_list, 'all')),
+    ]
+    try:
+        return run_operations(operations, stats, size, args)
+    finally:
+        gmail_utils.get_executor().shutdown()
+
+
+def folders(args, mailbox):
+    """{folder: message indexes} for several --folders, or None to keep the whole mailbox in one."""
+    if len(args.folders) < 2:
+        return None
+    return assign_folders(len(mailbox), args.folders, args.overlap, args.seed)
+
+
+def run_operations(operations, stats, size, args):
+    """Measure each (name, operation) in turn; returns [(name, result, row)]."""
+    rows = []
+    for name, operation in operations:
+        result, row = measure(operation, stats, size(), args)
+        rows.append((name, result, row))
+    return rows
+
+
+def affected(result):
+    """Messages an operation found or removed: a SenderIndex, a DeletionPlan or a count."""
+    if hasattr(result, 'message_count'):
+        return result.message_count
+    if result is None:
+        return 0
+    return result if isinstance(result, int) else len(result)
+
+
+def main():
+    args = parse_args()
+    mailbox, senders = make_mailbox(args.messages, args.senders, args.skew, args.seed)
+    safe_list = make_safe_list(senders, args.safe_fraction, args.seed)
+    print(f"{args.messages} messages from {args.senders} senders (skew {args.skew}), "
+          f"{len(safe_list)} safe-list entries, latency {args.latency * 1000:.0f} ms, "
+          f"error rate {args.error_rate:.1%}{', TLS' if args.tls else ''}"
+          + (f", {len(args.folders)} folders ({args.overlap:.0%} overlap)" if len(args.folders) > 1 else ""))
+
+    benches = {'imap': bench_imap, 'imap-async': bench_imap_async, 'gmail': bench_gmail}
+    print(f"{'backend':<10} {'operation':<10} {'messages':>9} {'found':>8} {'seconds':>8} {'msg/s':>10} "
+          f"{'round trips':>12} {'bytes':>12} {'peak MB':>8}")
+    # Caches, checkpoints and plans go to a scratch directory, not the working tree
+    with tempfile.TemporaryDirectory(prefix="bench-sweeps-") as scratch:
+        os.chdir(scratch)
+        for backend in args.backends:
+            try:
+                rows = benches[backend](args, mailbox, safe_list)
+            except ImportError as error:
+                print(f"{backend:<10} skipped: {error}")
+                continue
+            for name, result, row in rows:
+                peak = f"{row['peak'] / 1e6:.1f}" if row['peak'] is not None else "-"
+                print(f"{backend:<10} {name:<10} {row['messages']:>9} {affected(result):>8} {row['seconds']:>8.2f} "
+                      f"{row['rate']:>10,.0f} {row['round_trips']:>12,} {row['bytes']:>12,} {peak:>8}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+﻿"""Checks gmail_sync's incremental sync against the fake Gmail API (fake_gmail.py), with no account or network.
+
+Run from the repository root:
+
+    python benchmarks/check_gmail_sync.py
+
+Each check changes the fake mailbox the way mail does between two runs
+(arrivals, deletions, label changes, an expired historyId) and compares what
+history_changes() and sync_mailbox() report with what messages.list would
+list. The first failing check raises AssertionError.
+"""
+import contextlib
+import io
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_gmail import ACCOUNT, FakeGmail
+from synthetic_mailbox import SyntheticMessage, make_mailbox
+
+MESSAGES = 300
+
+
+def listed(gmail):
+    """The ids messages.list would list, i.e. what the replica should hold."""
+    service = gmail.service()
+    ids, token = set(), None
+    while True:
+        response = service.users().messages().list(userId='me', pageToken=token, maxResults=500).execute()
+        ids.update(message['id'] for message in response.get('messages', []))
+        token = response.get('nextPageToken')
+        if not token:
+            return ids
+
+
+def new_message(n):
+    return SyntheticMessage(f"New Sender {n} <new{n}@arrivals.example>", 2000, 1700000000 + n)
+
+
+def check(name, condition):
+    if not condition:
+        raise AssertionError(name)
+    print(f"ok  {name}")
+
+
+def main():
+    import gmail_sync
+    from gmail_executor import GmailExecutor
+
+    mailbox, _ = make_mailbox(MESSAGES, 50, seed=7)
+    gmail = FakeGmail(mailbox)
+    executor = GmailExecutor(gmail.service, units_per_second=1e9)
+    service = gmail.service()
+    store = gmail_sync.SyncStore(os.path.join(os.getcwd(), gmail_sync.SYNC_FILE))
+
+    def sync():
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            infos = gmail_sync.sync_mailbox(service, ACCOUNT, store, executor)
+        return infos, output.getvalue()
+
+    infos, output = sync()
+    check("first sync lists the whole mailbox", set(infos) == listed(gmail) and "Full sync" in output)
+    check("first sync stores the historyId", store.history_id(ACCOUNT) == gmail.get_profile()['historyId'])
+
+    start = store.history_id(ACCOUNT)
+    ids = sorted(infos)
+    arrived = [gmail.deliver(new_message(n)) for n in range(3)]
+    gone = gmail.deliver(new_message(3))
+    gmail.delete_messages([gone, ids[0]])
+    gmail.relabel(ids[1], add=['SPAM'], remove=['INBOX'])
+    gmail.relabel(ids[2], add=['Label_1'])
+    gmail.relabel(ids[3], add=['TRASH'])
+    gmail.relabel(ids[3], remove=['TRASH'])
+
+    added, removed, latest = gmail_sync.history_changes(service, start, executor)
+    check("arrivals and restored messages are added", added == set(arrived) | {ids[2], ids[3]})
+    check("deleted and spammed messages are removed", removed == {gone, ids[0], ids[1]})
+    check("the delta ends at the current historyId", latest == gmail.get_profile()['historyId'])
+
+    added, removed, _ = gmail_sync.history_changes(service, start, executor, label_id='Label_1')
+    check("a label's delta lists only that label's messages", added == {ids[2]} and not removed)
+
+    infos, output = sync()
+    check("incremental sync matches the listing", set(infos) == listed(gmail) and "Incremental sync" in output)
+    check("incremental sync fetches the new senders",
+          all(infos[message_id].sender.startswith("new") for message_id in arrived))
+
+    late = gmail.deliver(new_message(4))
+    gmail.expire_history()
+    infos, output = sync()
+    check("an expired historyId resyncs in full", "expired" in output and "Full sync" in output)
+    check("the resync matches the listing", set(infos) == listed(gmail) and late in infos)
+
+
+if __name__ == "__main__":
+    # The header cache and replica go to a scratch directory, not the working tree
+    with tempfile.TemporaryDirectory(prefix="check-gmail-sync-") as scratch:
+        os.chdir(scratch)
+        main()
@@ -0,0 +1,96 @@
+﻿"""Checks imap_async against the fake IMAP server (fake_imap_server.py) on a mailbox whose responses outgrow asyncio's defaults.
+
+Run from the repository root:
+
+    python benchmarks/check_imap_async.py
+
+The mailbox is big enough that its UID SEARCH response is one line of over
+64 KiB, the default limit of an asyncio stream. The asyncio engine's scan
+must find what the threaded engine (email_utils) finds, and with READ_LIMIT
+cut below that line, a scan must fail with AsyncIMAPError rather than hang.
+The first failing check raises AssertionError.
+"""
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_imap_server import FakeImapServer
+from synthetic_mailbox import make_mailbox, make_safe_list
+
+MESSAGES = 20000
+TIMEOUT = 120  # Seconds a scan may take before it counts as hung
+USER = "check@example.com"
+PASSWORD = "check"
+
+
+def check(name, condition):
+    if not condition:
+        raise AssertionError(name)
+    print(f"ok  {name}")
+
+
+def scan(engine, safe_list):
+    """engine's scan of the whole mailbox, or the exception it raised; AssertionError if it hangs."""
+    from header_cache import get_cache
+
+    get_cache().clear()  # Each scan fetches over the wire
+    outcome = []
+
+    def run():
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                outcome.append(engine.fetch_unapproved_senders(USER, PASSWORD, safe_list, 'all', 4))
+        except Exception as error:
+            outcome.append(error)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    thread.join(TIMEOUT)
+    if not outcome:
+        raise AssertionError(f"{engine.__name__} scan still running after {TIMEOUT}s")
+    return outcome[0]
+
+
+def main():
+    import email_utils
+    import imap_async
+
+    mailbox, senders = make_mailbox(MESSAGES, 500, seed=7)
+    safe_list = make_safe_list(senders, seed=7)
+    server = FakeImapServer(mailbox)
+    email_utils.IMAP_SERVER = "127.0.0.1"
+    email_utils.IMAP_PORT = server.start()
+    email_utils.IMAP_SSL = False
+    email_utils.IMAP_FOLDERS = ["INBOX"]
+    try:
+        search_line = len("* SEARCH " + " ".join(map(str, range(1, MESSAGES + 1))))
+        check("the SEARCH response outgrows asyncio's default line limit", search_line > 64 * 1024)
+
+        expected = scan(email_utils, safe_list)
+        found = scan(imap_async, safe_list)
+        check("the asyncio scan completes", not isinstance(found, Exception))
+        check("the asyncio scan finds what the threaded one does",
+              sorted(found.senders()) == sorted(expected.senders())
+              and found.message_count == expected.message_count)
+
+        limit, imap_async.READ_LIMIT = imap_async.READ_LIMIT, 1024
+        try:
+            failed = scan(imap_async, safe_list)
+        finally:
+            imap_async.READ_LIMIT = limit
+        check("a line over READ_LIMIT fails the scan instead of hanging",
+              isinstance(failed, imap_async.AsyncIMAPError))
+    finally:
+        server.stop()
+
+
+if __name__ == "__main__":
+    # The header cache and checkpoints go to a scratch directory, not the working tree
+    with tempfile.TemporaryDirectory(prefix="check-imap-async-") as scratch:
+        os.chdir(scratch)
+        main()
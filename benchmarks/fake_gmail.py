@@ -0,0 +1,279 @@
+﻿"""In-process stand-in for the Gmail API over a synthetic mailbox, for benchmarking gmail_utils without OAuth.
+
+FakeGmail.service() builds a service object with the parts of the
+googleapiclient interface gmail_utils and gmail_sync call: getProfile,
+messages.list (with -from: and after: queries, labelIds and
+includeSpamTrash), messages.get, messages.batchDelete, messages.delete,
+history.list and batch requests. relabel() and expire_history() make the
+label changes and history expiry gmail_sync has to cope with.
+Each HTTP request, a whole batch included, is one round trip delayed by
+`latency` seconds; with probability `error_rate` a request, or an item of a
+batch, fails with `error_status` the way the API reports quota and backend
+errors. Response bytes are counted as the size of the JSON the API would send.
+"""
+import json
+import random
+import threading
+import time
+
+from googleapiclient.errors import HttpError
+
+ACCOUNT = "bench@example.com"
+MAX_LIST_RESULTS = 500
+HIDDEN_LABELS = {'SPAM', 'TRASH'}  # Left out of messages.list unless includeSpamTrash or asked for by label
+MAX_BATCH_CALLS = 100
+HISTORY_PAGE_SIZE = 100
+
+
+class FakeResponse:
+    """The httplib2 response HttpError expects."""
+
+    def __init__(self, status):
+        self.status = status
+        self.reason = "Simulated failure"
+
+
+def simulated_error(status):
+    return HttpError(FakeResponse(status), b'{"error": {"message": "Simulated failure"}}')
+
+
+class FakeGmail:
+    """A synthetic mailbox behind a fake Gmail API, with round-trip and byte counters."""
+
+    def __init__(self, messages, latency=0.0, error_rate=0.0, error_status=503, seed=0, labels=None):
+        # Gmail ids are hex and grow with arrival time; listing is newest first
+        self.messages = {}
+        self.labels = {}  # Message id -> its label ids
+        self.history = []  # (historyId, record) for history.list
+        self.history_id = 1000
+        self.history_start = self.history_id  # Oldest historyId history.list still answers for
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.round_trips = 0
+        self.bytes_out = 0
+        self.lock = threading.Lock()
+        self._listings = {}  # q -> ids it lists, until the mailbox changes
+        self._rng = random.Random(seed)
+        self._next_id = 0x17a0000000000000
+        # labels maps label id to the indexes of its messages; without it every message is in the INBOX
+        message_labels = [[] for _ in messages]
+        for label, indexes in (labels or {'INBOX': range(len(messages))}).items():
+            for i in indexes:
+                message_labels[i].append(label)
+        for message, label_ids in zip(messages, message_labels):
+            self.deliver(message, label_ids)
+
+    def deliver(self, message, label_ids=('INBOX',)):
+        """Add a message, recording it in the history as a new arrival."""
+        with self.lock:
+            message_id = f"{self._next_id:x}"
+            self._next_id += 1
+            self.messages[message_id] = message
+            self.labels[message_id] = list(label_ids)
+            self._record({'messagesAdded': [{'message': {'id': message_id, 'labelIds': list(label_ids)}}]})
+        return message_id
+
+    def relabel(self, message_id, add=(), remove=()):
+        """Add and remove labels of a message, recording the change in the history."""
+        with self.lock:
+            labels = [label for label in self.labels[message_id] if label not in remove]
+            labels += [label for label in add if label not in labels]
+            self.labels[message_id] = labels
+            message = {'id': message_id, 'labelIds': list(labels)}
+            if add:
+                self._record({'labelsAdded': [{'message': message, 'labelIds': list(add)}]})
+            if remove:
+                self._record({'labelsRemoved': [{'message': message, 'labelIds': list(remove)}]})
+
+    def expire_history(self):
+        """Forget the history so far, as the API does after about a week; older historyIds then get a 404."""
+        with self.lock:
+            self.history.clear()
+            self.history_start = self.history_id
+
+    def _record(self, change):
+        self._listings.clear()
+        self.history_id += 1
+        self.history.append((self.history_id, change))
+
+    def service(self):
+        return FakeService(self)
+
+    def stats(self):
+        with self.lock:
+            return {'round_trips': self.round_trips, 'bytes_out': self.bytes_out}
+
+    def failed(self):
+        with self.lock:
+            return self.error_rate and self._rng.random() < self.error_rate
+
+    def round_trip(self, payload):
+        """Count one HTTP exchange carrying payload and wait out the latency."""
+        with self.lock:
+            self.round_trips += 1
+            self.bytes_out += len(json.dumps(payload))
+        if self.latency:
+            time.sleep(self.latency)
+
+    # API methods; each returns the response body
+
+    def get_profile(self):
+        with self.lock:
+            return {'emailAddress': ACCOUNT, 'messagesTotal': len(self.messages), 'historyId': str(self.history_id)}
+
+    def _listing(self, q, label_ids=None, include_spam_trash=False):
+        excluded, after = [], None
+        for term in (q or "").split():
+            if term.lower().startswith("-from:"):
+                excluded.append(term[len("-from:"):].lower())
+            elif term.lower().startswith("after:"):
+                after = int(term[len("after:"):])
+        key = (q, tuple(label_ids or ()), include_spam_trash)
+        hidden = set() if include_spam_trash else HIDDEN_LABELS - set(label_ids or ())
+        with self.lock:
+            if key not in self._listings:
+                self._listings[key] = [
+                    message_id for message_id in sorted(self.messages, reverse=True)
+                    if (after is None or self.messages[message_id].date > after)
+                    and all(label in self.labels[message_id] for label in label_ids or ())
+                    and not hidden & set(self.labels[message_id])
+                    and not any(entry in self.messages[message_id].from_header.lower() for entry in excluded)
+                ]
+            return self._listings[key]
+
+    def list_messages(self, maxResults=None, pageToken=None, q=None, labelIds=None, includeSpamTrash=False, **_):
+        ids = self._listing(q, labelIds, includeSpamTrash)
+        start = int(pageToken or 0)
+        end = start + min(maxResults or 100, MAX_LIST_RESULTS)
+        response = {'resultSizeEstimate': len(ids)}
+        if ids[start:end]:
+            response['messages'] = [{'id': message_id, 'threadId': message_id} for message_id in ids[start:end]]
+        if end < len(ids):
+            response['nextPageToken'] = str(end)
+        return response
+
+    def get_message(self, id, format='full', **_):
+        with self.lock:
+            message = self.messages.get(id)
+        if message is None:
+            raise HttpError(FakeResponse(404), b'{"error": {"message": "Not Found"}}')
+        response = {'id': id, 'threadId': id, 'labelIds': self.labels[id], 'internalDate': str(message.date * 1000)}
+        if format != 'minimal':
+            response['sizeEstimate'] = message.size
+            response['payload'] = {'headers': [{'name': 'From', 'value': message.from_header}]}
+        return response
+
+    def delete_messages(self, ids):
+        with self.lock:
+            for message_id in ids:
+                if self.messages.pop(message_id, None) is not None:
+                    label_ids = self.labels.pop(message_id)
+                    self._record({'messagesDeleted': [{'message': {'id': message_id, 'labelIds': label_ids}}]})
+        return {}
+
+    def list_history(self, startHistoryId, pageToken=None, labelId=None, **_):
+        start = int(startHistoryId)
+        with self.lock:
+            if start < self.history_start:
+                raise HttpError(FakeResponse(404), b'{"error": {"message": "Requested entity was not found."}}')
+            records = [dict(change, id=str(history_id)) for history_id, change in self.history
+                       if history_id > start and (labelId is None or any(
+                           labelId in item['message']['labelIds'] for items in change.values() for item in items))]
+            latest = str(self.history_id)
+        offset = int(pageToken or 0)
+        response = {'historyId': latest}
+        if records[offset:offset + HISTORY_PAGE_SIZE]:
+            response['history'] = records[offset:offset + HISTORY_PAGE_SIZE]
+        if offset + HISTORY_PAGE_SIZE < len(records):
+            response['nextPageToken'] = str(offset + HISTORY_PAGE_SIZE)
+        return response
+
+
+class FakeRequest:
+    """An API call not yet sent, like googleapiclient's HttpRequest."""
+
+    def __init__(self, gmail, call):
+        self.gmail = gmail
+        self.call = call
+
+    def execute(self):
+        if self.gmail.failed():
+            self.gmail.round_trip({})
+            raise simulated_error(self.gmail.error_status)
+        response = self.call()
+        self.gmail.round_trip(response)
+        return response
+
+
+class FakeBatch:
+    """Up to MAX_BATCH_CALLS requests sent as one HTTP request, answered through a callback per item."""
+
+    def __init__(self, gmail, callback):
+        self.gmail = gmail
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, request_id=None, callback=None):
+        if len(self.requests) >= MAX_BATCH_CALLS:
+            raise ValueError(f"Batches are limited to {MAX_BATCH_CALLS} calls")
+        self.requests.append((request_id or str(len(self.requests)), request, callback or self.callback))
+
+    def execute(self):
+        results = []
+        for request_id, request, callback in self.requests:
+            if self.gmail.failed():
+                results.append((request_id, callback, None, simulated_error(self.gmail.error_status)))
+                continue
+            try:
+                results.append((request_id, callback, request.call(), None))
+            except HttpError as error:
+                results.append((request_id, callback, None, error))
+        self.gmail.round_trip([response for _, _, response, _ in results])
+        for request_id, callback, response, exception in results:
+            callback(request_id, response, exception)
+
+
+class FakeService:
+    """The chained users().messages()... resource interface over a FakeGmail."""
+
+    def __init__(self, gmail):
+        self.gmail = gmail
+
+    def _request(self, call):
+        return FakeRequest(self.gmail, call)
+
+    def users(self):
+        return self
+
+    def messages(self):
+        return self
+
+    def history(self):
+        return FakeHistory(self)
+
+    def new_batch_http_request(self, callback=None):
+        return FakeBatch(self.gmail, callback)
+
+    def getProfile(self, userId='me'):
+        return self._request(self.gmail.get_profile)
+
+    def list(self, userId='me', **kwargs):
+        return self._request(lambda: self.gmail.list_messages(**kwargs))
+
+    def get(self, userId='me', id=None, **kwargs):
+        return self._request(lambda: self.gmail.get_message(id, **kwargs))
+
+    def batchDelete(self, userId='me', body=None):
+        return self._request(lambda: self.gmail.delete_messages(body['ids']))
+
+    def delete(self, userId='me', id=None):
+        return self._request(lambda: self.gmail.delete_messages([id]))
+
+
+class FakeHistory:
+    def __init__(self, service):
+        self.service = service
+
+    def list(self, userId='me', **kwargs):
+        return self.service._request(lambda: self.service.gmail.list_history(**kwargs))
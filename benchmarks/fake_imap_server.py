@@ -0,0 +1,343 @@
+﻿"""Local IMAP server over a synthetic mailbox, for benchmarking email_utils without a real account.
+
+It speaks the subset of IMAP4rev1 the sweep uses: LOGIN, SELECT, UID SEARCH
+(ALL, UID sets, FROM, NOT and, with gmail_extensions, X-GM-RAW -from:),
+UID FETCH of the From/Date headers and size (and, with gmail_extensions,
+X-GM-MSGID), UID MOVE, and the UID COPY + STORE + EXPUNGE fallback. Every
+command is one round trip; each is delayed by `latency` seconds, and a
+header FETCH drops the connection with probability `error_rate`, as a
+flaky server would.
+
+By default any folder name selects the one mailbox. Given `folders`, each
+folder holds its own share of the messages under its own UIDs; with
+gmail_extensions a message may be in several folders, like a Gmail message
+with several labels, and trashing it from one removes it from all of them.
+"""
+import os
+import random
+import re
+import socketserver
+import ssl
+import subprocess
+import tempfile
+import threading
+import time
+from email.utils import formatdate
+
+TOKEN = re.compile(r'"((?:[^"\\]|\\.)*)"|(\()|(\))|([^\s()]+)')
+RAW_TERM = re.compile(r"(-?)from:(\S+)", re.IGNORECASE)
+
+
+def tokenize(text):
+    """Split IMAP arguments into strings, keeping quoted strings whole and parentheses as tokens."""
+    tokens = []
+    for quoted, opening, closing, atom in TOKEN.findall(text):
+        if opening or closing or atom:
+            tokens.append(opening or closing or atom)
+        else:
+            tokens.append(quoted.replace('\\"', '"').replace("\\\\", "\\"))
+    return tokens
+
+
+def parse_set(uid_set, highest):
+    """Expand a UID set such as '1:3,7,9:*' into a set of ints; '*' is the highest UID in the mailbox."""
+    uids = set()
+    for part in uid_set.split(","):
+        bounds = [highest if bound == "*" else int(bound) for bound in part.split(":")]
+        uids.update(range(min(bounds), max(bounds) + 1))
+    return uids
+
+
+def self_signed_context():
+    """Server-side TLS context with a throwaway self-signed certificate made by the openssl CLI."""
+    directory = tempfile.mkdtemp(prefix="fake-imap-")
+    cert, key = os.path.join(directory, "cert.pem"), os.path.join(directory, "key.pem")
+    subprocess.run(
+        ["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+         "-subj", "/CN=localhost", "-keyout", key, "-out", cert],
+        check=True, capture_output=True,
+    )
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(cert, key)
+    return context
+
+
+class Mailbox:
+    """UID -> SyntheticMessage, shared by every connection; UIDs start at 1 and only grow.
+
+    msgids are the messages' X-GM-MSGIDs, by default their UIDs.
+    """
+
+    def __init__(self, messages, uidvalidity=1, msgids=None):
+        self.messages = {uid: message for uid, message in enumerate(messages, start=1)}
+        self.msgids = dict(enumerate(msgids or range(1, len(self.messages) + 1), start=1))
+        self.uidvalidity = uidvalidity
+        self.next_uid = len(self.messages) + 1
+        self.deleted = set()
+        self.trashed = 0
+        self.lock = threading.Lock()
+
+    def from_matching(self, uids, needles):
+        """The uids whose From header contains any of needles, ignoring case."""
+        pattern = re.compile("|".join(re.escape(needle.lower()) for needle in needles))
+        matches = {}  # Many messages share a From header
+        return {uid for uid in uids
+                if matches.setdefault(self.messages[uid].from_header,
+                                      pattern.search(self.messages[uid].from_header.lower()) is not None)}
+
+    def highest(self):
+        return max(self.messages, default=0)
+
+    def append(self, message, msgid=None):
+        with self.lock:
+            self.messages[self.next_uid] = message
+            self.msgids[self.next_uid] = msgid or self.next_uid
+            self.next_uid += 1
+
+    def remove(self, uids):
+        """Remove uids and return the X-GM-MSGIDs of the messages removed."""
+        removed = [uid for uid in uids if self.messages.pop(uid, None) is not None]
+        self.deleted.difference_update(removed)
+        self.trashed += len(removed)
+        return [self.msgids[uid] for uid in removed]
+
+    def remove_msgids(self, msgids):
+        with self.lock:
+            self.remove([uid for uid in self.messages if self.msgids[uid] in msgids])
+
+
+class Stats:
+    def __init__(self):
+        self.round_trips = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.connections = 0
+        self.dropped = 0
+        self.lock = threading.Lock()
+
+    def add(self, **counts):
+        with self.lock:
+            for name, count in counts.items():
+                setattr(self, name, getattr(self, name) + count)
+
+    def snapshot(self):
+        with self.lock:
+            return {name: getattr(self, name)
+                    for name in ("round_trips", "bytes_in", "bytes_out", "connections", "dropped")}
+
+
+class DropConnection(Exception):
+    pass
+
+
+class ImapHandler(socketserver.StreamRequestHandler):
+    def setup(self):
+        if self.server.ssl_context is not None:
+            self.request = self.server.ssl_context.wrap_socket(self.request, server_side=True)
+        super().setup()
+
+    def handle(self):
+        server = self.server
+        server.stats.add(connections=1)
+        self.mailbox = server.mailbox
+        self.send(b"* OK Fake IMAP server ready\r\n")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            server.stats.add(round_trips=1, bytes_in=len(line))
+            tag, _, rest = line.decode(errors="replace").rstrip("\r\n").partition(" ")
+            command, _, args = rest.partition(" ")
+            command = command.upper()
+            if command == "UID":
+                command, _, args = args.partition(" ")
+                command = "UID " + command.upper()
+            try:
+                untagged, status = self.dispatch(command, args)
+            except DropConnection:
+                server.stats.add(dropped=1)
+                return
+            if server.latency:
+                time.sleep(server.latency)
+            self.send(b"".join(untagged) + f"{tag} {status}\r\n".encode())
+            if command == "LOGOUT":
+                return
+
+    def send(self, data):
+        self.server.stats.add(bytes_out=len(data))
+        self.wfile.write(data)
+        self.wfile.flush()
+
+    def dispatch(self, command, args):
+        if command in ("SELECT", "EXAMINE"):
+            self.mailbox = self.server.folder(tokenize(args)[0])
+            if self.mailbox is None:
+                return [], f"NO {command} no such mailbox"
+        mailbox = self.mailbox
+        if command == "CAPABILITY":
+            return [f"* CAPABILITY {' '.join(self.server.capabilities)}\r\n".encode()], "OK CAPABILITY completed"
+        if command == "LOGIN":
+            return [], "OK LOGIN completed"
+        if command in ("SELECT", "EXAMINE"):
+            with mailbox.lock:
+                lines = [
+                    f"* {len(mailbox.messages)} EXISTS\r\n",
+                    "* 0 RECENT\r\n",
+                    f"* OK [UIDVALIDITY {mailbox.uidvalidity}] UIDs valid\r\n",
+                    f"* OK [UIDNEXT {mailbox.next_uid}] Predicted next UID\r\n",
+                ]
+            return [line.encode() for line in lines], f"OK [READ-WRITE] {command} completed"
+        if command == "NOOP":
+            return [], "OK NOOP completed"
+        if command == "LOGOUT":
+            return [b"* BYE Logging out\r\n"], "OK LOGOUT completed"
+        if command == "UID SEARCH":
+            with mailbox.lock:
+                found = self.search(tokenize(args))
+            return [("* SEARCH " + " ".join(map(str, sorted(found))) + "\r\n").encode()], "OK SEARCH completed"
+        if command == "UID FETCH":
+            uid_set, _, items = args.partition(" ")
+            headers = "BODY" in items.upper()
+            if headers and self.server.error_rate and self.server.roll() < self.server.error_rate:
+                raise DropConnection()
+            return self.fetch(uid_set, headers, "X-GM-MSGID" in items.upper()), "OK FETCH completed"
+        if command == "UID MOVE":
+            with mailbox.lock:
+                removed = mailbox.remove(sorted(parse_set(args.split(" ", 1)[0], mailbox.highest())))
+            self.server.removed(mailbox, removed)
+            return [], "OK MOVE completed"
+        if command == "UID COPY":
+            return [], "OK COPY completed"
+        if command == "UID STORE":
+            with mailbox.lock:
+                uids = parse_set(args.split(" ", 1)[0], mailbox.highest())
+                if "\\DELETED" in args.upper():
+                    mailbox.deleted.update(uid for uid in uids if uid in mailbox.messages)
+            return [], "OK STORE completed"
+        if command in ("UID EXPUNGE", "EXPUNGE"):
+            with mailbox.lock:
+                uids = mailbox.deleted
+                if command == "UID EXPUNGE":
+                    uids = uids & parse_set(args, mailbox.highest())
+                removed = mailbox.remove(sorted(uids))
+            self.server.removed(mailbox, removed)
+            return [], "OK EXPUNGE completed"
+        return [], f"BAD {command} not supported"
+
+    def search(self, tokens):
+        """UIDs matching every search key in tokens; NOT negates the key after it.
+
+        The senders a search excludes (NOT FROM, X-GM-RAW -from:) are applied
+        together in one pass, so long safe lists do not make the fake slower
+        than the client it is measuring.
+        """
+        mailbox = self.mailbox
+        uids = set(mailbox.messages)
+        excluded = []
+        negate = False
+        keys = iter(tokens)
+        for key in keys:
+            key = key.upper()
+            if key == "NOT":
+                negate = not negate
+                continue
+            if key == "FROM" and negate:
+                excluded.append(next(keys))
+            elif key == "FROM":
+                uids &= mailbox.from_matching(uids, [next(keys)])
+            elif key == "X-GM-RAW" and "X-GM-EXT-1" in self.server.capabilities:
+                for minus, needle in RAW_TERM.findall(next(keys)):
+                    if minus:
+                        excluded.append(needle)
+                    else:
+                        uids &= mailbox.from_matching(uids, [needle])
+            elif key == "UID":
+                matched = parse_set(next(keys), mailbox.highest())
+                uids = uids - matched if negate else uids & matched
+            elif key == "ALL" and negate:
+                uids = set()
+            negate = False
+        if excluded:
+            uids -= mailbox.from_matching(uids, excluded)
+        return uids
+
+    def fetch(self, uid_set, headers=True, msgid=False):
+        mailbox = self.mailbox
+        with mailbox.lock:
+            order = sorted(mailbox.messages)
+            sequence = {uid: number for number, uid in enumerate(order, start=1)}
+            wanted = sorted(parse_set(uid_set, order[-1] if order else 0) & sequence.keys())
+            messages = [(uid, sequence[uid], mailbox.messages[uid], mailbox.msgids[uid]) for uid in wanted]
+        msgid = msgid and "X-GM-EXT-1" in self.server.capabilities
+        responses = []
+        for uid, number, message, message_msgid in messages:
+            items = f"UID {uid}" + (f" X-GM-MSGID {message_msgid}" if msgid else "")
+            if not headers:
+                responses.append(f"* {number} FETCH ({items})\r\n".encode())
+                continue
+            header = (f"From: {message.from_header}\r\n"
+                      f"Date: {formatdate(message.date, usegmt=True)}\r\n\r\n").encode()
+            responses.append(
+                f"* {number} FETCH ({items} RFC822.SIZE {message.size} "
+                f"BODY[HEADER.FIELDS (FROM DATE)] {{{len(header)}}}\r\n".encode() + header + b")\r\n"
+            )
+        return responses
+
+
+class FakeImapServer(socketserver.ThreadingTCPServer):
+    """Threaded local IMAP server; start() runs it in the background and returns the port it listens on."""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, messages, host="127.0.0.1", port=0, latency=0.0, error_rate=0.0,
+                 gmail_extensions=False, ssl_context=None, uidvalidity=1, seed=0, folders=None):
+        super().__init__((host, port), ImapHandler)
+        # folders maps folder name to the indexes of its messages; X-GM-MSGIDs are the indexes plus one
+        self.folders = {name: Mailbox([messages[i] for i in indexes], uidvalidity, [i + 1 for i in indexes])
+                        for name, indexes in (folders or {}).items()}
+        self.mailbox = next(iter(self.folders.values())) if self.folders else Mailbox(messages, uidvalidity)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.ssl_context = ssl_context
+        self.capabilities = ["IMAP4rev1", "MOVE", "UIDPLUS"] + (["X-GM-EXT-1"] if gmail_extensions else [])
+        self.stats = Stats()
+        self._rng = random.Random(seed)
+        self._rng_lock = threading.Lock()
+
+    def folder(self, name):
+        """The mailbox a SELECT of name opens, or None if there is no such folder."""
+        if not self.folders:
+            return self.mailbox
+        for folder, mailbox in self.folders.items():
+            if folder == name or folder.upper() == name.upper() == "INBOX":
+                return mailbox
+        return None
+
+    def removed(self, mailbox, msgids):
+        """Trashing a message on Gmail removes every label, so it leaves every other folder too."""
+        if msgids and "X-GM-EXT-1" in self.capabilities:
+            for other in self.folders.values():
+                if other is not mailbox:
+                    other.remove_msgids(set(msgids))
+
+    def message_count(self):
+        """Distinct messages left in the folders."""
+        mailboxes = list(self.folders.values()) or [self.mailbox]
+        msgids = set()
+        for mailbox in mailboxes:
+            with mailbox.lock:
+                msgids.update(mailbox.msgids[uid] for uid in mailbox.messages)
+        return len(msgids)
+
+    def roll(self):
+        with self._rng_lock:
+            return self._rng.random()
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self.server_address[1]
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,61 @@
+﻿"""Synthetic mailboxes for the offline benchmarks, shared by the fake IMAP server and the fake Gmail API."""
+import random
+from collections import namedtuple
+
+SyntheticMessage = namedtuple("SyntheticMessage", ["from_header", "size", "date"])
+
+START_DATE = 1_600_000_000  # Unix time of the oldest message
+SECONDS_PER_MESSAGE = 600
+
+
+def random_word(rng, length):
+    return "".join(rng.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(length))
+
+
+def make_senders(rng, count):
+    """count distinct sender addresses spread over about count / 5 domains."""
+    domains = [f"{random_word(rng, 7)}.{rng.choice(['com', 'net', 'org'])}" for _ in range(max(1, count // 5))]
+    senders = set()
+    while len(senders) < count:
+        senders.add(f"{random_word(rng, 8)}@{rng.choice(domains)}")
+    return sorted(senders)
+
+
+def make_mailbox(size, distinct_senders=1000, skew=1.1, seed=42):
+    """Return (messages oldest first, senders by popularity) for a mailbox of `size` messages.
+
+    Sender popularity follows a Zipf law with exponent skew, so a few senders
+    account for most of the mail, as in a real inbox; 0 makes every sender
+    equally likely.
+    """
+    rng = random.Random(seed)
+    senders = make_senders(rng, distinct_senders)
+    weights = [1 / (rank + 1) ** skew for rank in range(len(senders))]
+    messages = []
+    for i, sender in enumerate(rng.choices(senders, weights, k=size)):
+        name = sender.split("@")[0].capitalize()
+        from_header = f"{name} <{sender}>" if rng.random() < 0.8 else sender
+        messages.append(SyntheticMessage(from_header, rng.randint(2_000, 200_000), START_DATE + i * SECONDS_PER_MESSAGE))
+    return messages, senders
+
+
+def make_safe_list(senders, fraction=0.3, seed=42):
+    """Safe list covering about `fraction` of the senders, picked across the popularity range."""
+    rng = random.Random(seed)
+    return sorted(rng.sample(senders, int(len(senders) * fraction)))
+
+
+def assign_folders(size, folders, overlap=0.2, seed=42):
+    """Return {folder: indexes of its messages} spreading `size` messages over the folders.
+
+    Each message goes to one folder picked at random; with probability
+    overlap it is filed under a second one as well, as a Gmail message with
+    two labels shows up in both folders.
+    """
+    rng = random.Random(seed)
+    assignment = {folder: [] for folder in folders}
+    for i in range(size):
+        chosen = rng.sample(folders, 2 if len(folders) > 1 and rng.random() < overlap else 1)
+        for folder in chosen:
+            assignment[folder].append(i)
+    return assignment
@@ -0,0 +1,133 @@
+﻿import json
+import sqlite3
+import threading
+import time
+import uuid
+
+from safe_list_store import matcher_for, safe_list_digest
+
+PLAN_FILE = "deletion_plans.db"
+PLAN_TTL = 24 * 3600  # Seconds a plan stays executable; older plans are dropped
+
+
+class DeletionPlan:
+    """What a dry run decided to delete, so the real delete can act on it without another sweep.
+
+    targets maps message id (UID for IMAP) to sender. safe_list_digest
+    identifies the safe list the decisions were made with; if the safe list
+    has changed by the time the plan runs, targets are re-checked against it
+    locally. high_water marks the newest mail the dry run saw (see
+    MailBackend), so only mail that arrived after it is fetched and
+    classified when the plan runs.
+    """
+
+    def __init__(self, account, targets, safe_list_digest, uidvalidity=None, high_water=None,
+                 plan_id=None, created=None):
+        self.id = plan_id or uuid.uuid4().hex
+        self.account = account
+        self.targets = dict(targets)
+        self.safe_list_digest = safe_list_digest
+        self.uidvalidity = uidvalidity
+        self.high_water = high_water
+        self.created = created or time.time()
+
+    @classmethod
+    def from_index(cls, index, safe_list_digest):
+        """The plan a dry run over index's scan would have produced."""
+        targets = {}
+        for sender in index.senders():
+            targets.update((message_id, sender) for message_id in index.stats(sender).ids)
+        return cls(index.account, targets, safe_list_digest, index.uidvalidity, index.high_water)
+
+    def __len__(self):
+        return len(self.targets)
+
+    def current_targets(self, safe_list):
+        """targets, less any sender the safe list has come to cover since the plan was made."""
+        if safe_list_digest(safe_list) == self.safe_list_digest:
+            return dict(self.targets)
+        matcher = matcher_for(safe_list)
+        return {message_id: sender for message_id, sender in self.targets.items() if not matcher.matches(sender)}
+
+
+class PlanStore:
+    """Deletion plans on disk, keyed by plan id, so a confirmed delete can run after a restart."""
+
+    def __init__(self, path=PLAN_FILE, ttl=PLAN_TTL):
+        self.path = path
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS plans ("
+                " id TEXT PRIMARY KEY,"
+                " account TEXT,"
+                " safe_list_digest TEXT NOT NULL,"
+                " uidvalidity TEXT,"
+                " high_water TEXT,"
+                " created REAL NOT NULL)"
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS plan_messages ("
+                " plan_id TEXT NOT NULL,"
+                " message_id TEXT NOT NULL,"
+                " sender TEXT,"
+                " PRIMARY KEY (plan_id, message_id))"
+            )
+
+    def save(self, plan):
+        with self._lock, self._conn:
+            self._expire()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO plans (id, account, safe_list_digest, uidvalidity, high_water, created)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                (plan.id, plan.account, plan.safe_list_digest, plan.uidvalidity,
+                 json.dumps(plan.high_water), plan.created),
+            )
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO plan_messages (plan_id, message_id, sender) VALUES (?, ?, ?)",
+                [(plan.id, message_id, sender) for message_id, sender in plan.targets.items()],
+            )
+        return plan
+
+    def get(self, plan_id):
+        """The plan, or None if there is no such plan or it has expired."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT account, safe_list_digest, uidvalidity, high_water, created FROM plans"
+                " WHERE id = ? AND created >= ?",
+                (plan_id, time.time() - self.ttl),
+            ).fetchone()
+            if row is None:
+                return None
+            targets = self._conn.execute(
+                "SELECT message_id, sender FROM plan_messages WHERE plan_id = ?", (plan_id,)
+            ).fetchall()
+        account, digest, uidvalidity, high_water, created = row
+        return DeletionPlan(account, targets, digest, uidvalidity, json.loads(high_water), plan_id, created)
+
+    def discard(self, plan_id):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM plan_messages WHERE plan_id = ?", (plan_id,))
+            self._conn.execute("DELETE FROM plans WHERE id = ?", (plan_id,))
+
+    def _expire(self):
+        cutoff = time.time() - self.ttl
+        self._conn.execute(
+            "DELETE FROM plan_messages WHERE plan_id IN (SELECT id FROM plans WHERE created < ?)", (cutoff,)
+        )
+        self._conn.execute("DELETE FROM plans WHERE created < ?", (cutoff,))
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_plan_store():
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = PlanStore()
+        return _store
@@ -1,331 +1,460 @@
 ﻿import imaplib
-import email
 import re
-from email.header import decode_header
 import json
 import os
-import time
-
-SAFE_LIST_FILE = "safe_list.json"
-
-def load_safe_list():
-    if not os.path.exists(SAFE_LIST_FILE):
-        with open(SAFE_LIST_FILE, "w") as f:
-            json.dump([], f)
-        return []
-
+from email.utils import parsedate_to_datetime
+import queue
+import tempfile
+import threading
+from contextlib import contextmanager
+from deletion_plan import get_plan_store
+from header_cache import get_cache
+from mail_backend import MailBackend, MultiFolderBackend
+from metrics import RECONNECTS
+from search_query import split_safe_list, compile_imap_criteria, compile_gmail_raw_criteria
+from sender_parser import sender_from_headers
+from sender_index import MessageInfo
+import pipeline
+
+CHECKPOINT_FILE = "imap_checkpoints.json"
+IMAP_SERVER = os.environ.get("IMAP_SERVER", "imap.gmail.com") # Can be changed to fit other email services
+IMAP_PORT = int(os.environ.get("IMAP_PORT", "993"))
+IMAP_SSL = os.environ.get("IMAP_SSL", "1") != "0"  # Set IMAP_SSL=0 for a plain-text local server
+MAILBOX = "inbox"
+# Comma-separated folders to sweep, e.g. "INBOX,[Gmail]/Spam"; more than one are swept together
+IMAP_FOLDERS = [folder.strip() for folder in os.environ.get("IMAP_FOLDERS", MAILBOX).split(",") if folder.strip()]
+TRASH_MAILBOX = "[Gmail]/Trash"
+FETCH_CHUNK_SIZE = 500  # Messages per FETCH command
+MAX_SET_LENGTH = 4000  # Longest UID set sent in one MOVE/COPY/STORE/EXPUNGE
+FROM_HEADER_QUERY = "(UID RFC822.SIZE BODY.PEEK[HEADER.FIELDS (FROM DATE)])"
+IMAP_CONNECTIONS = 4  # Extra connections per scan; Gmail allows 15 per account
+
+_checkpoint_lock = threading.Lock()  # Sweeps running at once update the one checkpoint file
+
+def load_checkpoints():
+    if not os.path.exists(CHECKPOINT_FILE):
+        return {}
     try:
-        with open(SAFE_LIST_FILE, "r") as f:
-            data = f.read().strip()
-            if not data:
-                return []
-            return json.loads(data)
+        with open(CHECKPOINT_FILE, "r") as f:
+            return json.load(f)
     except (json.JSONDecodeError, IOError) as e:
-        print(f"Warning Failed to load safe list: {e}")
-        return []
-
-def save_safe_list(safe_list):
-    with open(SAFE_LIST_FILE, "w") as f:
-        json.dump(sorted(list(set(safe_list))), f, indent=2)
+        print(f"Warning Failed to load scan checkpoints: {e}")
+        return {}
 
-def fetch_unapproved_senders(email_user, email_pass, safe_list, scan_limit='100'):
-    imap_server = "imap.gmail.com" # Can be changed to fit other email services
-    unapproved_senders = set()
+def save_checkpoints(checkpoints):
+    # A temporary file of its own, so writers in other processes never rename each other's half-written one
+    fd, tmp_file = tempfile.mkstemp(prefix=os.path.basename(CHECKPOINT_FILE) + ".",
+                                    dir=os.path.dirname(os.path.abspath(CHECKPOINT_FILE)))
     try:
-        print("Fetching unapproved senders...")
-        mail = imaplib.IMAP4_SSL(imap_server)
-        mail.login(email_user, email_pass)
-        mail.select("inbox")
-
-        result, data = mail.search(None, "ALL")
-        print("mail.search ran")
-        if result != "OK":
-            return []
-        email_ids = data[0].split()
-        email_ids = [e.decode() for e in email_ids]
-        if scan_limit != 'all':
-            try:
-                limit = int(scan_limit)
-                email_ids = email_ids[-limit:]
-            except ValueError:
-                pass # Use full list if conversion fails
-
-        for i, num in enumerate(email_ids):
-            if i % 10 == 0:
-                print(f"Processed {i} emails...")
-            result, msg_data = mail.fetch(num, "(BODY.PEEK[HEADER.FIELDS (FROM)])")
-            if result != "OK":
-                continue
-
-            msg = email.message_from_bytes(msg_data[0][1])
-            sender = msg.get("From", "")
-            if sender:
-                decoded_sender, _ = decode_header(sender)[0]
-                if isinstance(decoded_sender, bytes):
-                    decoded_sender = decoded_sender.decode(errors="ignore")
-
-                # extract email only
-                if "<" in decoded_sender:
-                    decoded_sender = decoded_sender.split("<")[-1].rstrip(">")
-
-                if decoded_sender not in safe_list:
-                    unapproved_senders.add(decoded_sender)
-                    print(f"Found unapproved sender: {decoded_sender}")
-
-        mail.logout()
-
-    except Exception as e:
-        print("Error: ", e)
-    print(f"Total unapproved senders: {len(unapproved_senders)}")
-    return list(unapproved_senders)
-
-
-def delete_unapproved_emails_dry_run(email_user, email_pass, safe_list, scan_limit='500'):
-    mail = imaplib.IMAP4_SSL("imap.gmail.com")
+        with os.fdopen(fd, "w") as f:
+            json.dump(checkpoints, f)
+        os.replace(tmp_file, CHECKPOINT_FILE)
+    except BaseException:
+        os.unlink(tmp_file)
+        raise
+
+def quote_mailbox(name):
+    """A mailbox name as an IMAP argument, quoted if it has spaces or other specials, e.g. "[Gmail]/All Mail"."""
+    if re.fullmatch(r'[^\s(){%*"\\]+', name):
+        return name
+    return '"' + name.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+def connect(email_user, email_pass, mailbox=MAILBOX, host=None, port=None, use_ssl=None):
+    """Log in, select the mailbox and return (connection, UIDVALIDITY).
+
+    host, port and use_ssl default to IMAP_SERVER, IMAP_PORT and IMAP_SSL.
+    """
+    host, port = host or IMAP_SERVER, port or IMAP_PORT
+    use_ssl = IMAP_SSL if use_ssl is None else use_ssl
+    mail = imaplib.IMAP4_SSL(host, port) if use_ssl else imaplib.IMAP4(host, port)
     mail.login(email_user, email_pass)
-    mail.select("inbox")
+    mail.select(quote_mailbox(mailbox))
+    _, data = mail.response("UIDVALIDITY")
+    uidvalidity = data[0].decode() if data and data[0] else None
+    return mail, uidvalidity
+
+class ConnectionPool:
+    """Up to `size` authenticated connections to one mailbox, opened on demand and reused by shard workers."""
+
+    def __init__(self, email_user, email_pass, size=IMAP_CONNECTIONS, mailbox=MAILBOX, **server):
+        self.email_user = email_user
+        self.email_pass = email_pass
+        self.size = size
+        self.mailbox = mailbox
+        self.server = server  # host, port and use_ssl for connect()
+        self._idle = queue.LifoQueue()
+        self._available = threading.Semaphore(size)
+
+    @contextmanager
+    def connection(self):
+        """Check out a connection; it is discarded instead of returned if the server drops it."""
+        with self._available:
+            try:
+                mail = self._idle.get_nowait()
+            except queue.Empty:
+                mail, _ = connect(self.email_user, self.email_pass, self.mailbox, **self.server)
+            yield mail
+            # Not reached if the body raised, so a dropped connection is never reused
+            self._idle.put(mail)
+
+    def close(self):
+        while True:
+            try:
+                mail = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                mail.logout()
+            except (imaplib.IMAP4.error, OSError):
+                pass
 
-    result, data = mail.search(None, "ALL")
+def search_uids(mail, criteria="ALL"):
+    result, data = mail.uid("SEARCH", None, criteria)
     if result != "OK":
-        mail.logout()
-        return 0
-
-    email_ids = data[0].split()
-    email_ids = [e.decode() for e in email_ids]
+        return None
+    return [e.decode() for e in data[0].split()]
 
+def limit_ids(ids, scan_limit):
     if scan_limit != 'all':
         try:
-            limit = int(scan_limit)
-            email_ids = email_ids[-limit:]
+            return ids[-int(scan_limit):]
         except ValueError:
-            pass
-
-    print(f"DRY RUN: Would process {len(email_ids)} emails")
-
-    would_delete_count = 0
-    processed_count = 0
-
-    for i, num in enumerate(email_ids):
-        processed_count += 1
-        print(f"DRY RUN: Processing {processed_count}/{len(email_ids)} - Email ID: {num}")
-
-        try:
-            result, msg_data = mail.fetch(num, '(BODY.PEEK[HEADER.FIELDS (FROM)])')
-
-            if result != "OK" or not msg_data:
-                print(f"DRY RUN: Would skip email {num} - fetch failed")
-                continue
-
-            sender = None
-            for response_part in msg_data:
-                if response_part is None:
-                    continue
-
-                if isinstance(response_part, tuple) and len(response_part) > 1 and response_part[1]:
-                    raw = response_part[1].decode(errors='ignore')
-
-                    # Extract sender
-                    match = re.search(r"<([^>]+)>", raw)
-                    if match:
-                        sender = match.group(1).strip()
-                    else:
-                        match = re.search(r"From:\s*([^\r\n]+)", raw, re.IGNORECASE)
-                        if match:
-                            from_line = match.group(1).strip()
-                            email_match = re.search(r"([a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,})", from_line)
-                            if email_match:
-                                sender = email_match.group(1)
-                    break
-
-            if sender:
-                is_safe = any(safe.lower() in sender.lower() for safe in safe_list)
-
-                if not is_safe:
-                    would_delete_count += 1
-                    print(f"DRY RUN: WOULD DELETE email from {sender} (#{would_delete_count})")
-                else:
-                    print(f"DRY RUN: Would keep safe email from {sender}")
-            else:
-                print(f"DRY RUN: No sender found for email {num}")
-
-        except Exception as e:
-            print(f"DRY RUN: Error processing email {num}: {e}")
+            pass # Use full list if conversion fails
+    return ids
+
+def sequence_sets(ids, max_length=MAX_SET_LENGTH):
+    """Yield (sequence set, ids) pairs covering ids, each set compressed and at most max_length long."""
+    numbers = sorted(set(int(i) for i in ids))
+    ranges, members, length = [], [], 0
+    start = prev = None
+    for n in numbers + [None]:
+        if start is not None and n == prev + 1:
+            prev = n
             continue
-
-    print(f"DRY RUN SUMMARY: Would delete {would_delete_count} out of {processed_count} emails")
-    mail.logout()
-    return would_delete_count
-
-def delete_unapproved_emails(email_user, email_pass, safe_list, scan_limit='500'):
-    mail = imaplib.IMAP4_SSL("imap.gmail.com")
-    mail.login(email_user, email_pass)
-    mail.select("inbox")
-
-    result, data = mail.search(None, "ALL")
-    if result != "OK":
-        mail.logout()
-        return 0
-
-    email_ids = data[0].split()
-    email_ids = [e.decode() for e in email_ids]
-
-    print(f"DEBUG: Total emails in inbox: {len(email_ids)}")
-    print(f"DEBUG: Scan limit: {scan_limit}")
-
-    if scan_limit != 'all':
-        try:
-            limit = int(scan_limit)
-            original_count = len(email_ids)
-            email_ids = email_ids[-limit:]
-            print(f"DEBUG: Limited from {original_count} to {len(email_ids)} emails")
-        except ValueError:
-            pass
-
-    print(f"DEBUG: Processing {len(email_ids)} emails")
-    print(f"DEBUG: Email ID range: {email_ids[0]} to {email_ids[-1]}")
-
-    deleted_count = 0
-    processed_count = 0
-    failed_fetch_count = 0
-
-    for i, num in enumerate(email_ids):
-        processed_count += 1
-        print(f"DEBUG: Processing {processed_count}/{len(email_ids)} - Email ID: {num}")
-
-        try:
-            # Check connection health
-            try:
-                mail.noop()  # Keep connection alive
-            except:
-                print("DEBUG: Connection lost, reconnecting...")
-                mail.logout()
-                mail = imaplib.IMAP4_SSL("imap.gmail.com")
-                mail.login(email_user, email_pass)
-                mail.select("inbox")
-
-            result, msg_data = mail.fetch(num, '(BODY.PEEK[HEADER.FIELDS (FROM)])')
-            print(f"DEBUG: Fetch result: {result}")
-
-            if result != "OK":
-                print(f"DEBUG: Fetch failed for email {num} - Result: {result}")
-                failed_fetch_count += 1
-                continue
-
-            if not msg_data:
-                print(f"DEBUG: No data returned for email {num}")
-                failed_fetch_count += 1
-                continue
-
-            print(f"DEBUG: msg_data type: {type(msg_data)}, length: {len(msg_data)}")
-
-            sender_found = False
-            for response_part in msg_data:
-                print(f"DEBUG: Processing response part: {type(response_part)}")
-
-                # Handle None response parts
-                if response_part is None:
-                    print(f"DEBUG: Response part is None, skipping")
-                    continue
-
-                if isinstance(response_part, tuple):
-                    if len(response_part) < 2 or response_part[1] is None:
-                        print(f"DEBUG: Tuple response part has no data: {response_part}")
-                        continue
-
-                    raw = response_part[1].decode(errors='ignore')
-                    print(f"DEBUG: Raw header (first 200 chars): {raw[:200]}")
-
-                    # Extract sender email
-                    sender = None
-                    match = re.search(r"<([^>]+)>", raw)
-                    if match:
-                        sender = match.group(1).strip()
-                        print(f"DEBUG: Found sender in brackets: {sender}")
-                    else:
-                        match = re.search(r"From:\s*([^\r\n]+)", raw, re.IGNORECASE)
-                        if match:
-                            from_line = match.group(1).strip()
-                            email_match = re.search(r"([a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,})", from_line)
-                            if email_match:
-                                sender = email_match.group(1)
-                                print(f"DEBUG: Found sender without brackets: {sender}")
-
-                    if sender:
-                        sender_found = True
-                        print(f"DEBUG: Checking if '{sender}' is safe...")
-
-                        is_safe = any(safe.lower() in sender.lower() for safe in safe_list)
-                        print(f"DEBUG: Is safe: {is_safe}")
-
-                        if not is_safe:
-                            print(f"DEBUG: Moving email {num} from {sender} to trash")
-                            try:
-                                mail.copy(num, '[Gmail]/Trash')
-                                mail.store(num, '+FLAGS', '\\Deleted')
-                                deleted_count += 1
-                                print(f"DEBUG: Successfully moved email {deleted_count}")
-                            except Exception as move_error:
-                                print(f"DEBUG: Error moving email {num}: {move_error}")
-                            if deleted_count % 50 == 0:
-                                mail.expunge()
-                        else:
-                            print(f"DEBUG: Email from {sender} is safe, skipping")
-                        break
-                else:
-                    print(f"DEBUG: Unexpected response type: {type(response_part)}")
-
-            if not sender_found:
-                print(f"DEBUG: No sender found in email {num} - trying alternative fetch method")
-                # Try fetching the entire header as fallback
-                try:
-                    result2, msg_data2 = mail.fetch(num, '(BODY.PEEK[HEADER])')
-                    if result2 == "OK" and msg_data2:
-                        for part in msg_data2:
-                            if isinstance(part, tuple) and part[1]:
-                                full_header = part[1].decode(errors='ignore')
-                                match = re.search(r"^From:\s*(.+)$", full_header, re.MULTILINE | re.IGNORECASE)
-                                if match:
-                                    from_line = match.group(1).strip()
-                                    email_match = re.search(r"([a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,})",
-                                                            from_line)
-                                    if email_match:
-                                        sender = email_match.group(1)
-                                        print(f"DEBUG: Found sender via full header: {sender}")
-                                        sender_found = True
-
-                                        is_safe = any(safe.lower() in sender.lower() for safe in safe_list)
-                                        if not is_safe:
-                                            mail.copy(num, '[Gmail]/Trash')
-                                            mail.store(num, '+FLAGS', '\\Deleted')
-                                            deleted_count += 1
-                                            print(f"DEBUG: Moved email via fallback method")
-                                        break
-                except Exception as fallback_error:
-                    print(f"DEBUG: Fallback method failed: {fallback_error}")
-
-            if not sender_found:
-                failed_fetch_count += 1
-                print(f"DEBUG: Still no sender found for email {num} - email may be corrupted or deleted")
-            if failed_fetch_count >= 10:
-                break
-        except Exception as e:
-            print(f"DEBUG: Exception processing email {num}: {e}")
-            import traceback
-            traceback.print_exc()
+        if start is not None:
+            item = f"{start}:{prev}" if start != prev else str(start)
+            if ranges and length + len(item) + 1 > max_length:
+                yield ",".join(ranges), members
+                ranges, members, length = [], [], 0
+            ranges.append(item)
+            members.extend(str(m) for m in range(start, prev + 1))
+            length += len(item) + 1
+        start = prev = n
+    if ranges:
+        yield ",".join(ranges), members
+
+def sequence_set(ids):
+    """Compress message ids into an IMAP sequence set, e.g. ['1', '2', '3', '7'] -> '1:3,7'."""
+    return ",".join(uid_set for uid_set, _ in sequence_sets(ids, max_length=float("inf")))
+
+def parse_fetch_response(msg_data):
+    """Split a multi-message UID FETCH response into (uid, raw header bytes, RFC822.SIZE or None) triples."""
+    triples = []
+    for i, response_part in enumerate(msg_data or []):
+        if not isinstance(response_part, tuple) or len(response_part) < 2:
             continue
-    time.sleep(0.5)
-
-    print(f"DEBUG: Final stats:")
-    print(f"  - Processed: {processed_count}")
-    print(f"  - Failed fetches: {failed_fetch_count}")
-    print(f"  - Moved to trash: {deleted_count}")
-
+        # Servers may send the UID and size items before or after the header literal
+        trailer = msg_data[i + 1] if i + 1 < len(msg_data) and isinstance(msg_data[i + 1], bytes) else b""
+        match = re.search(rb"UID\s+(\d+)", response_part[0]) or re.search(rb"UID\s+(\d+)", trailer)
+        if match:
+            size = re.search(rb"RFC822\.SIZE\s+(\d+)", response_part[0]) or re.search(rb"RFC822\.SIZE\s+(\d+)", trailer)
+            triples.append((match.group(1).decode(), response_part[1] or b"", int(size.group(1)) if size else None))
+    return triples
+
+def fetch_message_infos(mail, uids, chunk_size=FETCH_CHUNK_SIZE):
+    """Yield (uid, MessageInfo) for every uid, using one UID FETCH round trip per chunk."""
+    for start in range(0, len(uids), chunk_size):
+        chunk = uids[start:start + chunk_size]
+        result, msg_data = mail.uid("FETCH", sequence_set(chunk), FROM_HEADER_QUERY)
+        if result != "OK":
+            print(f"Batch fetch failed for {len(chunk)} emails - Result: {result}")
+            continue
+        for uid, raw, size in parse_fetch_response(msg_data):
+            yield uid, message_info(raw, size)
+
+def extract_date(raw):
+    """Return the Unix time of a raw header block's Date header, or None."""
+    if isinstance(raw, bytes):
+        raw = raw.decode(errors="ignore")
+    match = re.search(r"^Date:\s*([^\r\n]+)", raw or "", re.IGNORECASE | re.MULTILINE)
+    if not match:
+        return None
     try:
-        print("DEBUG: Running expunge...")
-        mail.expunge()
-        print("DEBUG: Expunge completed")
-    except Exception as e:
-        print(f"DEBUG: Error during expunge: {e}")
-
-    mail.logout()
-    return deleted_count
\ No newline at end of file
+        return parsedate_to_datetime(match.group(1).strip()).timestamp()
+    except (TypeError, ValueError, IndexError):
+        return None
+
+def message_info(raw, size=None):
+    return MessageInfo(sender_from_headers(raw), size, extract_date(raw))
+
+def fetch_message_keys(mail, uids):
+    """Return {uid: X-GM-MSGID}, Gmail's id for a message in whichever folders it shows up, one FETCH per UID set."""
+    keys = {}
+    for uid_set, _ in sequence_sets(uids):
+        result, data = mail.uid("FETCH", uid_set, "(X-GM-MSGID)")
+        if result != "OK":
+            print(f"Message id fetch failed - Result: {result}")
+            continue
+        for line in data or []:
+            line = line[0] if isinstance(line, tuple) else line
+            uid = re.search(rb"UID\s+(\d+)", line or b"")
+            msgid = re.search(rb"X-GM-MSGID\s+(\d+)", line or b"")
+            if uid and msgid:
+                keys[uid.group(1).decode()] = msgid.group(1).decode()
+    return keys
+
+def move_to_trash(mail, uids):
+    """Move uids to the trash in bulk and return the ones that were moved.
+
+    Uses UID MOVE (RFC 6851) when the server supports it. Otherwise it uses
+    UID COPY + UID STORE over compressed UID sets, followed by one UID EXPUNGE
+    (RFC 4315), or a plain EXPUNGE on servers without UIDPLUS.
+    """
+    use_move = "MOVE" in mail.capabilities
+    moved = []
+    for uid_set, members in sequence_sets(uids):
+        if use_move:
+            result, _ = mail.uid("MOVE", uid_set, quote_mailbox(TRASH_MAILBOX))
+        else:
+            result, _ = mail.uid("COPY", uid_set, quote_mailbox(TRASH_MAILBOX))
+            if result == "OK":
+                result, _ = mail.uid("STORE", uid_set, "+FLAGS.SILENT", "(\\Deleted)")
+        if result == "OK":
+            moved.extend(members)
+        else:
+            print(f"Failed to move {len(members)} emails to trash - Result: {result}")
+
+    if moved and not use_move:
+        if "UIDPLUS" in mail.capabilities:
+            for uid_set, _ in sequence_sets(moved):
+                mail.uid("EXPUNGE", uid_set)
+        else:
+            mail.expunge()
+    return moved
+
+def pushdown_criteria(capabilities, safe_list):
+    """Return the SEARCH criteria strings that exclude mail from pushdown safe-list entries."""
+    pushdown, _ = split_safe_list(safe_list)
+    if not pushdown:
+        return []
+    if "X-GM-EXT-1" in capabilities:
+        return compile_gmail_raw_criteria(pushdown)
+    return compile_imap_criteria(pushdown)
+
+def search_candidate_uids(mail, scope, safe_list):
+    """Return the uids in scope that the server reports as not from any pushdown safe-list entry.
+
+    Uses X-GM-RAW when the server advertises Gmail extensions and chained
+    NOT FROM criteria otherwise. Entries too ambiguous to push down are left
+    for the client-side matcher, so the result may still contain safe mail.
+    """
+    criteria = pushdown_criteria(mail.capabilities, safe_list)
+    if not scope or not criteria:
+        return scope
+
+    uid_range = f"UID {scope[0]}:{scope[-1]}"
+    candidates = set(scope)
+    for criterion in criteria:
+        found = search_uids(mail, f"{uid_range} {criterion}")
+        if found is None:
+            print("Server-side search failed, falling back to fetching every header")
+            return scope
+        candidates.intersection_update(found)
+        if not candidates:
+            break
+    print(f"Server-side search left {len(candidates)} of {len(scope)} emails to check")
+    return [uid for uid in scope if uid in candidates]
+
+def prune_cache(email_user, uidvalidity, scope, mailbox=MAILBOX):
+    """Bring the header cache in line with the mailbox before scanning scope, its newest slice.
+
+    Cached senders for the account/mailbox are dropped when UIDVALIDITY
+    changes, which forces a full rescan, and cached uids in scope's range that
+    are no longer listed are pruned as deleted.
+    """
+    cache = get_cache()
+    key = f"{email_user}/{mailbox}"
+    checkpoint = load_checkpoints().get(key)
+    if not checkpoint or checkpoint.get("uidvalidity") != uidvalidity:
+        if checkpoint:
+            print(f"UIDVALIDITY changed for {key}, rescanning mailbox")
+        cache.invalidate(email_user, mailbox)
+
+    if scope:
+        lowest = int(scope[0])
+        listed = set(scope)
+        stale = [uid for uid in cache.keys(email_user, mailbox) if int(uid) >= lowest and uid not in listed]
+        cache.invalidate(email_user, mailbox, stale)
+
+def cached_messages(email_user, uidvalidity, scope, uids, mailbox=MAILBOX):
+    """Return ({uid: MessageInfo} from the header cache, uids still to fetch), after prune_cache."""
+    prune_cache(email_user, uidvalidity, scope, mailbox)
+    known = get_cache().get_infos(email_user, mailbox, uids)
+    missing = [uid for uid in uids if uid not in known]
+    print(f"Header cache has {len(known)} of {len(uids)} emails, fetching {len(missing)}")
+    return known, missing
+
+def save_checkpoint(email_user, uidvalidity, mailbox=MAILBOX):
+    """Record the mailbox's UIDVALIDITY, which prune_cache() compares on the next scan."""
+    key = f"{email_user}/{mailbox}"
+    with _checkpoint_lock:  # Read-modify-write, so another sweep's checkpoint is not lost
+        checkpoints = load_checkpoints()
+        if checkpoints.get(key) == {"uidvalidity": uidvalidity}:
+            return
+        checkpoints[key] = {"uidvalidity": uidvalidity}
+        save_checkpoints(checkpoints)
+
+class ImapBackend(MailBackend):
+    """An IMAP mailbox, for the sweep pipeline.
+
+    Listing is one UID SEARCH plus the safe-list pushdown searches, made on
+    the main connection before the first page is yielded. Fetches run on up
+    to `connections` pooled connections at once and go to the server only for
+    uids missing from the header cache. Trashing uses the main connection.
+    high_water is the highest UID listed, as UIDs only ever grow within one
+    UIDVALIDITY. host, port and use_ssl are passed on to connect().
+    """
+
+    name = "imap"
+    page_size = FETCH_CHUNK_SIZE
+
+    def __init__(self, email_user, email_pass, connections=IMAP_CONNECTIONS, mailbox=MAILBOX,
+                 host=None, port=None, use_ssl=None):
+        self.email_user = email_user
+        self.account = email_user
+        self.email_pass = email_pass
+        self.mailbox = mailbox
+        self.server = {'host': host, 'port': port, 'use_ssl': use_ssl}
+        self.fetch_workers = max(1, connections)
+        self.mail = None
+        self.pool = None
+        self.listed = False
+
+    def open(self):
+        self.mail, self.uidvalidity = connect(self.email_user, self.email_pass, self.mailbox, **self.server)
+        self.pool = ConnectionPool(self.email_user, self.email_pass, self.fetch_workers, self.mailbox, **self.server)
+
+    def close(self):
+        if self.listed:
+            save_checkpoint(self.email_user, self.uidvalidity, self.mailbox)
+        if self.pool is not None:
+            self.pool.close()
+        if self.mail is not None:
+            try:
+                self.mail.logout()
+            except (imaplib.IMAP4.error, OSError):
+                pass
+
+    def list_pages(self, scan_limit, safe_list):
+        email_ids = search_uids(self.mail)
+        if email_ids is None:
+            print("Mailbox search failed")
+            return
+        self.high_water = int(email_ids[-1]) if email_ids else 0
+        scope = limit_ids(email_ids, scan_limit)
+        candidates = search_candidate_uids(self.mail, scope, safe_list)
+        prune_cache(self.email_user, self.uidvalidity, scope, self.mailbox)
+        self.listed = True
+        yield from self._pages(candidates)
+
+    def list_newer(self, high_water, safe_list):
+        # "n:*" always matches the highest UID, even when it is below n
+        email_ids = search_uids(self.mail, f"UID {high_water + 1}:*")
+        if email_ids is None:
+            print("Mailbox search failed")
+            return
+        newer = [uid for uid in email_ids if int(uid) > high_water]
+        yield from self._pages(search_candidate_uids(self.mail, newer, safe_list), newer=True)
+
+    def fetch(self, uids):
+        cache = get_cache()
+        infos = cache.get_infos(self.email_user, self.mailbox, uids)
+        missing = [uid for uid in uids if uid not in infos]
+        if missing:
+            fetched = self._fetch_missing(missing)
+            cache.put_many(self.email_user, self.mailbox, fetched)
+            infos.update(fetched)
+        return {uid: info for uid, info in infos.items() if info.sender}
+
+    def _fetch_missing(self, uids):
+        # A shard whose connection drops is retried once on a fresh connection
+        for attempt in range(2):
+            try:
+                with self.pool.connection() as mail:
+                    return dict(fetch_message_infos(mail, uids))
+            except (imaplib.IMAP4.abort, OSError) as e:
+                if attempt:
+                    raise
+                RECONNECTS.inc(backend=self.name)
+                print(f"Shard connection lost ({e}), retrying on a new connection")
+
+    def trash(self, uids):
+        moved = move_to_trash(self.mail, uids)
+        get_cache().invalidate(self.email_user, self.mailbox, moved)
+        return len(moved)
+
+    def message_keys(self, uids):
+        # Only Gmail lists one message in several folders, under one X-GM-MSGID
+        if "X-GM-EXT-1" not in self.mail.capabilities:
+            return None
+        return fetch_message_keys(self.mail, uids) if uids else {}
+
+
+def imap_backend(email_user, email_pass, connections=IMAP_CONNECTIONS, folders=None, **server):
+    """The backend for sweeping folders (default IMAP_FOLDERS) of a mailbox: an ImapBackend, or a MultiFolderBackend.
+
+    With several folders, each gets its own main connection and an equal
+    share of the fetch connections, at least one.
+    """
+    folders = list(dict.fromkeys(folders or IMAP_FOLDERS))
+    if len(folders) == 1:
+        return ImapBackend(email_user, email_pass, connections, folders[0], **server)
+    share = folder_connections(connections, len(folders))
+    return MultiFolderBackend({folder: ImapBackend(email_user, email_pass, share, folder, **server)
+                               for folder in folders})
+
+
+def folder_connections(connections, folder_count):
+    """Fetch connections each of folder_count folders gets out of connections."""
+    return max(1, connections // folder_count)
+
+
+def fetch_unapproved_senders(email_user, email_pass, safe_list, scan_limit='100', connections=IMAP_CONNECTIONS,
+                             folders=None):
+    """Return a SenderIndex of the unapproved mail in scope, publishing each sender as it is found."""
+    print("Fetching unapproved senders...")
+    return pipeline.scan(imap_backend(email_user, email_pass, connections, folders), safe_list, scan_limit)
+
+
+def delete_indexed_emails(email_user, email_pass, uids, uidvalidity, folders=None):
+    """Move uids indexed by an earlier scan to the trash without scanning again.
+
+    Raises ValueError if the mailbox's UIDVALIDITY changed since the scan, as
+    the uids may then name different messages.
+    """
+    return pipeline.delete_ids(imap_backend(email_user, email_pass, folders=folders), uids, uidvalidity)
+
+
+def execute_deletion_plan(email_user, email_pass, plan_id, safe_list, connections=IMAP_CONNECTIONS, folders=None):
+    """Move the mail a dry run planned to delete to the trash, plus unapproved mail that arrived since.
+
+    Raises ValueError if the plan has expired or the mailbox's UIDVALIDITY
+    changed since the dry run.
+    """
+    store = get_plan_store()
+    plan = store.get(plan_id)
+    if plan is None:
+        raise ValueError("The dry run has expired; run it again before deleting")
+    deleted_count = pipeline.execute_plan(imap_backend(email_user, email_pass, connections, folders), plan, safe_list)
+    store.discard(plan_id)
+    return deleted_count
+
+
+def delete_unapproved_emails_dry_run(email_user, email_pass, safe_list, scan_limit='500', connections=IMAP_CONNECTIONS,
+                                     folders=None):
+    """Work out what delete_unapproved_emails() would remove and return it as a saved DeletionPlan."""
+    return pipeline.dry_run(imap_backend(email_user, email_pass, connections, folders), safe_list, scan_limit)
+
+def delete_unapproved_emails(email_user, email_pass, safe_list, scan_limit='500', connections=IMAP_CONNECTIONS,
+                             folders=None):
+    return pipeline.delete(imap_backend(email_user, email_pass, connections, folders), safe_list, scan_limit)
@@ -1,9 +1,19 @@
-﻿from flask import Flask, render_template, request, redirect, url_for, session, jsonify
-from gmail_utils import fetch_unapproved_senders,load_safe_list,save_safe_list, delete_unapproved_emails, delete_unapproved_emails_dry_run, setup_gmail_api
+﻿from flask import Flask, render_template, request, redirect, url_for, session, jsonify, abort
+from deletion_plan import DeletionPlan, get_plan_store
+from gmail_utils import fetch_unapproved_senders, delete_unapproved_emails, delete_unapproved_emails_dry_run, delete_indexed_emails, execute_deletion_plan, setup_gmail_api
+from job_routes import jobs_blueprint
+from jobs import get_runner, JobQueueFull, DONE
+from metrics_routes import metrics_blueprint
+from safe_list_store import get_safe_list_store
+from scan_routes import scans_blueprint
+from scan_store import find_scan, run_scan, PAGE_SIZE
 import os
 
 app = Flask(__name__)
 app.secret_key = os.urandom(24)
+app.register_blueprint(jobs_blueprint)
+app.register_blueprint(scans_blueprint)
+app.register_blueprint(metrics_blueprint)
 
 
 @app.route('/')
@@ -22,28 +32,29 @@ def setup():
 def scan_emails():
     """Scan emails and find unapproved senders."""
     try:
-        # Load existing safe list
-        stored_safe = load_safe_list()
-
-        # Get user-provided safe list
-        user_safe = request.form.get('safe_list', '').splitlines()
-        user_safe = [email.strip() for email in user_safe if email.strip()]
-
-        # Merge safe lists
-        merged_safe = list(set(stored_safe + user_safe))
-        session['safe_list'] = merged_safe
-        save_safe_list(merged_safe)
+        # Merge the user-provided safe list into the stored one
+        store = get_safe_list_store()
+        store.add(request.form.get('safe_list', '').splitlines())
+        merged_safe = store.snapshot()
 
         # Get scan limit
         scan_limit = request.form.get('scan_limit', '500')
         session['scan_limit'] = scan_limit
+        incremental = request.form.get('incremental') == 'on'
+        session['incremental'] = incremental
 
-        # Fetch unapproved senders using Gmail API
-        unapproved = fetch_unapproved_senders(merged_safe, scan_limit)
-        session['unapproved'] = unapproved
+        # Fetch unapproved senders using Gmail API, in the background
+        job = get_runner().submit('scan', run_scan, fetch_unapproved_senders, merged_safe, scan_limit, incremental)
+        session['scan_id'] = job.id
+        session.pop('plan_id', None)
 
+        # The preview page fills in as senders are found
         return redirect(url_for('preview'))
 
+    except JobQueueFull as e:
+        return render_template('error.html',
+                               error="Too many jobs running",
+                               message=str(e)), 503
     except FileNotFoundError as e:
         return render_template('error.html',
                                error="Gmail API not set up",
@@ -56,10 +67,13 @@ def scan_emails():
 
 @app.route('/preview', methods=['GET', 'POST'])
 def preview():
-    """Preview unapproved senders and allow safe list updates."""
+    """Preview unapproved senders and allow safe list updates.
+
+    A finished scan's senders stay on the server; the page loads them a page
+    at a time from the scans blueprint.
+    """
     # Load values
-    stored_safe = load_safe_list()
-    unapproved_senders = session.get('unapproved', [])
+    store = get_safe_list_store()
     scan_limit = session.get('scan_limit', '500')
 
     # Handle new safe-list additions from the preview page
@@ -67,48 +81,64 @@ def preview():
         newly_added_safe = request.form.getlist('keep')
 
         if newly_added_safe:
-            # Add to stored safe list
-            stored_safe.extend(newly_added_safe)
-            stored_safe = list(set(stored_safe))  # Remove duplicates
-            save_safe_list(stored_safe)
-
-            # Filter out newly safe senders from unapproved list
-            original_count = len(unapproved_senders)
-
-            unapproved_senders = [
-                sender for sender in unapproved_senders
-                if not any(safe.lower() in sender.lower() for safe in newly_added_safe)
-            ]
-
-            session['unapproved'] = unapproved_senders
-
-            print(f"Filtered unapproved list: {original_count} -> {len(unapproved_senders)} senders")
+            # Scan results are filtered against the stored safe list as it changes
+            store.add(newly_added_safe)
             print(f"Newly added safe senders: {newly_added_safe}")
 
+    stored_safe = store.snapshot()
+    result, scan = find_scan(session.get('scan_id'), stored_safe)
+    if result is not None:
+        found = result.count(stored_safe)
+    else:
+        found = len(scan['found']) if scan else 0
+
     return render_template(
         "gmail_preview.html",
-        unapproved=unapproved_senders,
+        result=result,
+        found=found,
+        indexed=result is not None and result.index is not None,
+        page_size=PAGE_SIZE,
         safe_list=stored_safe,
-        scan_limit=scan_limit
+        scan_limit=scan_limit,
+        scan=scan
     )
 
 
+def scan_index(safe_list):
+    """This session's scan index without senders the safe list now matches, or None if there is none.
+
+    Cancelled and failed scans have no index, so deleting falls back to
+    scanning again.
+    """
+    result, _ = find_scan(session.get('scan_id'), safe_list)
+    return result.view(safe_list) if result is not None else None
+
+
 @app.route('/delete_emails', methods=['POST'])
 def delete_emails():
     """Delete emails from unapproved senders."""
     try:
         scan_limit = session.get('scan_limit', '500')
-        safe_list = load_safe_list()  # Pull fresh from file
-
-        deleted_count = delete_unapproved_emails(safe_list, scan_limit)
-
-        session.clear()
-
-        return render_template('result.html',
-                               action="Deleted",
-                               count=deleted_count,
-                               dry_run=False)
-
+        incremental = session.get('incremental', False)
+        safe_list = get_safe_list_store().snapshot()  # Current version, cached until it changes
+        index = scan_index(safe_list)
+        plan_id = session.pop('plan_id', None)
+
+        if plan_id is not None:
+            # Act on what the dry run reported, checking only mail that arrived since
+            job = get_runner().submit('delete', execute_deletion_plan, plan_id, safe_list)
+        elif index is not None:
+            # Delete exactly what the preview showed, without scanning again
+            job = get_runner().submit('delete', delete_indexed_emails, index.message_ids())
+        else:
+            job = get_runner().submit('delete', delete_unapproved_emails, safe_list, scan_limit, incremental)
+
+        return redirect(url_for('jobs.job_progress', job_id=job.id))
+
+    except JobQueueFull as e:
+        return render_template('error.html',
+                               error="Too many jobs running",
+                               message=str(e)), 503
     except Exception as e:
         return render_template('error.html',
                                error="Deletion failed",
@@ -120,21 +150,61 @@ def delete_emails_dry_run():
     """Dry run - count emails that would be deleted."""
     try:
         scan_limit = session.get('scan_limit', '500')
-        safe_list = load_safe_list()  # Pull fresh from file
+        incremental = session.get('incremental', False)
+        safe_list = get_safe_list_store().snapshot()  # Current version, cached until it changes
+        index = scan_index(safe_list)
 
-        would_delete_count = delete_unapproved_emails_dry_run(safe_list, scan_limit)
+        if index is not None:
+            plan = get_plan_store().save(DeletionPlan.from_index(index, safe_list.digest))
+            session['plan_id'] = plan.id
+            return render_template('result.html',
+                                   action="Would delete",
+                                   count=len(plan),
+                                   dry_run=True)
 
-        return render_template('result.html',
-                               action="Would delete",
-                               count=would_delete_count,
-                               dry_run=True)
+        job = get_runner().submit('dry run', delete_unapproved_emails_dry_run, safe_list, scan_limit, incremental)
 
+        return redirect(url_for('jobs.job_progress', job_id=job.id))
+
+    except JobQueueFull as e:
+        return render_template('error.html',
+                               error="Too many jobs running",
+                               message=str(e)), 503
     except Exception as e:
         return render_template('error.html',
                                error="Dry run failed",
                                message=str(e))
 
 
+@app.route('/jobs/<job_id>/result')
+def job_result(job_id):
+    """Hand a finished job's result to the page that shows it."""
+    job = get_runner().get(job_id)
+    if job is None:
+        abort(404)
+    if job.status != DONE:
+        return redirect(url_for('jobs.job_progress', job_id=job_id))
+
+    if job.kind == 'scan':
+        session['scan_id'] = job_id
+        return redirect(url_for('preview'))
+
+    if job.kind == 'delete':
+        session.clear()
+        return render_template('result.html',
+                               action="Deleted",
+                               count=job.result,
+                               dry_run=False)
+
+    plan = job.result
+    if plan is not None:
+        session['plan_id'] = plan.id
+    return render_template('result.html',
+                           action="Would delete",
+                           count=len(plan) if plan is not None else 0,
+                           dry_run=True)
+
+
 @app.route('/api/check_setup')
 def check_setup():
     """API endpoint to check if Gmail API is set up."""
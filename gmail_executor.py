@@ -0,0 +1,206 @@
+﻿import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from googleapiclient.errors import HttpError
+
+from metrics import RETRIES
+
+# Gmail API cost per call, in quota units
+QUOTA_UNITS = {
+    'getProfile': 1,
+    'history.list': 2,
+    'messages.list': 5,
+    'messages.get': 5,
+    'messages.delete': 10,
+    'messages.batchDelete': 50,
+}
+USER_QUOTA_PER_SECOND = 250  # Per-user limit: 15,000 units per minute
+MAX_WORKERS = 8
+MAX_RETRIES = 5
+BASE_BACKOFF = 1.0  # Seconds; doubles with each consecutive throttle
+MAX_BACKOFF = 32.0
+THROTTLE_STATUSES = {429}
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+RATE_LIMIT_REASONS = ('rateLimitExceeded', 'userRateLimitExceeded')
+
+
+def error_status(error):
+    status = getattr(getattr(error, 'resp', None), 'status', None)
+    return int(status) if status is not None else None
+
+
+def is_throttled(error):
+    """True for 429s and for the 403s Gmail uses to report a rate limit."""
+    status = error_status(error)
+    if status in THROTTLE_STATUSES:
+        return True
+    return status == 403 and any(reason in str(error) for reason in RATE_LIMIT_REASONS)
+
+
+def is_retryable(error):
+    return is_throttled(error) or error_status(error) in RETRYABLE_STATUSES
+
+
+class TokenBucket:
+    """Token bucket refilled at `rate` units per second, holding at most `capacity`.
+
+    A request larger than the capacity waits for a full bucket and then runs
+    the balance negative, so later callers wait it off and the average rate
+    still holds.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, units):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                needed = min(units, self.capacity)
+                if self._tokens >= needed:
+                    self._tokens -= units
+                    return
+                wait = (needed - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class AdaptiveLimiter:
+    """Concurrency limit that halves on throttling and grows back one slot per clean round.
+
+    A throttle also pauses every caller for an exponentially growing, jittered
+    backoff, so the workers do not keep hammering the quota together.
+    """
+
+    def __init__(self, max_concurrency):
+        self.max_concurrency = max_concurrency
+        self.limit = max_concurrency
+        self._active = 0
+        self._successes = 0
+        self._throttles = 0  # Consecutive throttles, drives the backoff
+        self._resume_at = 0.0
+        self._condition = threading.Condition()
+
+    @contextmanager
+    def slot(self):
+        with self._condition:
+            while True:
+                wait = self._resume_at - time.monotonic()
+                if wait > 0:
+                    self._condition.wait(wait)
+                elif self._active >= self.limit:
+                    self._condition.wait()
+                else:
+                    break
+            self._active += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._active -= 1
+                self._condition.notify_all()
+
+    def succeeded(self):
+        with self._condition:
+            self._throttles = 0
+            self._successes += 1
+            if self._successes >= self.limit and self.limit < self.max_concurrency:
+                self.limit += 1
+                self._successes = 0
+                self._condition.notify_all()
+
+    def throttled(self):
+        """Record a throttle and return the backoff applied."""
+        with self._condition:
+            self.limit = max(1, self.limit // 2)
+            self._successes = 0
+            delay = min(MAX_BACKOFF, BASE_BACKOFF * 2 ** self._throttles)
+            delay = delay / 2 + random.uniform(0, delay / 2)
+            self._throttles += 1
+            self._resume_at = max(self._resume_at, time.monotonic() + delay)
+            return delay
+
+
+class GmailExecutor:
+    """Runs Gmail API calls concurrently within the per-user quota.
+
+    Each worker thread builds its own service object through service_factory,
+    since the API client is not thread-safe. Every call first takes its quota
+    units from a token bucket and a slot from the adaptive limiter; throttled
+    and transient failures are retried with backoff. shared_bucket, if given,
+    is a second TokenBucket that several accounts' executors draw on, e.g.
+    for a quota that covers every account of one project.
+    """
+
+    def __init__(self, service_factory, max_workers=MAX_WORKERS, units_per_second=USER_QUOTA_PER_SECOND,
+                 shared_bucket=None):
+        self.service_factory = service_factory
+        self.bucket = TokenBucket(units_per_second)
+        self.shared_bucket = shared_bucket
+        self.limiter = AdaptiveLimiter(max_workers)
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='gmail')
+        self._local = threading.local()
+
+    def service(self):
+        """This thread's service object."""
+        if getattr(self._local, 'service', None) is None:
+            self._local.service = self.service_factory()
+        return self._local.service
+
+    def call(self, method, work, calls=1):
+        """Run work(service) on the current thread under the quota, retrying throttled and transient errors.
+
+        `calls` is the number of API calls work makes, e.g. the size of a batch.
+        """
+        return self._run(method, lambda: work(self.service()), calls)
+
+    def execute(self, method, request):
+        """Execute a request built by the calling thread's own service, under the quota."""
+        return self._run(method, request.execute)
+
+    def _run(self, method, fn, calls=1):
+        units = QUOTA_UNITS[method] * calls
+        for attempt in range(MAX_RETRIES + 1):
+            with self.limiter.slot():
+                self.bucket.acquire(units)
+                if self.shared_bucket is not None:
+                    self.shared_bucket.acquire(units)
+                try:
+                    result = fn()
+                except HttpError as error:
+                    if not is_retryable(error) or attempt == MAX_RETRIES:
+                        raise
+                    status = error_status(error)
+                    delay = self.limiter.throttled() if is_throttled(error) else None
+                else:
+                    self.limiter.succeeded()
+                    return result
+            RETRIES.inc(backend='gmail', reason=f'{method} {status}')
+            print(f'{method} failed ({status}), retrying (attempt {attempt + 1} of {MAX_RETRIES})')
+            if delay is None:
+                # Transient server error: back off this call only
+                time.sleep(BASE_BACKOFF * 2 ** attempt * random.uniform(0.5, 1))
+
+    def submit(self, method, work, calls=1):
+        """Run work(service) on a worker thread with that thread's service; returns a Future."""
+        return self._pool.submit(self.call, method, work, calls)
+
+    def map(self, method, work, items, calls=len):
+        """Run work(service, item) for every item concurrently and return the results in order.
+
+        calls(item) gives the number of API calls each item makes.
+        """
+        futures = [self.submit(method, lambda service, item=item: work(service, item), calls(item))
+                   for item in items]
+        return [future.result() for future in futures]
+
+    def shutdown(self):
+        self._pool.shutdown(wait=True)
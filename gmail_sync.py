@@ -0,0 +1,197 @@
+﻿import sqlite3
+import threading
+
+from googleapiclient.errors import HttpError
+
+import gmail_utils
+from sender_index import MessageInfo
+from sender_parser import PARSER_VERSION
+
+SYNC_FILE = "gmail_sync.db"
+HIDDEN_LABELS = {'SPAM', 'TRASH'}  # messages.list leaves these out by default
+
+
+class SyncStore:
+    """Local replica of each account's mailbox: message id -> MessageInfo, plus the historyId it is current to."""
+
+    def __init__(self, path=SYNC_FILE):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS sync_state (account TEXT PRIMARY KEY, history_id TEXT NOT NULL)"
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS messages ("
+                " account TEXT NOT NULL,"
+                " id TEXT NOT NULL,"
+                " sender TEXT,"
+                " size INTEGER,"
+                " date REAL,"
+                " PRIMARY KEY (account, id))"
+            )
+            columns = {row[1] for row in self._conn.execute("PRAGMA table_info(messages)")}
+            if "size" not in columns:
+                # Replica written before sizes and dates were kept: resync it in full
+                self._conn.execute("ALTER TABLE messages ADD COLUMN size INTEGER")
+                self._conn.execute("ALTER TABLE messages ADD COLUMN date REAL")
+                self._conn.execute("DELETE FROM sync_state")
+            if self._conn.execute("PRAGMA user_version").fetchone()[0] != PARSER_VERSION:
+                # Senders parsed by another version of sender_parser: resync in full
+                self._conn.execute("DELETE FROM messages")
+                self._conn.execute("DELETE FROM sync_state")
+                self._conn.execute(f"PRAGMA user_version = {PARSER_VERSION}")
+
+    def history_id(self, account):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT history_id FROM sync_state WHERE account = ?", (account,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def infos(self, account):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, sender, size, date FROM messages WHERE account = ?", (account,)
+            ).fetchall()
+        return {row[0]: MessageInfo(*row[1:]) for row in rows}
+
+    def replace(self, account, infos, history_id):
+        """Overwrite the replica after a full resync."""
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM messages WHERE account = ?", (account,))
+            self._write(account, infos, (), history_id)
+
+    def apply(self, account, added, removed, history_id=None):
+        """Apply a delta: added is {id: MessageInfo}, removed an iterable of ids."""
+        with self._lock, self._conn:
+            self._write(account, added, removed, history_id)
+
+    def _write(self, account, added, removed, history_id):
+        self._conn.executemany(
+            "DELETE FROM messages WHERE account = ? AND id = ?", [(account, message_id) for message_id in removed]
+        )
+        self._conn.executemany(
+            "INSERT OR REPLACE INTO messages (account, id, sender, size, date) VALUES (?, ?, ?, ?, ?)",
+            [(account, message_id) + tuple(info) for message_id, info in added.items()],
+        )
+        if history_id is not None:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO sync_state (account, history_id) VALUES (?, ?)", (account, str(history_id))
+            )
+
+    def reset(self, account):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM messages WHERE account = ?", (account,))
+            self._conn.execute("DELETE FROM sync_state WHERE account = ?", (account,))
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = SyncStore()
+        return _store
+
+
+def history_changes(service, start_history_id, executor=None, label_id=None):
+    """Return (added ids, removed ids, latest historyId) since start_history_id.
+
+    With label_id, only messages under that label count as present, and only
+    changes to them are listed. Raises HttpError 404 when start_history_id is
+    too old for the API to answer, which callers treat as a signal to resync
+    from scratch.
+    """
+    executor = executor or gmail_utils.get_executor()
+
+    def visible(message):
+        labels = set(message.get('labelIds', []))
+        return label_id in labels if label_id else not HIDDEN_LABELS & labels
+
+    present = {}  # id -> visible to messages.list after the last event seen
+    latest = start_history_id
+    page_token = None
+    label_args = {'labelId': label_id} if label_id else {}
+    while True:
+        results = executor.execute('history.list', service.users().history().list(
+            userId='me',
+            startHistoryId=start_history_id,
+            historyTypes=['messageAdded', 'messageDeleted', 'labelAdded', 'labelRemoved'],
+            pageToken=page_token,
+            **label_args
+        ))
+
+        for record in results.get('history', []):
+            for change in record.get('messagesAdded', []):
+                message = change['message']
+                present[message['id']] = visible(message)
+            for change in record.get('messagesDeleted', []):
+                present[change['message']['id']] = False
+            for change in record.get('labelsAdded', []) + record.get('labelsRemoved', []):
+                message = change['message']
+                present[message['id']] = visible(message)
+
+        latest = results.get('historyId', latest)
+        page_token = results.get('nextPageToken')
+        if not page_token:
+            break
+
+    added = {message_id for message_id, visible in present.items() if visible}
+    removed = {message_id for message_id, visible in present.items() if not visible}
+    return added, removed, latest
+
+
+def full_resync(service, account, store, executor=None):
+    """Rebuild the replica from a complete listing of the mailbox."""
+    executor = executor or gmail_utils.get_executor()
+    # Take the historyId first so changes made while listing show up in the next delta
+    profile = executor.execute('getProfile', service.users().getProfile(userId='me'))
+    history_id = profile['historyId']
+    infos = {}
+    for page in gmail_utils.list_message_pages(service, 'all', executor):
+        infos.update(gmail_utils.get_message_infos(account, [msg['id'] for msg in page], executor))
+    store.replace(account, infos, history_id)
+    print(f"Full sync of {account}: {len(infos)} messages at historyId {history_id}")
+    return infos
+
+
+def sync_mailbox(service, account, store=None, executor=None):
+    """Bring the replica for account up to date and return {message_id: MessageInfo} for the whole mailbox.
+
+    Only messages added since the stored historyId are fetched. Without a
+    stored historyId, or once it has expired, the mailbox is resynced in full.
+    API calls go through executor, by default gmail_utils.get_executor().
+    """
+    store = store or get_store()
+    start_history_id = store.history_id(account)
+    if start_history_id is None:
+        return full_resync(service, account, store, executor)
+
+    try:
+        added, removed, latest = history_changes(service, start_history_id, executor)
+    except HttpError as error:
+        if getattr(error.resp, 'status', None) == 404:
+            print(f"historyId {start_history_id} expired for {account}, resyncing")
+            return full_resync(service, account, store, executor)
+        raise
+
+    new_infos = gmail_utils.get_message_infos(account, sorted(added), executor)
+    store.apply(account, new_infos, removed, latest)
+    print(f"Incremental sync of {account}: +{len(new_infos)} -{len(removed)} messages, historyId {latest}")
+    return store.infos(account)
+
+
+def newest_ids(messages, scan_limit):
+    """Return the newest scan_limit message ids (all for 'all'), newest first.
+
+    Gmail message ids increase with the time a message reached the mailbox,
+    so sorting them numerically approximates messages.list order.
+    """
+    ids = sorted(messages, key=lambda message_id: int(message_id, 16), reverse=True)
+    return ids if scan_limit == 'all' else ids[:int(scan_limit)]
@@ -1,55 +1,53 @@
 ﻿import os
 import json
 import base64
-import re
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
-from email.header import decode_header
 import pickle
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
+from deletion_plan import get_plan_store
+from gmail_executor import GmailExecutor
+from header_cache import get_cache
+from jobs import report_progress, in_current_job
+from mail_backend import MailBackend
+from metrics import RETRIES, debug
+from search_query import split_safe_list, compile_gmail_queries
+from sender_parser import parse_sender
+from sender_index import MessageInfo
+import pipeline
 
 # Gmail API scopes - we need modify scope to delete emails
 SCOPES = ['https://www.googleapis.com/auth/gmail.modify']
-SAFE_LIST_FILE = "safe_list.json"
 TOKEN_FILE = "token.pickle"
 CREDENTIALS_FILE = "credentials.json"
+CACHE_MAILBOX = "gmail-api"  # Message ids are unique per account, not per label
+BATCH_SIZE = 100  # Gmail API allows up to 100 calls per batch request
+LIST_PAGE_SIZE = 500  # Largest page messages.list will return
+PREFETCH_PAGES = 2  # Listed pages buffered ahead of header fetching
+BATCH_RETRIES = 4
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+DELETE_BATCH_SIZE = 1000  # Gmail API allows up to 1000 messages per batch delete
+# Comma-separated label ids to sweep, e.g. "INBOX,SPAM,CATEGORY_PROMOTIONS"; unset sweeps what messages.list lists
+GMAIL_LABELS = [label.strip() for label in os.environ.get("GMAIL_LABELS", "").split(",") if label.strip()]
+SERVICE_FACTORY = None  # When set, called with the token file instead of the OAuth flow (e.g. a fake for benchmarks)
+
+
+def authenticate_gmail(token_file=TOKEN_FILE):
+    """Authenticate and return Gmail service object for the account whose OAuth token is kept in token_file."""
+    if SERVICE_FACTORY is not None:
+        return SERVICE_FACTORY(token_file)
 
-
-def load_safe_list():
-    """Load the safe list from JSON file."""
-    if not os.path.exists(SAFE_LIST_FILE):
-        with open(SAFE_LIST_FILE, "w") as f:
-            json.dump([], f)
-        return []
-
-    try:
-        with open(SAFE_LIST_FILE, "r") as f:
-            data = f.read().strip()
-            if not data:
-                return []
-            return json.loads(data)
-    except (json.JSONDecodeError, IOError) as e:
-        print(f"Warning: Failed to load safe list: {e}")
-        return []
-
-
-def save_safe_list(safe_list):
-    """Save the safe list to JSON file."""
-    with open(SAFE_LIST_FILE, "w") as f:
-        json.dump(sorted(list(set(safe_list))), f, indent=2)
-
-
-def authenticate_gmail():
-    """Authenticate and return Gmail service object."""
     creds = None
 
     # Load existing token
-    if os.path.exists(TOKEN_FILE):
-        with open(TOKEN_FILE, 'rb') as token:
+    if os.path.exists(token_file):
+        with open(token_file, 'rb') as token:
             creds = pickle.load(token)
 
     # If there are no (valid) credentials available, let the user log in
@@ -68,7 +66,7 @@ def authenticate_gmail():
             creds = flow.run_local_server(port=0)
 
         # Save the credentials for the next run
-        with open(TOKEN_FILE, 'wb') as token:
+        with open(token_file, 'wb') as token:
             pickle.dump(creds, token)
 
     try:
@@ -79,40 +77,6 @@ def authenticate_gmail():
         return None
 
 
-def extract_email_from_header(header_value):
-    """Extract email address from header value."""
-    if not header_value:
-        return None
-
-    # Handle encoded headers
-    try:
-        decoded_parts = decode_header(header_value)
-        decoded_header = ""
-        for part in decoded_parts:
-            if isinstance(part[0], bytes):
-                decoded_header += part[0].decode(part[1] or 'utf-8', errors='ignore')
-            else:
-                decoded_header += part[0]
-        header_value = decoded_header
-    except:
-        pass
-
-    # Extract email from various formats
-    email_pattern = r'([a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,})'
-
-    # Try to find email in angle brackets first
-    bracket_match = re.search(r'<([^>]+)>', header_value)
-    if bracket_match:
-        return bracket_match.group(1).strip()
-
-    # Fall back to general email pattern
-    email_match = re.search(email_pattern, header_value)
-    if email_match:
-        return email_match.group(1).strip()
-
-    return None
-
-
 def get_message_headers(service, message_id):
     """Get message headers including From field."""
     try:
@@ -123,198 +87,423 @@ def get_message_headers(service, message_id):
             metadataHeaders=['From']
         ).execute()
 
-        headers = message.get('payload', {}).get('headers', [])
-        from_header = None
-
-        for header in headers:
-            if header['name'].lower() == 'from':
-                from_header = header['value']
-                break
-
-        return extract_email_from_header(from_header)
+        return sender_from_message(message)
     except HttpError as error:
         print(f'Error getting message headers: {error}')
         return None
 
 
-def fetch_unapproved_senders(safe_list, scan_limit=500):
-    """Fetch unapproved senders using Gmail API."""
-    service = authenticate_gmail()
-    if not service:
-        return []
+def sender_from_message(message):
+    """Extract the sender address from a metadata-format message resource."""
+    headers = message.get('payload', {}).get('headers', [])
+    from_header = None
 
-    unapproved_senders = set()
+    for header in headers:
+        if header['name'].lower() == 'from':
+            from_header = header['value']
+            break
 
-    try:
-        print("Fetching unapproved senders using Gmail API...")
+    return parse_sender(from_header)
 
-        # Get list of messages
-        if scan_limit == 'all':
-            max_results = None
-        else:
-            max_results = min(int(scan_limit), 500)  # Gmail API limits to 500 per request
 
-        results = service.users().messages().list(
-            userId='me',
-            maxResults=max_results
-        ).execute()
+def info_from_message(message):
+    """MessageInfo for a metadata-format message resource; the date is its internalDate."""
+    internal_date = message.get('internalDate')
+    return MessageInfo(
+        sender_from_message(message),
+        message.get('sizeEstimate'),
+        int(internal_date) / 1000 if internal_date is not None else None
+    )
 
-        messages = results.get('messages', [])
-        print(f"Found {len(messages)} messages to process")
 
-        # Process messages in batches for efficiency
-        batch_size = 100
-        for i in range(0, len(messages), batch_size):
-            batch = messages[i:i + batch_size]
-            print(f"Processing batch {i // batch_size + 1}/{(len(messages) + batch_size - 1) // batch_size}")
+def get_message_headers_batch(message_ids, executor=None):
+    """Get {message_id: MessageInfo} for many messages, up to BATCH_SIZE metadata gets per HTTP request.
 
-            for msg in batch:
-                sender_email = get_message_headers(service, msg['id'])
+    Batches run concurrently on the shared executor. Items that fail with a
+    retryable status (rate limits, server errors) slow the executor down and
+    are retried in a later round; other failures are logged and left out of
+    the result.
+    """
+    executor = executor or get_executor()
+    senders = {}
+    pending = list(message_ids)
 
-                if sender_email:
-                    # Check if sender is in safe list
-                    is_safe = any(safe.lower() in sender_email.lower() for safe in safe_list)
-
-                    if not is_safe:
-                        unapproved_senders.add(sender_email)
-                        print(f"Found unapproved sender: {sender_email}")
-
-        print(f"Total unapproved senders: {len(unapproved_senders)}")
-        return list(unapproved_senders)
+    def fetch_chunk(service, chunk):
+        fetched, failed = {}, []
 
+        def callback(request_id, response, exception):
+            if exception is None:
+                fetched[request_id] = info_from_message(response)
+                return
+            status = getattr(getattr(exception, 'resp', None), 'status', None)
+            if status is not None and int(status) in RETRYABLE_STATUSES:
+                failed.append(request_id)
+            else:
+                print(f'Error getting message headers for {request_id}: {exception}')
+
+        batch = service.new_batch_http_request(callback=callback)
+        for message_id in chunk:
+            batch.add(
+                service.users().messages().get(
+                    userId='me',
+                    id=message_id,
+                    format='metadata',
+                    metadataHeaders=['From']
+                ),
+                request_id=message_id
+            )
+        batch.execute()
+        return fetched, failed
+
+    for attempt in range(BATCH_RETRIES + 1):
+        chunks = [pending[i:i + BATCH_SIZE] for i in range(0, len(pending), BATCH_SIZE)]
+        futures = [executor.submit('messages.get', lambda service, chunk=chunk: fetch_chunk(service, chunk), len(chunk))
+                   for chunk in chunks]
+        failed = []
+        for chunk, future in zip(chunks, futures):
+            try:
+                fetched, chunk_failed = future.result()
+            except HttpError as error:
+                # The executor already retried the whole batch; leave it out
+                print(f'Batch request failed: {error}')
+                continue
+            senders.update(fetched)
+            failed.extend(chunk_failed)
+
+        if not failed:
+            break
+        if attempt == BATCH_RETRIES:
+            print(f'Giving up on {len(failed)} messages after {BATCH_RETRIES} retries')
+            break
+        delay = executor.limiter.throttled()
+        RETRIES.inc(len(failed), backend='gmail', reason='batch item')
+        print(f'Retrying {len(failed)} throttled or failed messages in {delay:.1f}s')
+        pending = failed
+
+    return senders
+
+
+def list_message_pages(service, scan_limit, executor=None, **list_args):
+    """Yield pages of message stubs from messages.list, following nextPageToken until scan_limit is reached."""
+    executor = executor or get_executor()
+    limit = None if scan_limit == 'all' else int(scan_limit)
+    listed = 0
+    page_token = None
+    while limit is None or listed < limit:
+        page_size = LIST_PAGE_SIZE if limit is None else min(LIST_PAGE_SIZE, limit - listed)
+        results = executor.execute('messages.list', service.users().messages().list(
+            userId='me',
+            maxResults=page_size,
+            pageToken=page_token,
+            **list_args
+        ))
+        messages = results.get('messages', [])
+        if messages:
+            listed += len(messages)
+            yield messages
+        page_token = results.get('nextPageToken')
+        if not page_token:
+            break
+
+
+def iter_message_pages(scan_limit, prefetch=PREFETCH_PAGES, executor=None, **list_args):
+    """Stream pages of message stubs, listing ahead on a background thread (see pipeline.threaded).
+
+    The lister has its own service object because the API client is not
+    thread-safe. At most `prefetch` pages are buffered, so memory stays bounded
+    however large the mailbox is. Listing errors are re-raised in the caller.
+    """
+    executor = executor or get_executor()
+
+    def pages():
+        service = executor.service_factory()  # Made on the listing thread, which uses it
+        yield from list_message_pages(service, scan_limit, executor, **list_args)
+
+    return pipeline.threaded(pages(), queue_size=prefetch)
+
+
+def list_candidate_ids(service, scan_limit, queries, executor=None, **list_args):
+    """Return the ids in scope that every query lists, newest first.
+
+    A limited scope is listed without a query first; the candidate listings
+    are then bounded with after: at the oldest message in scope, so they do
+    not walk the whole mailbox. list_args (e.g. labelIds) go to every listing.
+    """
+    executor = executor or get_executor()
+    scope, bound = None, ""
+    if scan_limit != 'all':
+        scope = [msg['id'] for page in list_message_pages(service, scan_limit, executor, **list_args) for msg in page]
+        if not scope:
+            return []
+        oldest = executor.execute('messages.get', service.users().messages().get(
+            userId='me',
+            id=scope[-1],
+            format='minimal'
+        ))
+        bound = f" after:{int(oldest['internalDate']) // 1000 - 1}"
+
+    order, candidates = None, None
+    for query in queries:
+        listed = [msg['id'] for page in list_message_pages(service, 'all', executor, q=query + bound, **list_args)
+                  for msg in page]
+        if order is None:
+            order = listed
+        candidates = set(listed) if candidates is None else candidates.intersection(listed)
+    return [message_id for message_id in (scope if scope is not None else order) if message_id in candidates]
+
+
+def iter_candidate_pages(service, scan_limit, safe_list, executor=None, **list_args):
+    """Yield pages of message ids in scope that are not from an address or domain on the safe list.
+
+    The safe list is compiled into -from: queries so Gmail leaves safe mail
+    out of the listing. Entries too ambiguous for search syntax are still
+    applied by the caller once headers are fetched. list_args (e.g.
+    labelIds) go to every messages.list call.
+    """
+    pushdown, _ = split_safe_list(safe_list)
+    queries = compile_gmail_queries(pushdown)
+    if not queries or (scan_limit == 'all' and len(queries) == 1):
+        # Nothing to intersect: stream the listing, prefetching on a background thread
+        if queries:
+            list_args['q'] = queries[0]
+        if scan_limit != 'all':
+            report_progress(total=int(scan_limit))
+        for batch in iter_message_pages(scan_limit, executor=executor, **list_args):
+            yield [msg['id'] for msg in batch]
+        return
+
+    ids = list_candidate_ids(service, scan_limit, queries, executor, **list_args)
+    print(f"Search left {len(ids)} candidate messages to check")
+    report_progress(total=len(ids))
+    for i in range(0, len(ids), LIST_PAGE_SIZE):
+        yield ids[i:i + LIST_PAGE_SIZE]
+
+
+def forget_messages(account, message_ids):
+    """Drop deleted messages from the header cache and the incremental-sync replica."""
+    import gmail_sync
+    get_cache().invalidate(account, CACHE_MAILBOX, message_ids)
+    gmail_sync.get_store().apply(account, {}, message_ids)
+
+
+def get_profile(service, executor=None):
+    """Return the authenticated user's profile: emailAddress, used to key the header cache, and historyId."""
+    return (executor or get_executor()).execute('getProfile', service.users().getProfile(userId='me'))
+
+
+_executors = {}  # Token file -> executor; the quota it keeps to is per user
+_executor_lock = threading.Lock()
+
+
+def get_executor(token_file=TOKEN_FILE):
+    """Shared executor for one account; its worker threads each authenticate their own service object."""
+    with _executor_lock:
+        if token_file not in _executors:
+            _executors[token_file] = GmailExecutor(lambda: authenticate_gmail(token_file))
+        return _executors[token_file]
+
+
+def delete_messages(account, message_ids, executor=None):
+    """Permanently delete message_ids, DELETE_BATCH_SIZE per batchDelete call, running calls concurrently.
+
+    A batch the API rejects falls back to deleting its messages one by one.
+    Returns the number of messages deleted.
+    """
+    executor = executor or get_executor()
+
+    def batch_delete(service, batch_ids):
+        service.users().messages().batchDelete(userId='me', body={'ids': batch_ids}).execute()
+
+    def delete_one(service, msg_id):
+        service.users().messages().delete(userId='me', id=msg_id).execute()
+
+    chunks = [message_ids[i:i + DELETE_BATCH_SIZE] for i in range(0, len(message_ids), DELETE_BATCH_SIZE)]
+    futures = [executor.submit('messages.batchDelete', lambda service, chunk=chunk: batch_delete(service, chunk))
+               for chunk in chunks]
+
+    deleted_count = 0
+    for batch_ids, future in zip(chunks, futures):
+        try:
+            future.result()
+            deleted_count += len(batch_ids)
+            forget_messages(account, batch_ids)
+            debug(f"Deleted batch: {len(batch_ids)} messages (Total: {deleted_count})")
+
+        except HttpError as error:
+            print(f"Error deleting batch: {error}")
+            # Fallback to individual deletion
+            singles = [executor.submit('messages.delete', lambda service, msg_id=msg_id: delete_one(service, msg_id))
+                       for msg_id in batch_ids]
+            for msg_id, single in zip(batch_ids, singles):
+                try:
+                    single.result()
+                    deleted_count += 1
+                    forget_messages(account, [msg_id])
+                except HttpError as individual_error:
+                    print(f"Error deleting individual message {msg_id}: {individual_error}")
+
+    return deleted_count
+
+
+def get_message_infos(account, message_ids, executor=None):
+    """Return {message_id: MessageInfo}, only calling the API for ids missing from the header cache."""
+    cache = get_cache()
+    infos = cache.get_infos(account, CACHE_MAILBOX, message_ids)
+    missing = [message_id for message_id in message_ids if message_id not in infos]
+    fetched = {message_id: info
+               for message_id, info in get_message_headers_batch(missing, executor).items()
+               if info.sender}
+    cache.put_many(account, CACHE_MAILBOX, fetched)
+    infos.update(fetched)
+    return infos
+
+
+class GmailBackend(MailBackend):
+    """The Gmail mailbox whose OAuth token is kept in token_file, through the Gmail API, for the sweep pipeline.
+
+    Listing leaves out mail the safe list's -from: queries rule out, or, in
+    incremental mode, answers from the local replica kept current through
+    history.list (see gmail_sync), which already holds every message's info.
+    Each fetch spreads its metadata batches over the account's executor (by
+    default the one get_executor() shares between sweeps of the account), so
+    a couple of fetch workers are enough to keep it busy. high_water is the
+    mailbox's historyId when the backend was opened, so history.list can
+    later name the mail that arrived after the listing.
+
+    labels (default GMAIL_LABELS) limits the sweep to messages under any of
+    those label ids, spam and trash included if named. Each label is listed
+    on its own thread, with scan_limit applying per label, and a message
+    under several of them is kept once, as its id is the same under each.
+    The incremental replica covers the whole mailbox, so it cannot be
+    combined with labels.
+    """
+
+    name = "gmail"
+    fetch_workers = 2
+    page_size = LIST_PAGE_SIZE
+    trash_batch_size = DELETE_BATCH_SIZE
+
+    def __init__(self, incremental=False, token_file=TOKEN_FILE, executor=None, labels=None):
+        self.labels = list(dict.fromkeys(labels if labels is not None else GMAIL_LABELS))
+        if incremental and self.labels:
+            raise ValueError("Incremental sync covers the whole mailbox and cannot be limited to labels")
+        self.incremental = incremental
+        self.token_file = token_file
+        self.executor = executor or get_executor(token_file)
+        self.service = None
+        self.account = None
+        self._replica = None
+
+    def open(self):
+        self.service = authenticate_gmail(self.token_file)
+        if not self.service:
+            raise RuntimeError("Could not connect to the Gmail API")
+        profile = get_profile(self.service, self.executor)
+        self.account = profile['emailAddress']
+        self.high_water = profile['historyId']
+
+    def list_pages(self, scan_limit, safe_list):
+        if self.labels:
+            yield from self._pages(self._each_label(lambda service, label: [
+                message_id
+                for page in iter_candidate_pages(service, scan_limit, safe_list, self.executor,
+                                                 labelIds=[label], includeSpamTrash=True)
+                for message_id in page
+            ]))
+            return
+        if not self.incremental:
+            yield from iter_candidate_pages(self.service, scan_limit, safe_list, self.executor)
+            return
+
+        import gmail_sync
+        self._replica = gmail_sync.sync_mailbox(self.service, self.account, executor=self.executor)
+        yield from self._pages(gmail_sync.newest_ids(self._replica, scan_limit))
+
+    def list_newer(self, high_water, safe_list):
+        import gmail_sync
+
+        def added(service, label=None):
+            return sorted(gmail_sync.history_changes(service, high_water, self.executor, label)[0])
+
+        try:
+            ids = self._each_label(added) if self.labels else added(self.service)
+        except HttpError as error:
+            if getattr(error.resp, 'status', None) == 404:
+                raise ValueError("The dry run is too old to bring up to date; run it again before deleting")
+            raise
+        yield from self._pages(ids, newer=True)
+
+    def _each_label(self, listing):
+        """The ids listing(service, label) returns for each label, run a label per thread, each id once."""
+        def run(label):
+            return listing(self.executor.service(), label)  # The worker thread's own service object
+
+        with ThreadPoolExecutor(max_workers=len(self.labels), thread_name_prefix='label') as pool:
+            listings = list(pool.map(in_current_job(run), self.labels))
+        ids = list(dict.fromkeys(message_id for listed in listings for message_id in listed))
+        duplicates = sum(len(listed) for listed in listings) - len(ids)
+        if duplicates:
+            print(f"Skipped {duplicates} messages already listed under another label")
+        return ids
+
+    def fetch(self, message_ids):
+        if self._replica is not None:
+            return {message_id: self._replica[message_id] for message_id in message_ids
+                    if self._replica[message_id].sender}
+        return get_message_infos(self.account, message_ids, self.executor)
+
+    def trash(self, message_ids):
+        return delete_messages(self.account, message_ids, self.executor)
+
+
+def fetch_unapproved_senders(safe_list, scan_limit=500, incremental=False):
+    """Return a SenderIndex of the unapproved mail in scope, publishing each sender as it is found."""
+    print("Fetching unapproved senders using Gmail API...")
+    return pipeline.scan(GmailBackend(incremental), safe_list, scan_limit)
+
+
+def delete_indexed_emails(message_ids):
+    """Delete messages indexed by an earlier scan without scanning again."""
+    try:
+        return pipeline.delete_ids(GmailBackend(), message_ids)
     except HttpError as error:
         print(f'An error occurred: {error}')
-        return []
-
-
-def delete_unapproved_emails_dry_run(safe_list, scan_limit=500):
-    """Dry run - count emails that would be deleted."""
-    service = authenticate_gmail()
-    if not service:
         return 0
 
-    try:
-        print("DRY RUN: Counting emails that would be deleted...")
 
-        # Get list of messages
-        if scan_limit == 'all':
-            max_results = None
-        else:
-            max_results = min(int(scan_limit), 500)
+def execute_deletion_plan(plan_id, safe_list):
+    """Delete the mail a dry run planned to delete, plus unapproved mail that arrived since.
 
-        results = service.users().messages().list(
-            userId='me',
-            maxResults=max_results
-        ).execute()
-
-        messages = results.get('messages', [])
-        print(f"DRY RUN: Found {len(messages)} messages to check")
-
-        would_delete_count = 0
-
-        # Process messages in batches
-        batch_size = 100
-        for i in range(0, len(messages), batch_size):
-            batch = messages[i:i + batch_size]
-            print(f"DRY RUN: Checking batch {i // batch_size + 1}/{(len(messages) + batch_size - 1) // batch_size}")
-
-            for msg in batch:
-                sender_email = get_message_headers(service, msg['id'])
-
-                if sender_email:
-                    is_safe = any(safe.lower() in sender_email.lower() for safe in safe_list)
-
-                    if not is_safe:
-                        would_delete_count += 1
-                        print(f"DRY RUN: WOULD DELETE email from {sender_email} (#{would_delete_count})")
-                    else:
-                        print(f"DRY RUN: Would keep safe email from {sender_email}")
+    Raises ValueError if the plan has expired or is too old to bring up to date.
+    """
+    store = get_plan_store()
+    plan = store.get(plan_id)
+    if plan is None:
+        raise ValueError("The dry run has expired; run it again before deleting")
+    try:
+        deleted_count = pipeline.execute_plan(GmailBackend(), plan, safe_list)
+    except HttpError as error:
+        print(f'An error occurred: {error}')
+        return 0
+    store.discard(plan_id)
+    return deleted_count
 
-        print(f"DRY RUN SUMMARY: Would delete {would_delete_count} out of {len(messages)} emails")
-        return would_delete_count
 
+def delete_unapproved_emails_dry_run(safe_list, scan_limit=500, incremental=False):
+    """Dry run - work out which emails would be deleted and return them as a saved DeletionPlan."""
+    try:
+        print("DRY RUN: Finding emails that would be deleted...")
+        return pipeline.dry_run(GmailBackend(incremental), safe_list, scan_limit)
     except HttpError as error:
         print(f'An error occurred: {error}')
-        return 0
+        return None
 
 
-def delete_unapproved_emails(safe_list, scan_limit=500):
+def delete_unapproved_emails(safe_list, scan_limit=500, incremental=False):
     """Delete emails from unapproved senders using Gmail API."""
-    service = authenticate_gmail()
-    if not service:
-        return 0
-
     try:
         print("Deleting unapproved emails using Gmail API...")
-
-        # Get list of messages
-        if scan_limit == 'all':
-            max_results = None
-        else:
-            max_results = min(int(scan_limit), 500)
-
-        results = service.users().messages().list(
-            userId='me',
-            maxResults=max_results
-        ).execute()
-
-        messages = results.get('messages', [])
-        print(f"Found {len(messages)} messages to process")
-
-        messages_to_delete = []
-
-        # First pass: identify messages to delete
-        batch_size = 100
-        for i in range(0, len(messages), batch_size):
-            batch = messages[i:i + batch_size]
-            print(f"Analyzing batch {i // batch_size + 1}/{(len(messages) + batch_size - 1) // batch_size}")
-
-            for msg in batch:
-                sender_email = get_message_headers(service, msg['id'])
-
-                if sender_email:
-                    is_safe = any(safe.lower() in sender_email.lower() for safe in safe_list)
-
-                    if not is_safe:
-                        messages_to_delete.append(msg['id'])
-                        print(f"Marked for deletion: email from {sender_email}")
-
-        print(f"Total messages marked for deletion: {len(messages_to_delete)}")
-
-        # Second pass: delete messages in batches
-        if messages_to_delete:
-            deleted_count = 0
-            delete_batch_size = 1000  # Gmail API allows up to 1000 messages per batch delete
-
-            for i in range(0, len(messages_to_delete), delete_batch_size):
-                batch_ids = messages_to_delete[i:i + delete_batch_size]
-
-                try:
-                    # Use batchDelete for efficiency
-                    service.users().messages().batchDelete(
-                        userId='me',
-                        body={'ids': batch_ids}
-                    ).execute()
-
-                    deleted_count += len(batch_ids)
-                    print(f"Deleted batch: {len(batch_ids)} messages (Total: {deleted_count})")
-
-                except HttpError as error:
-                    print(f"Error deleting batch: {error}")
-                    # Fallback to individual deletion
-                    for msg_id in batch_ids:
-                        try:
-                            service.users().messages().delete(userId='me', id=msg_id).execute()
-                            deleted_count += 1
-                        except HttpError as individual_error:
-                            print(f"Error deleting individual message {msg_id}: {individual_error}")
-
-            print(f"Successfully deleted {deleted_count} emails")
-            return deleted_count
-        else:
-            print("No emails to delete")
-            return 0
-
+        return pipeline.delete(GmailBackend(incremental), safe_list, scan_limit)
     except HttpError as error:
         print(f'An error occurred: {error}')
         return 0
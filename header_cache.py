@@ -0,0 +1,141 @@
+﻿import sqlite3
+import threading
+import time
+
+from sender_index import MessageInfo
+from sender_parser import PARSER_VERSION
+
+CACHE_FILE = "header_cache.db"
+MAX_ENTRIES = 200000  # Oldest-accessed rows are evicted beyond this
+SQL_CHUNK_SIZE = 500  # Stay well under SQLite's bound-parameter limit
+
+
+class HeaderCache:
+    """On-disk cache of parsed senders keyed by account, mailbox and message key.
+
+    The key is the UID for IMAP mailboxes and the message id for the Gmail API.
+    A cached sender of None means the message had no parsable From header.
+    Rows written from a full MessageInfo also keep the message size and date.
+    """
+
+    def __init__(self, path=CACHE_FILE, max_entries=MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS headers ("
+                " account TEXT NOT NULL,"
+                " mailbox TEXT NOT NULL,"
+                " key TEXT NOT NULL,"
+                " sender TEXT,"
+                " size INTEGER,"
+                " date REAL,"
+                " accessed REAL NOT NULL,"
+                " PRIMARY KEY (account, mailbox, key))"
+            )
+            columns = {row[1] for row in self._conn.execute("PRAGMA table_info(headers)")}
+            for column, kind in (("size", "INTEGER"), ("date", "REAL")):
+                if column not in columns:  # Cache written before sizes and dates were kept
+                    self._conn.execute(f"ALTER TABLE headers ADD COLUMN {column} {kind}")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS headers_accessed ON headers (accessed)")
+            if self._conn.execute("PRAGMA user_version").fetchone()[0] != PARSER_VERSION:
+                # Senders parsed by another version of sender_parser: fetch them again
+                self._conn.execute("DELETE FROM headers")
+                self._conn.execute(f"PRAGMA user_version = {PARSER_VERSION}")
+
+    def get_infos(self, account, mailbox, keys):
+        """Return {key: MessageInfo} for the keys cached with their size and date."""
+        rows = self._select(account, mailbox, keys, "sender, size, date", "AND size IS NOT NULL")
+        return {row[0]: MessageInfo(*row[1:]) for row in rows}
+
+    def _select(self, account, mailbox, keys, columns, condition=""):
+        found = []
+        keys = list(keys)
+        now = time.time()
+        with self._lock, self._conn:
+            for start in range(0, len(keys), SQL_CHUNK_SIZE):
+                chunk = keys[start:start + SQL_CHUNK_SIZE]
+                placeholders = ",".join("?" * len(chunk))
+                params = [account, mailbox] + chunk
+                found.extend(self._conn.execute(
+                    f"SELECT key, {columns} FROM headers"
+                    f" WHERE account = ? AND mailbox = ? AND key IN ({placeholders}) {condition}",
+                    params,
+                ).fetchall())
+                self._conn.execute(
+                    f"UPDATE headers SET accessed = ? WHERE account = ? AND mailbox = ? AND key IN ({placeholders})",
+                    [now] + params,
+                )
+        return found
+
+    def put_many(self, account, mailbox, entries):
+        """Store {key: MessageInfo or sender} and evict the least recently used rows if over capacity."""
+        if not entries:
+            return
+        now = time.time()
+        rows = []
+        for key, entry in entries.items():
+            info = entry if isinstance(entry, MessageInfo) else MessageInfo(entry, None, None)
+            rows.append((account, mailbox, key, info.sender, info.size, info.date, now))
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO headers (account, mailbox, key, sender, size, date, accessed)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+            self._evict()
+
+    def keys(self, account, mailbox):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT key FROM headers WHERE account = ? AND mailbox = ?", (account, mailbox)
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def invalidate(self, account, mailbox=None, keys=None):
+        """Drop cached rows for an account, one of its mailboxes, or specific keys."""
+        with self._lock, self._conn:
+            if mailbox is None:
+                self._conn.execute("DELETE FROM headers WHERE account = ?", (account,))
+            elif keys is None:
+                self._conn.execute("DELETE FROM headers WHERE account = ? AND mailbox = ?", (account, mailbox))
+            else:
+                keys = list(keys)
+                for start in range(0, len(keys), SQL_CHUNK_SIZE):
+                    chunk = keys[start:start + SQL_CHUNK_SIZE]
+                    self._conn.execute(
+                        f"DELETE FROM headers WHERE account = ? AND mailbox = ? AND key IN ({','.join('?' * len(chunk))})",
+                        [account, mailbox] + chunk,
+                    )
+
+    def clear(self):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM headers")
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM headers").fetchone()[0]
+
+    def _evict(self):
+        overflow = self._conn.execute("SELECT COUNT(*) FROM headers").fetchone()[0] - self.max_entries
+        if overflow > 0:
+            self._conn.execute(
+                "DELETE FROM headers WHERE rowid IN (SELECT rowid FROM headers ORDER BY accessed LIMIT ?)",
+                (overflow,),
+            )
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    """Return the process-wide header cache, opening it on first use."""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = HeaderCache()
+        return _cache
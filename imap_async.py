@@ -0,0 +1,431 @@
+﻿import asyncio
+import re
+import ssl
+import threading
+
+import email_utils
+import pipeline
+from deletion_plan import get_plan_store
+from email_utils import (
+    MAILBOX, TRASH_MAILBOX, FETCH_CHUNK_SIZE, FROM_HEADER_QUERY,
+    limit_ids, sequence_sets, parse_fetch_response, message_info, pushdown_criteria,
+    prune_cache, save_checkpoint,
+)
+from header_cache import get_cache
+from mail_backend import MailBackend, MultiFolderBackend
+from metrics import RECONNECTS
+
+PIPELINE_DEPTH = 8  # FETCH commands in flight on one connection
+SSL_CONTEXT = None  # Client TLS context; None verifies the server against the system's CAs
+READ_LIMIT = 64 * 1024 * 1024  # Longest response line; a UID SEARCH of a large mailbox runs to megabytes
+
+LITERAL = re.compile(rb"\{(\d+)\}\r\n$")
+TAGGED = re.compile(rb"^(?P<tag>A\d+) (?P<status>[A-Z]+) ?(?P<text>.*)")
+UIDVALIDITY = re.compile(rb"\[UIDVALIDITY (\d+)\]")
+CAPABILITY = re.compile(rb"CAPABILITY ([^\]\r\n]*)", re.IGNORECASE)
+FETCH_UID = re.compile(rb"UID\s+(\d+)")
+GM_MSGID = re.compile(rb"X-GM-MSGID\s+(\d+)")
+
+
+class AsyncIMAPError(Exception):
+    pass
+
+
+def quote(value):
+    return '"' + value.replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+
+class AsyncIMAPClient:
+    """Minimal asyncio IMAP4rev1 client that pipelines tagged commands on one connection.
+
+    Every untagged response is delivered to all commands in flight, so callers
+    that pipeline must pick out their own data, e.g. FETCH responses by UID.
+    Responses use imaplib's layout, so email_utils' parsers work unchanged.
+    """
+
+    def __init__(self, host, port=email_utils.IMAP_PORT, use_ssl=True):
+        self.host = host
+        self.port = port
+        self.use_ssl = use_ssl
+        self.capabilities = ()
+        self.uidvalidity = None
+        self._reader = None
+        self._writer = None
+        self._reader_task = None
+        self._tag = 0
+        self._pending = {}  # tag -> (future, untagged data list)
+        self.closed = False  # Set once the server has dropped the connection
+
+    async def connect(self):
+        context = (SSL_CONTEXT or ssl.create_default_context()) if self.use_ssl else None
+        self._reader, self._writer = await asyncio.open_connection(self.host, self.port, ssl=context,
+                                                                   limit=READ_LIMIT)
+        greeting = await self._read_response()
+        self._update_capabilities(greeting)
+        self._reader_task = asyncio.create_task(self._read_loop())
+
+    async def _read_response(self):
+        """Read one response line plus any literals, in imaplib's (prefix, literal) ... trailer layout."""
+        line = await self._reader.readline()
+        if not line:
+            raise ConnectionError("IMAP server closed the connection")
+        parts = []
+        while True:
+            match = LITERAL.search(line)
+            if not match:
+                break
+            literal = await self._reader.readexactly(int(match.group(1)))
+            parts.append((line.rstrip(b"\r\n"), literal))
+            line = await self._reader.readline()
+        line = line.rstrip(b"\r\n")
+        if parts:
+            parts.append(line)
+            return parts
+        return [line]
+
+    async def _read_loop(self):
+        try:
+            while True:
+                response = await self._read_response()
+                first = response[0][0] if isinstance(response[0], tuple) else response[0]
+                if first.startswith(b"* "):
+                    self._update_capabilities(response)
+                    for _, data in self._pending.values():
+                        data.extend(response)
+                    continue
+                match = TAGGED.match(first)
+                if match:
+                    entry = self._pending.pop(match.group("tag").decode(), None)
+                    if entry and not entry[0].done():
+                        entry[0].set_result((match.group("status").decode(), entry[1], match.group("text")))
+        except Exception as e:
+            # Whatever stopped the reader (a dropped connection, a line over READ_LIMIT), nothing
+            # will answer the commands in flight, so they fail rather than wait forever
+            self.closed = True
+            for future, _ in self._pending.values():
+                if not future.done():
+                    error = AsyncIMAPError(f"Connection lost: {e}")
+                    error.__cause__ = e
+                    future.set_exception(error)
+            self._pending.clear()
+
+    def _update_capabilities(self, response):
+        for part in response:
+            text = part[0] if isinstance(part, tuple) else part
+            match = CAPABILITY.search(text)
+            if match:
+                self.capabilities = tuple(match.group(1).decode().upper().split())
+
+    async def command(self, name, *args):
+        """Send a tagged command and wait for its completion; returns (status, untagged data)."""
+        if self.closed:
+            raise AsyncIMAPError("Connection lost")
+        self._tag += 1
+        tag = f"A{self._tag:04d}"
+        future = asyncio.get_running_loop().create_future()
+        self._pending[tag] = (future, [])
+        line = " ".join([tag, name] + [str(arg) for arg in args]) + "\r\n"
+        self._writer.write(line.encode())
+        await self._writer.drain()
+        status, data, text = await future
+        if status == "BAD":
+            raise AsyncIMAPError(f"{name} rejected: {text.decode(errors='ignore')}")
+        return status, data
+
+    async def login(self, user, password):
+        status, _ = await self.command("LOGIN", quote(user), quote(password))
+        if status != "OK":
+            raise AsyncIMAPError("LOGIN failed")
+        await self.command("CAPABILITY")
+
+    async def select(self, mailbox=MAILBOX):
+        status, data = await self.command("SELECT", quote(mailbox))
+        if status != "OK":
+            raise AsyncIMAPError(f"SELECT {mailbox} failed")
+        for part in data:
+            match = UIDVALIDITY.search(part[0] if isinstance(part, tuple) else part)
+            if match:
+                self.uidvalidity = match.group(1).decode()
+        return self.uidvalidity
+
+    async def uid_search(self, criteria="ALL"):
+        status, data = await self.command("UID SEARCH", criteria)
+        if status != "OK":
+            return None
+        uids = []
+        for part in data:
+            if isinstance(part, bytes) and part.startswith(b"* SEARCH"):
+                uids.extend(uid.decode() for uid in part[len(b"* SEARCH"):].split())
+        return uids
+
+    async def uid_fetch_messages(self, uids):
+        """Fetch From/Date headers and sizes for uids; returns {uid: MessageInfo} limited to the uids asked for."""
+        wanted = set(uids)
+        messages = {}
+        for uid_set, _ in sequence_sets(uids):
+            status, data = await self.command("UID FETCH", uid_set, FROM_HEADER_QUERY)
+            if status != "OK":
+                print(f"Batch fetch failed for {len(uids)} emails - Result: {status}")
+                continue
+            for uid, raw, size in parse_fetch_response(data):
+                if uid in wanted:
+                    messages[uid] = message_info(raw, size)
+        return messages
+
+    async def uid_fetch_keys(self, uids):
+        """Return {uid: X-GM-MSGID} for uids, like email_utils.fetch_message_keys."""
+        wanted = set(uids)
+        keys = {}
+        for uid_set, _ in sequence_sets(uids):
+            status, data = await self.command("UID FETCH", uid_set, "(X-GM-MSGID)")
+            if status != "OK":
+                print(f"Message id fetch failed - Result: {status}")
+                continue
+            for part in data:
+                line = part[0] if isinstance(part, tuple) else part
+                uid, msgid = FETCH_UID.search(line), GM_MSGID.search(line)
+                if uid and msgid and uid.group(1).decode() in wanted:
+                    keys[uid.group(1).decode()] = msgid.group(1).decode()
+        return keys
+
+    async def logout(self):
+        try:
+            await self.command("LOGOUT")
+        except (AsyncIMAPError, OSError):
+            pass
+        if self._reader_task:
+            self._reader_task.cancel()
+        self._writer.close()
+
+
+async def connect(email_user, email_pass, mailbox=MAILBOX, host=None, port=None, use_ssl=None):
+    client = AsyncIMAPClient(host or email_utils.IMAP_SERVER, port or email_utils.IMAP_PORT,
+                             email_utils.IMAP_SSL if use_ssl is None else use_ssl)
+    await client.connect()
+    await client.login(email_user, email_pass)
+    await client.select(mailbox)
+    return client
+
+
+async def search_candidate_uids(client, scope, safe_list):
+    """Async counterpart of email_utils.search_candidate_uids."""
+    criteria = pushdown_criteria(client.capabilities, safe_list)
+    if not scope or not criteria:
+        return scope
+    uid_range = f"UID {scope[0]}:{scope[-1]}"
+    candidates = set(scope)
+    # Searches are not pipelined: untagged SEARCH results carry no tag to tell them apart
+    for criterion in criteria:
+        found = await client.uid_search(f"{uid_range} {criterion}")
+        if found is None:
+            print("Server-side search failed, falling back to fetching every header")
+            return scope
+        candidates.intersection_update(found)
+    print(f"Server-side search left {len(candidates)} of {len(scope)} emails to check")
+    return [uid for uid in scope if uid in candidates]
+
+
+async def move_to_trash(client, uids):
+    """Async counterpart of email_utils.move_to_trash."""
+    use_move = "MOVE" in client.capabilities
+    moved = []
+    for uid_set, members in sequence_sets(uids):
+        if use_move:
+            status, _ = await client.command("UID MOVE", uid_set, quote(TRASH_MAILBOX))
+        else:
+            status, _ = await client.command("UID COPY", uid_set, quote(TRASH_MAILBOX))
+            if status == "OK":
+                status, _ = await client.command("UID STORE", uid_set, "+FLAGS.SILENT", "(\\Deleted)")
+        if status == "OK":
+            moved.extend(members)
+        else:
+            print(f"Failed to move {len(members)} emails to trash - Result: {status}")
+
+    if moved and not use_move:
+        if "UIDPLUS" in client.capabilities:
+            for uid_set, _ in sequence_sets(moved):
+                await client.command("UID EXPUNGE", uid_set)
+        else:
+            await client.command("EXPUNGE")
+    return moved
+
+
+class EventLoopThread:
+    """An asyncio event loop running forever on a daemon thread, shared by every AsyncImapBackend."""
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever, name='imap-async', daemon=True)
+        self._thread.start()
+
+    def run(self, coroutine):
+        """Run coroutine on the loop and return its result, blocking the calling thread meanwhile."""
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+
+_loop = None
+_loop_lock = threading.Lock()
+
+
+def get_loop():
+    """Return the process-wide IMAP event loop, starting it on first use."""
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = EventLoopThread()
+        return _loop
+
+
+class AsyncImapBackend(MailBackend):
+    """An IMAP mailbox on one pipelined asyncio connection, for the sweep pipeline.
+
+    Works like email_utils.ImapBackend, header cache and checkpoints
+    included, but keeps a single connection on the shared event loop
+    (get_loop()) instead of a pool of blocking ones, so the mailboxes of
+    every running sweep share one thread. Each of the pipeline's `depth`
+    fetch workers submits its chunk's UID FETCH to the connection, so that
+    many are in flight at once. A connection the server drops is replaced
+    and the command retried once.
+    """
+
+    name = "imap"
+    page_size = FETCH_CHUNK_SIZE
+
+    def __init__(self, email_user, email_pass, depth=PIPELINE_DEPTH, mailbox=MAILBOX,
+                 host=None, port=None, use_ssl=None):
+        self.email_user = email_user
+        self.account = email_user
+        self.email_pass = email_pass
+        self.mailbox = mailbox
+        self.server = {'host': host, 'port': port, 'use_ssl': use_ssl}
+        self.fetch_workers = max(1, depth)
+        self.client = None
+        self.listed = False
+        self._loop = get_loop()
+        self._reconnecting = None
+
+    def open(self):
+        self.client = self._loop.run(self._connect())
+        self.uidvalidity = self.client.uidvalidity
+
+    async def _connect(self):
+        self._reconnecting = asyncio.Lock()  # Made on the loop it is used from
+        return await connect(self.email_user, self.email_pass, self.mailbox, **self.server)
+
+    def close(self):
+        if self.listed:
+            save_checkpoint(self.email_user, self.uidvalidity, self.mailbox)
+        if self.client is not None:
+            self._loop.run(self.client.logout())
+
+    def list_pages(self, scan_limit, safe_list):
+        email_ids = self._run(lambda client: client.uid_search())
+        if email_ids is None:
+            print("Mailbox search failed")
+            return
+        self.high_water = int(email_ids[-1]) if email_ids else 0
+        scope = limit_ids(email_ids, scan_limit)
+        candidates = self._run(lambda client: search_candidate_uids(client, scope, safe_list))
+        prune_cache(self.email_user, self.uidvalidity, scope, self.mailbox)
+        self.listed = True
+        yield from self._pages(candidates)
+
+    def list_newer(self, high_water, safe_list):
+        # "n:*" always matches the highest UID, even when it is below n
+        email_ids = self._run(lambda client: client.uid_search(f"UID {high_water + 1}:*"))
+        if email_ids is None:
+            print("Mailbox search failed")
+            return
+        newer = [uid for uid in email_ids if int(uid) > high_water]
+        yield from self._pages(self._run(lambda client: search_candidate_uids(client, newer, safe_list)), newer=True)
+
+    def fetch(self, uids):
+        cache = get_cache()
+        infos = cache.get_infos(self.email_user, self.mailbox, uids)
+        missing = [uid for uid in uids if uid not in infos]
+        if missing:
+            fetched = self._run(lambda client: client.uid_fetch_messages(missing))
+            cache.put_many(self.email_user, self.mailbox, fetched)
+            infos.update(fetched)
+        return {uid: info for uid, info in infos.items() if info.sender}
+
+    def trash(self, uids):
+        moved = self._run(lambda client: move_to_trash(client, uids))
+        get_cache().invalidate(self.email_user, self.mailbox, moved)
+        return len(moved)
+
+    def message_keys(self, uids):
+        # Only Gmail lists one message in several folders, under one X-GM-MSGID
+        if "X-GM-EXT-1" not in self.client.capabilities:
+            return None
+        return self._run(lambda client: client.uid_fetch_keys(uids)) if uids else {}
+
+    def _run(self, command):
+        """command(client)'s result, awaited on the event loop."""
+        return self._loop.run(self._retrying(command))
+
+    async def _retrying(self, command):
+        for attempt in range(2):
+            client = self.client
+            try:
+                return await command(client)
+            except AsyncIMAPError as e:
+                if attempt or not client.closed:
+                    raise
+                print(f"Connection lost ({e}), retrying on a new connection")
+                async with self._reconnecting:
+                    if self.client is client:  # Commands that were in flight together reconnect once
+                        RECONNECTS.inc(backend=self.name)
+                        self.client = await connect(self.email_user, self.email_pass, self.mailbox, **self.server)
+
+
+def imap_backend(email_user, email_pass, depth=PIPELINE_DEPTH, folders=None, **server):
+    """email_utils.imap_backend on the asyncio engine: an AsyncImapBackend, or a MultiFolderBackend of them."""
+    folders = list(dict.fromkeys(folders or email_utils.IMAP_FOLDERS))
+    if len(folders) == 1:
+        return AsyncImapBackend(email_user, email_pass, depth, folders[0], **server)
+    return MultiFolderBackend({folder: AsyncImapBackend(email_user, email_pass, depth, folder, **server)
+                               for folder in folders})
+
+
+# email_utils' operations on the asyncio engine, taking the same arguments (depth
+# instead of connections) and returning the same results; app.py picks one by IMAP_ENGINE
+
+def fetch_unapproved_senders(email_user, email_pass, safe_list, scan_limit='100', depth=PIPELINE_DEPTH, folders=None):
+    """Return a SenderIndex of the unapproved mail in scope, publishing each sender as it is found."""
+    print("Fetching unapproved senders...")
+    return pipeline.scan(imap_backend(email_user, email_pass, depth, folders), safe_list, scan_limit)
+
+
+def delete_indexed_emails(email_user, email_pass, uids, uidvalidity, folders=None):
+    """Move uids indexed by an earlier scan to the trash without scanning again.
+
+    Raises ValueError if the mailbox's UIDVALIDITY changed since the scan, as
+    the uids may then name different messages.
+    """
+    return pipeline.delete_ids(imap_backend(email_user, email_pass, folders=folders), uids, uidvalidity)
+
+
+def execute_deletion_plan(email_user, email_pass, plan_id, safe_list, depth=PIPELINE_DEPTH, folders=None):
+    """Move the mail a dry run planned to delete to the trash, plus unapproved mail that arrived since.
+
+    Raises ValueError if the plan has expired or the mailbox's UIDVALIDITY
+    changed since the dry run.
+    """
+    store = get_plan_store()
+    plan = store.get(plan_id)
+    if plan is None:
+        raise ValueError("The dry run has expired; run it again before deleting")
+    deleted_count = pipeline.execute_plan(imap_backend(email_user, email_pass, depth, folders), plan, safe_list)
+    store.discard(plan_id)
+    return deleted_count
+
+
+def delete_unapproved_emails_dry_run(email_user, email_pass, safe_list, scan_limit='500', depth=PIPELINE_DEPTH,
+                                     folders=None):
+    """Work out what delete_unapproved_emails() would remove and return it as a saved DeletionPlan."""
+    return pipeline.dry_run(imap_backend(email_user, email_pass, depth, folders), safe_list, scan_limit)
+
+
+def delete_unapproved_emails(email_user, email_pass, safe_list, scan_limit='500', depth=PIPELINE_DEPTH, folders=None):
+    return pipeline.delete(imap_backend(email_user, email_pass, depth, folders), safe_list, scan_limit)
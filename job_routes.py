@@ -0,0 +1,65 @@
+﻿import json
+
+from flask import Blueprint, Response, render_template, request, jsonify, abort
+
+from jobs import get_runner
+
+SSE_POLL_SECONDS = 1.0  # Longest wait between events; also keeps idle proxies from closing the stream
+
+jobs_blueprint = Blueprint('jobs', __name__)
+
+
+@jobs_blueprint.route('/jobs/<job_id>')
+def job_status(job_id):
+    """Progress of a job: status, processed/total, rate (messages/s) and ETA (s)."""
+    job = get_runner().get(job_id)
+    if job is None:
+        abort(404)
+    return jsonify(job.to_dict())
+
+
+@jobs_blueprint.route('/jobs/<job_id>/cancel', methods=['POST'])
+def cancel_job(job_id):
+    """Ask a queued or running job to stop."""
+    job = get_runner().cancel(job_id)
+    if job is None:
+        abort(404)
+    return jsonify(job.to_dict())
+
+
+@jobs_blueprint.route('/jobs/<job_id>/events')
+def job_events(job_id):
+    """Server-Sent Events stream of a job's published items, its progress, and a final `end` event.
+
+    ?start=N skips the first N items, which the page already rendered.
+    """
+    job = get_runner().get(job_id)
+    if job is None:
+        abort(404)
+
+    start = request.args.get('start', 0, type=int)
+
+    def events():
+        sent = start
+        while True:
+            items, finished = job.wait_items(sent, SSE_POLL_SECONDS)
+            for item in items:
+                yield f"event: item\ndata: {json.dumps(item)}\n\n"
+            sent += len(items)
+            state = json.dumps(job.to_dict())
+            if finished:
+                yield f"event: end\ndata: {state}\n\n"
+                return
+            yield f"event: progress\ndata: {state}\n\n"
+
+    return Response(events(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@jobs_blueprint.route('/jobs/<job_id>/progress')
+def job_progress(job_id):
+    """Page that polls the job's status and moves on to the app's job_result view once it is done."""
+    job = get_runner().get(job_id)
+    if job is None:
+        abort(404)
+    return render_template('job.html', job=job.to_dict())
@@ -0,0 +1,220 @@
+﻿import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+JOB_WORKERS = 2  # Sweeps run at once; each one already parallelises its own I/O
+MAX_PENDING_JOBS = 8  # Submissions beyond this are refused rather than queued
+MAX_FINISHED_JOBS = 100  # Finished jobs kept around for status queries
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+FINISHED = {DONE, FAILED, CANCELLED}
+
+
+class JobCancelled(BaseException):
+    """Raised inside a job when it is cancelled.
+
+    Derives from BaseException, like asyncio.CancelledError, so the broad
+    `except Exception` handlers in the mail operations let it through.
+    """
+
+
+class JobQueueFull(Exception):
+    pass
+
+
+class Job:
+    def __init__(self, kind):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.status = QUEUED
+        self.processed = 0
+        self.total = None
+        self.result = None
+        self.error = None
+        self.items = []  # Partial results published while running, e.g. senders as they are found
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self._cancel = threading.Event()
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._future = None
+
+    @property
+    def cancel_requested(self):
+        return self._cancel.is_set()
+
+    def update(self, processed=None, total=None, advance=0, total_advance=0):
+        with self._lock:
+            if total is not None:
+                self.total = total
+            if total_advance:
+                self.total = (self.total or 0) + total_advance
+            if processed is not None:
+                self.processed = processed
+            self.processed += advance
+
+    def publish(self, item):
+        with self._changed:
+            self.items.append(item)
+            self._changed.notify_all()
+
+    def finish(self, status):
+        with self._changed:
+            self.status = status
+            self.finished = time.time()
+            self._changed.notify_all()
+
+    def wait_items(self, start, timeout):
+        """Return (items published from index start on, finished), waiting up to timeout for something new."""
+        with self._changed:
+            if len(self.items) <= start and self.status not in FINISHED:
+                self._changed.wait(timeout)
+            return self.items[start:], self.status in FINISHED
+
+    def to_dict(self):
+        with self._lock:
+            processed, total = self.processed, self.total
+        end = self.finished or time.time()
+        elapsed = end - self.started if self.started else 0.0
+        rate = processed / elapsed if elapsed > 0 else None
+        eta = None
+        if self.status == RUNNING and rate and total is not None:
+            eta = max(0.0, (total - processed) / rate)
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'status': self.status,
+            'processed': processed,
+            'total': total,
+            'elapsed': round(elapsed, 1),
+            'rate': round(rate, 1) if rate is not None else None,
+            'eta': round(eta, 1) if eta is not None else None,
+            'error': self.error,
+        }
+
+
+_current = threading.local()
+
+
+def current_job():
+    """The job running on this thread, or None outside the job runner."""
+    return getattr(_current, 'job', None)
+
+
+def report_progress(processed=None, total=None, advance=0, total_advance=0):
+    """Record progress for the job running on this thread and stop it if it was cancelled.
+
+    total replaces the job's total; total_advance adds to it, for work found
+    after the total was first reported. A no-op outside a job, so the mail
+    operations can call it unconditionally. Raises JobCancelled once
+    cancellation has been requested.
+    """
+    job = current_job()
+    if job is None:
+        return
+    job.update(processed, total, advance, total_advance)
+    if job.cancel_requested:
+        raise JobCancelled()
+
+
+def publish(item):
+    """Hand a partial result to whoever is following the job running on this thread; a no-op outside a job."""
+    job = current_job()
+    if job is not None:
+        job.publish(item)
+
+
+def in_current_job(fn):
+    """Wrap fn so that, run on another thread, it reports progress to and is cancelled with the calling thread's job."""
+    job = current_job()
+
+    def run(*args, **kwargs):
+        previous = current_job()
+        _current.job = job
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _current.job = previous
+
+    return run
+
+
+class JobRunner:
+    """Runs long mail operations on a bounded pool of background threads."""
+
+    def __init__(self, workers=JOB_WORKERS, max_pending=MAX_PENDING_JOBS, max_finished=MAX_FINISHED_JOBS):
+        self.max_pending = max_pending
+        self.max_finished = max_finished
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='job')
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def submit(self, kind, fn, *args, **kwargs):
+        """Queue fn(*args, **kwargs) and return its Job; raises JobQueueFull when too many are waiting."""
+        job = Job(kind)
+        with self._lock:
+            pending = sum(1 for other in self._jobs.values() if other.status == QUEUED)
+            if pending >= self.max_pending:
+                raise JobQueueFull(f"{pending} jobs are already waiting")
+            self._jobs[job.id] = job
+            self._prune()
+        job._future = self._pool.submit(self._run, job, fn, args, kwargs)
+        return job
+
+    def _run(self, job, fn, args, kwargs):
+        if job.cancel_requested:
+            job.finish(CANCELLED)
+            return
+        job.status = RUNNING
+        job.started = time.time()
+        _current.job = job
+        status = FAILED
+        try:
+            job.result = fn(*args, **kwargs)
+            status = DONE
+        except JobCancelled:
+            status = CANCELLED
+        except Exception as e:
+            job.error = str(e)
+            print(f"Job {job.id} ({job.kind}) failed: {e}")
+        finally:
+            _current.job = None
+            job.finish(status)
+
+    def _prune(self):
+        finished = [job_id for job_id, job in self._jobs.items() if job.status in FINISHED]
+        for job_id in finished[:max(0, len(finished) - self.max_finished)]:
+            del self._jobs[job_id]
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def cancel(self, job_id):
+        """Request cancellation; a queued job never starts, a running one stops at its next progress report."""
+        job = self.get(job_id)
+        if job is None or job.status in FINISHED:
+            return job
+        job._cancel.set()
+        if job._future is not None and job._future.cancel():
+            job.finish(CANCELLED)
+        return job
+
+
+_runner = None
+_runner_lock = threading.Lock()
+
+
+def get_runner():
+    global _runner
+    with _runner_lock:
+        if _runner is None:
+            _runner = JobRunner()
+        return _runner
@@ -0,0 +1,195 @@
+﻿from concurrent.futures import ThreadPoolExecutor
+
+from jobs import report_progress, in_current_job
+from pipeline import merged
+
+
+class MailBackend:
+    """One mailbox that the sweep pipeline (see pipeline.py) runs against.
+
+    The pipeline calls open() first and close() last (also usable as a
+    context manager). In between:
+
+    - list_pages(scan_limit, safe_list) yields lists of message ids to check,
+      after whatever safe-list filtering the server can do for us.
+    - fetch(ids) returns {id: MessageInfo} for the ids whose sender could be
+      read. It is called from fetch_workers threads at once.
+    - trash(ids) removes the messages and returns how many it removed.
+
+    uidvalidity is set by open() on backends whose ids can be reassigned
+    (IMAP); ids from an earlier scan are only valid while it is unchanged.
+    name labels the backend's metrics (see metrics.py) and account names
+    the mailbox's owner. open() or list_pages() sets high_water, a
+    JSON-serialisable marker of the newest mail listed, and
+    list_newer(high_water, safe_list) later lists only mail that arrived
+    after it, the same way list_pages() does, but adds its count to the
+    job's progress total instead of setting it. message_keys(ids) identifies
+    messages the account may also list elsewhere under other ids (see
+    MultiFolderBackend).
+    """
+
+    name = "mail"
+    fetch_workers = 1
+    page_size = 500  # Ids per listed page
+    trash_batch_size = 1000
+    uidvalidity = None
+    account = None
+    high_water = None
+
+    def open(self):
+        pass
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def list_pages(self, scan_limit, safe_list):
+        raise NotImplementedError
+
+    def list_newer(self, high_water, safe_list):
+        raise NotImplementedError
+
+    def fetch(self, ids):
+        raise NotImplementedError
+
+    def trash(self, ids):
+        raise NotImplementedError
+
+    def _pages(self, ids, newer=False):
+        """ids in pages of page_size, for list_pages(), or list_newer() with newer true."""
+        if newer:
+            report_progress(total_advance=len(ids))  # On top of the planned messages already counted
+        else:
+            report_progress(total=len(ids))
+        for start in range(0, len(ids), self.page_size):
+            yield ids[start:start + self.page_size]
+
+    def message_keys(self, ids):
+        """{id: key} naming each message the same way in every folder that lists it, or None if none can.
+
+        None means no message is listed in two folders. Otherwise ids left
+        out have gone since they were listed (or their key could not be
+        read), and are skipped.
+        """
+        return None
+
+
+class MultiFolderBackend(MailBackend):
+    """Several folders of one account swept as one mailbox, each message once however many folders list it.
+
+    backends maps folder name to a backend for that folder alone, whose ids
+    are strings without "/"; this backend's ids are "folder/id". Folders are
+    opened and listed concurrently, and each folder's pages are passed on as
+    it lists them. A message more than one folder lists (Gmail shows a
+    message in the folder of each of its labels) is kept only in the folder
+    whose page naming it in message_keys() came first, so it is fetched and
+    trashed once. fetch_workers is the folders' together, so every folder's
+    connections stay busy. uidvalidity and high_water combine the folders'
+    own.
+    """
+
+    def __init__(self, backends):
+        self.backends = dict(backends)
+        if not self.backends:
+            raise ValueError("No folders to sweep")
+        first = next(iter(self.backends.values()))
+        self.name = first.name
+        self.trash_batch_size = first.trash_batch_size
+        self.fetch_workers = sum(backend.fetch_workers for backend in self.backends.values())
+
+    def _each(self, fn):
+        """{folder: fn(folder, backend)}, run for every folder at once; the first error is re-raised."""
+        with ThreadPoolExecutor(max_workers=len(self.backends), thread_name_prefix='folder') as pool:
+            futures = {folder: pool.submit(in_current_job(fn), folder, backend)
+                       for folder, backend in self.backends.items()}
+            return {folder: future.result() for folder, future in futures.items()}
+
+    def open(self):
+        try:
+            self._each(lambda folder, backend: backend.open())
+        except BaseException:
+            self.close()
+            raise
+        self.account = next(iter(self.backends.values())).account
+        uidvalidities = [backend.uidvalidity for backend in self.backends.values()]
+        if any(uidvalidity is not None for uidvalidity in uidvalidities):
+            self.uidvalidity = ";".join(f"{folder}={uidvalidity}"
+                                        for folder, uidvalidity in zip(self.backends, uidvalidities))
+
+    def close(self):
+        for backend in self.backends.values():
+            backend.close()
+
+    def list_pages(self, scan_limit, safe_list):
+        report_progress(total=0)  # Grown page by page, as only the pages' unique messages count
+        yield from self._merged({folder: backend.list_pages(scan_limit, safe_list)
+                                 for folder, backend in self.backends.items()})
+        self.high_water = {folder: backend.high_water for folder, backend in self.backends.items()}
+
+    def list_newer(self, high_water, safe_list):
+        # A folder the dry run could not list has no high water mark; none of its mail was planned, so none goes
+        unlisted = [folder for folder in self.backends if high_water.get(folder) is None]
+        if unlisted:
+            print(f"Skipping folders the dry run did not list: {', '.join(unlisted)}")
+        yield from self._merged({folder: backend.list_newer(high_water[folder], safe_list)
+                                 for folder, backend in self.backends.items() if folder not in unlisted})
+
+    def _merged(self, listings):
+        """The pages of every folder's listing as they come, as "folder/id" pages without messages already listed."""
+        seen = set()
+        duplicates = 0
+        # The folders' own progress totals count duplicates, so they list outside the job
+        for folder, page, keys in merged((_keyed(folder, self.backends[folder], pages)
+                                          for folder, pages in listings.items()), in_job=False):
+            unique = []
+            for message_id in page:
+                if keys is not None:
+                    # Missing when another folder's trash took it since the listing: Gmail trashes every label
+                    key = keys.get(message_id)
+                    if key is None or key in seen:
+                        duplicates += 1
+                        continue
+                    seen.add(key)
+                unique.append(f"{folder}/{message_id}")
+            report_progress(total_advance=len(unique))
+            if unique:
+                yield unique
+        if duplicates:
+            print(f"Skipped {duplicates} messages already listed in another folder or gone since")
+
+    def _by_folder(self, ids):
+        grouped = {}
+        for message_id in ids:
+            folder, _, folder_id = message_id.rpartition("/")
+            if folder not in self.backends:
+                raise ValueError(f"Message {message_id} is not in a folder of this sweep")
+            grouped.setdefault(folder, []).append(folder_id)
+        return grouped
+
+    def fetch(self, ids):
+        infos = {}
+        for folder, folder_ids in self._by_folder(ids).items():
+            fetched = self.backends[folder].fetch(folder_ids)
+            infos.update((f"{folder}/{message_id}", info) for message_id, info in fetched.items())
+        return infos
+
+    def trash(self, ids):
+        return sum(self.backends[folder].trash(folder_ids) for folder, folder_ids in self._by_folder(ids).items())
+
+
+def _keyed(folder, backend, pages):
+    """(folder, page, keys) for each of the pages, keys being backend.message_keys() for all of them.
+
+    The keys are read before the first page is passed on, as trash() may
+    then use the connection they are read over.
+    """
+    pages = list(pages)
+    keys = backend.message_keys([message_id for page in pages for message_id in page])
+    for page in pages:
+        yield folder, page, keys
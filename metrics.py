@@ -0,0 +1,176 @@
+﻿import bisect
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+LOG_LEVELS = {'DEBUG': 10, 'INFO': 20, 'WARNING': 30, 'ERROR': 40}
+LOG_LEVEL = os.environ.get("SWEEP_LOG_LEVEL", "INFO").upper()  # DEBUG adds per-sender and per-batch lines
+PROGRESS_LOG_SECONDS = 5.0  # Shortest gap between two progress lines of one sweep
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def log(level, message):
+    """Print message if level (DEBUG, INFO, WARNING or ERROR) is at or above SWEEP_LOG_LEVEL."""
+    if LOG_LEVELS[level] >= LOG_LEVELS.get(LOG_LEVEL, LOG_LEVELS['INFO']):
+        print(message)
+
+
+def debug(message):
+    log('DEBUG', message)
+
+
+def _label_key(labelnames, labels):
+    if set(labels) != set(labelnames):
+        raise ValueError(f"Expected labels {labelnames}, got {sorted(labels)}")
+    return tuple(str(labels[name]) for name in labelnames)
+
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labelnames, key, extra=()):
+    pairs = list(zip(labelnames, key)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def _format_value(value):
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class Counter:
+    """Monotonic count per label combination, e.g. messages that went through a stage."""
+
+    kind = "counter"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(self.labelnames, labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(_label_key(self.labelnames, labels), 0)
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        return [(f"{self.name}{_format_labels(self.labelnames, key)}", value) for key, value in values]
+
+
+class Histogram:
+    """Distribution of observed values, e.g. seconds per call, in cumulative le buckets plus _sum and _count."""
+
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._values = {}  # label key -> [per-bucket counts (the last one is +Inf), sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = _label_key(self.labelnames, labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.setdefault(key, [[0] * (len(self.buckets) + 1), 0.0])
+            entry[0][index] += 1
+            entry[1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the seconds the with block took, including when it raises."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def count(self, **labels):
+        with self._lock:
+            counts, _ = self._values.get(_label_key(self.labelnames, labels), ([0], 0.0))
+            return sum(counts)
+
+    def samples(self):
+        with self._lock:
+            values = sorted((key, (list(counts), total)) for key, (counts, total) in self._values.items())
+        samples = []
+        for key, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                samples.append((f"{self.name}_bucket{_format_labels(self.labelnames, key, [('le', le)])}", cumulative))
+            samples.append((f"{self.name}_sum{_format_labels(self.labelnames, key)}", total))
+            samples.append((f"{self.name}_count{_format_labels(self.labelnames, key)}", cumulative))
+        return samples
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format."""
+        with self._lock:
+            metrics = list(self._metrics)
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(f"{sample} {_format_value(value)}" for sample, value in metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+# Stages are list, fetch, classify and delete; backend is a MailBackend's name
+STAGE_MESSAGES = REGISTRY.register(Counter(
+    "sweep_stage_messages_total", "Messages that went through a sweep stage.", ("backend", "stage")))
+STAGE_SECONDS = REGISTRY.register(Histogram(
+    "sweep_stage_seconds", "Seconds per batch spent in a sweep stage.", ("backend", "stage")))
+UNAPPROVED_MESSAGES = REGISTRY.register(Counter(
+    "sweep_unapproved_messages_total", "Classified messages whose sender is not on the safe list.", ("backend",)))
+RECONNECTS = REGISTRY.register(Counter(
+    "sweep_reconnects_total", "Connections replaced after the server dropped them.", ("backend",)))
+RETRIES = REGISTRY.register(Counter(
+    "sweep_retries_total", "Calls retried after a throttle or transient error.", ("backend", "reason")))
+
+
+class ProgressLog:
+    """Prints how far a stage has got, at most once every `interval` seconds however often it is updated."""
+
+    def __init__(self, label, interval=PROGRESS_LOG_SECONDS):
+        self.label = label
+        self.interval = interval
+        self.count = 0
+        self._started = self._logged = time.monotonic()
+        self._lock = threading.Lock()
+
+    def update(self, advance):
+        with self._lock:
+            self.count += advance
+            now = time.monotonic()
+            if now - self._logged < self.interval:
+                return
+            self._logged = now
+            count, elapsed = self.count, now - self._started
+        log('INFO', f"{self.label}: {count} so far ({count / elapsed:,.0f}/s)")
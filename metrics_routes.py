@@ -0,0 +1,11 @@
+﻿from flask import Blueprint, Response
+
+from metrics import REGISTRY
+
+metrics_blueprint = Blueprint('metrics', __name__)
+
+
+@metrics_blueprint.route('/metrics')
+def metrics():
+    """Sweep counters and stage latencies in the Prometheus text format, for scraping."""
+    return Response(REGISTRY.render(), mimetype='text/plain; version=0.0.4')
@@ -0,0 +1,305 @@
+﻿import queue
+import threading
+
+from deletion_plan import DeletionPlan, get_plan_store
+from jobs import report_progress, publish, in_current_job
+from metrics import STAGE_MESSAGES, STAGE_SECONDS, UNAPPROVED_MESSAGES, ProgressLog, debug
+from safe_list_store import matcher_for, safe_list_digest
+from sender_index import SenderIndex
+
+QUEUE_SIZE = 4  # Batches buffered between two stages
+POLL_SECONDS = 0.5  # How often a blocked stage checks whether the consumer has gone away
+
+
+class _Failure:
+    def __init__(self, error):
+        self.error = error
+
+
+def _put(q, item, stop):
+    """Put item on q, waiting while it is full; False if stop was set first."""
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=POLL_SECONDS)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _get(q, stop, default):
+    """The next item of q, waiting while it is empty; default if stop was set first."""
+    while not stop.is_set():
+        try:
+            return q.get(timeout=POLL_SECONDS)
+        except queue.Empty:
+            continue
+    return default
+
+
+def threaded(source, fn=None, workers=1, queue_size=QUEUE_SIZE):
+    """Yield fn(item) for every item of source, computed on `workers` threads, in completion order.
+
+    source is iterated on a thread of its own, so a generator doing network
+    I/O (listing) runs ahead of the workers, which run ahead of the consumer.
+    At most queue_size items wait between each of them, so memory stays
+    bounded however large the mailbox is. Errors raised by source or fn,
+    including JobCancelled, are re-raised in the consumer, and closing this
+    generator stops every thread.
+    """
+    fn = fn or (lambda item: item)
+    source = iter(source)
+    inbox = queue.Queue(maxsize=queue_size)
+    outbox = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+    done = object()
+
+    @in_current_job
+    def feed():
+        try:
+            for item in source:
+                if not _put(inbox, item, stop):
+                    break
+        except BaseException as error:
+            _put(outbox, _Failure(error), stop)
+        finally:
+            if hasattr(source, 'close'):
+                source.close()
+            for _ in range(workers):
+                _put(inbox, done, stop)
+
+    @in_current_job
+    def work():
+        try:
+            while True:
+                item = _get(inbox, stop, done)
+                if item is done or not _put(outbox, fn(item), stop):
+                    return
+        except BaseException as error:
+            _put(outbox, _Failure(error), stop)
+        finally:
+            _put(outbox, done, stop)
+
+    threads = [threading.Thread(target=feed, daemon=True)]
+    threads += [threading.Thread(target=work, daemon=True) for _ in range(workers)]
+    for thread in threads:
+        thread.start()
+
+    finished = 0
+    try:
+        while finished < workers:
+            item = outbox.get()
+            if item is done:
+                finished += 1
+            elif isinstance(item, _Failure):
+                raise item.error
+            else:
+                yield item
+    finally:
+        stop.set()
+
+
+def merged(sources, in_job=True, queue_size=QUEUE_SIZE):
+    """Yield the items of every iterable in sources, each iterated on a thread of its own, as they come.
+
+    Like threaded(), at most queue_size items wait, errors are re-raised in
+    the consumer and closing this generator stops every thread. With in_job
+    false, the sources are iterated outside the caller's job and report no
+    progress to it.
+    """
+    sources = [iter(source) for source in sources]
+    outbox = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+    done = object()
+
+    def drain(source):
+        try:
+            for item in source:
+                if not _put(outbox, item, stop):
+                    break
+        except BaseException as error:
+            _put(outbox, _Failure(error), stop)
+        finally:
+            if hasattr(source, 'close'):
+                source.close()
+            _put(outbox, done, stop)
+
+    for source in sources:
+        threading.Thread(target=in_current_job(drain) if in_job else drain, args=(source,), daemon=True).start()
+
+    finished = 0
+    try:
+        while finished < len(sources):
+            item = outbox.get()
+            if item is done:
+                finished += 1
+            elif isinstance(item, _Failure):
+                raise item.error
+            else:
+                yield item
+    finally:
+        stop.set()
+
+
+def rebatch(batches, size):
+    """Regroup an iterable of lists into lists of `size` items (the last may be shorter)."""
+    pending = []
+    for batch in batches:
+        pending.extend(batch)
+        while len(pending) >= size:
+            yield pending[:size]
+            pending = pending[size:]
+    if pending:
+        yield pending
+
+
+def listed(backend, pages):
+    """pages, counted and timed as the list stage."""
+    pages = iter(pages)
+    try:
+        while True:
+            with STAGE_SECONDS.time(backend=backend.name, stage='list'):
+                page = next(pages, None)
+            if page is None:
+                return
+            STAGE_MESSAGES.inc(len(page), backend=backend.name, stage='list')
+            yield page
+    finally:
+        if hasattr(pages, 'close'):
+            pages.close()
+
+
+def fetched(backend, ids):
+    """(len(ids), backend.fetch(ids)), counted and timed as the fetch stage."""
+    with STAGE_SECONDS.time(backend=backend.name, stage='fetch'):
+        infos = backend.fetch(ids)
+    STAGE_MESSAGES.inc(len(ids), backend=backend.name, stage='fetch')
+    return len(ids), infos
+
+
+def trashed(backend, ids):
+    """backend.trash(ids), counted and timed as the delete stage."""
+    with STAGE_SECONDS.time(backend=backend.name, stage='delete'):
+        count = backend.trash(ids)
+    STAGE_MESSAGES.inc(count, backend=backend.name, stage='delete')
+    return count
+
+
+def classify(backend, safe_list, pages):
+    """Run the fetch and classify stages over listed pages and yield {id: MessageInfo} of unapproved mail per batch.
+
+    pages is one of the backend's listings. Listing and fetching overlap with
+    each other and with the caller, which classifies a batch while the next
+    ones are being fetched.
+    """
+    matcher = matcher_for(safe_list)
+    progress = ProgressLog(f"Checked ({backend.name})")
+    batches = threaded(listed(backend, pages), lambda ids: fetched(backend, ids), workers=backend.fetch_workers)
+    for checked, infos in batches:
+        with STAGE_SECONDS.time(backend=backend.name, stage='classify'):
+            unapproved = {message_id: info for message_id, info in infos.items()
+                          if info.sender and not matcher.matches(info.sender)}
+        STAGE_MESSAGES.inc(len(infos), backend=backend.name, stage='classify')
+        UNAPPROVED_MESSAGES.inc(len(unapproved), backend=backend.name)
+        report_progress(advance=checked)
+        progress.update(checked)
+        yield unapproved
+
+
+def scan(backend, safe_list, scan_limit):
+    """Return a SenderIndex of the unapproved mail in scope, publishing each sender as it is found."""
+    index = SenderIndex()
+    with backend:
+        index.uidvalidity = backend.uidvalidity
+        index.account = backend.account
+        for unapproved in classify(backend, safe_list, backend.list_pages(scan_limit, safe_list)):
+            for message_id, info in unapproved.items():
+                if index.add(message_id, info):
+                    debug(f"Found unapproved sender: {info.sender}")
+                    publish(info.sender)
+        index.high_water = backend.high_water
+    print(f"Total unapproved senders: {len(index)}")
+    return index
+
+
+def dry_run(backend, safe_list, scan_limit):
+    """Decide what delete() would remove, without removing anything, and save it as a DeletionPlan.
+
+    Returns the plan; execute_plan() carries it out later without another sweep.
+    """
+    targets = {}
+    with backend:
+        for unapproved in classify(backend, safe_list, backend.list_pages(scan_limit, safe_list)):
+            targets.update((message_id, info.sender) for message_id, info in unapproved.items())
+        plan = DeletionPlan(backend.account, targets, safe_list_digest(safe_list),
+                            backend.uidvalidity, backend.high_water)
+    get_plan_store().save(plan)
+    print(f"DRY RUN SUMMARY: Would delete {len(plan)} emails")
+    return plan
+
+
+def delete(backend, safe_list, scan_limit):
+    """Remove unapproved mail in scope and return how many messages were removed.
+
+    The act stage runs behind the others: each full batch of targets is
+    trashed on its own thread while the next ones are still being fetched
+    and classified.
+    """
+    with backend:
+        unapproved = classify(backend, safe_list, backend.list_pages(scan_limit, safe_list))
+        targets = rebatch((list(batch) for batch in unapproved), backend.trash_batch_size)
+        deleted_count = sum(threaded(targets, lambda ids: trashed(backend, ids)))
+    print(f"Removed {deleted_count} unapproved emails")
+    return deleted_count
+
+
+def execute_plan(backend, plan, safe_list):
+    """Carry out a dry run's DeletionPlan and return how many messages were removed.
+
+    The planned messages are removed in bulk without being fetched again;
+    only senders the safe list has come to cover since are spared. Mail that
+    arrived after the dry run is listed, fetched and classified as usual, so
+    it is not left behind. Raises ValueError if the plan is for another
+    account or the mailbox's UIDVALIDITY changed.
+    """
+    with backend:
+        if backend.account != plan.account:
+            raise ValueError("The deletion plan was made for a different account")
+        if backend.uidvalidity != plan.uidvalidity:
+            raise ValueError("The mailbox changed since the dry run; run it again before deleting")
+
+        targets = list(plan.current_targets(safe_list))
+        report_progress(processed=0, total=len(targets))
+        deleted_count = 0
+        for batch in rebatch([targets], backend.trash_batch_size):
+            deleted_count += trashed(backend, batch)
+            report_progress(advance=len(batch))
+        print(f"Removed {deleted_count} of {len(targets)} planned emails")
+
+        if plan.high_water is not None:
+            planned = set(plan.targets)
+            newer = classify(backend, safe_list, backend.list_newer(plan.high_water, safe_list))
+            batches = rebatch(([message_id for message_id in batch if message_id not in planned] for batch in newer),
+                              backend.trash_batch_size)
+            newer_count = sum(threaded(batches, lambda ids: trashed(backend, ids)))
+            print(f"Removed {newer_count} unapproved emails that arrived after the dry run")
+            deleted_count += newer_count
+    return deleted_count
+
+
+def delete_ids(backend, ids, uidvalidity=None):
+    """Remove messages indexed by an earlier scan, without scanning again.
+
+    Raises ValueError if the backend's uidvalidity changed since the scan, as
+    the ids may then name different messages.
+    """
+    with backend:
+        if backend.uidvalidity != uidvalidity:
+            raise ValueError("The mailbox changed since it was scanned; scan it again before deleting")
+        report_progress(processed=0, total=len(ids))
+        deleted_count = 0
+        for batch in rebatch([ids], backend.trash_batch_size):
+            deleted_count += trashed(backend, batch)
+            report_progress(advance=len(batch))
+    print(f"Removed {deleted_count} of {len(ids)} indexed emails")
+    return deleted_count
@@ -0,0 +1,82 @@
+﻿from collections import deque
+
+MEMO_SIZE = 100000  # Distinct senders remembered per matcher
+
+
+class SafeListMatcher:
+    """Compiled form of a safe list, built once per run.
+
+    matches(sender) gives the same answer as
+    any(safe.lower() in sender.lower() for safe in safe_list), but in time
+    proportional to the length of the sender rather than the size of the safe
+    list: exact addresses are answered from a set, everything else by a single
+    pass of an Aho-Corasick automaton over the lowercased sender.
+    """
+
+    def __init__(self, safe_list):
+        entries = {safe.lower() for safe in safe_list}
+        self.size = len(entries)
+        self._match_all = "" in entries  # "" is a substring of every sender
+        self._exact = entries
+        self._memo = {}
+        self._build(entries)
+
+    def _build(self, entries):
+        # Trie of every entry; _goto[state] maps a character to the next state
+        self._goto = [{}]
+        self._terminal = [False]
+        for entry in entries:
+            state = 0
+            for ch in entry:
+                nxt = self._goto[state].get(ch)
+                if nxt is None:
+                    nxt = len(self._goto)
+                    self._goto[state][ch] = nxt
+                    self._goto.append({})
+                    self._terminal.append(False)
+                state = nxt
+            self._terminal[state] = True
+
+        # Breadth-first failure links; a state is terminal if any suffix of it is
+        self._fail = [0] * len(self._goto)
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for ch, nxt in self._goto[state].items():
+                queue.append(nxt)
+                fail = self._fail[state]
+                while fail and ch not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[nxt] = self._goto[fail].get(ch, 0)
+                self._terminal[nxt] = self._terminal[nxt] or self._terminal[self._fail[nxt]]
+
+    def matches(self, sender):
+        """Return True if any safe-list entry occurs in the sender, ignoring case."""
+        if self._match_all:
+            return True
+        result = self._memo.get(sender)
+        if result is None:
+            result = self._scan(sender.lower())
+            if len(self._memo) >= MEMO_SIZE:
+                self._memo.clear()
+            self._memo[sender] = result
+        return result
+
+    __contains__ = matches
+
+    def _scan(self, text):
+        if text in self._exact:
+            return True
+        goto, fail, terminal = self._goto, self._fail, self._terminal
+        state = 0
+        for ch in text:
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            if terminal[state]:
+                return True
+        return False
+
+    def unsafe(self, senders):
+        """Return the senders that no safe-list entry matches, preserving order."""
+        return [sender for sender in senders if not self.matches(sender)]
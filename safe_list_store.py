@@ -0,0 +1,134 @@
+﻿import hashlib
+import json
+import os
+import sqlite3
+import threading
+
+from safe_list_matcher import SafeListMatcher
+
+STORE_FILE = "safe_list.db"
+LEGACY_FILE = "safe_list.json"  # Imported once when the store is first created
+
+
+class SafeList(tuple):
+    """Immutable snapshot of the safe list at one store version.
+
+    Iterates like the sorted list of entries. The matcher is built on first
+    use and shared by every request and scan that sees this version.
+    """
+
+    def __new__(cls, entries, version):
+        snapshot = super().__new__(cls, entries)
+        snapshot.version = version
+        snapshot._matcher = None
+        snapshot._lock = threading.Lock()
+        return snapshot
+
+    @property
+    def matcher(self):
+        with self._lock:
+            if self._matcher is None:
+                self._matcher = SafeListMatcher(self)
+            return self._matcher
+
+    @property
+    def digest(self):
+        return safe_list_digest(self)
+
+
+def safe_list_digest(safe_list):
+    """Content hash of a safe list, the same for any order or duplication of its entries."""
+    return hashlib.sha256("\n".join(sorted(set(safe_list))).encode()).hexdigest()
+
+
+def matcher_for(safe_list):
+    """The snapshot's shared matcher, or a freshly built one for a plain list of entries."""
+    if isinstance(safe_list, SafeList):
+        return safe_list.matcher
+    return SafeListMatcher(safe_list)
+
+
+class SafeListStore:
+    """Safe list shared by both apps, kept in SQLite so adds and removes are atomic and incremental.
+
+    Every change bumps a version number in the same transaction. snapshot()
+    reads only that number and reuses its cached snapshot, and the matcher
+    built for it, until another request or process changes the list.
+    """
+
+    def __init__(self, path=STORE_FILE, legacy_file=LEGACY_FILE):
+        self.path = path
+        self._lock = threading.Lock()
+        self._snapshot = None
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS entries (entry TEXT PRIMARY KEY)")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+            created = self._conn.execute(
+                "INSERT OR IGNORE INTO meta (key, value) VALUES ('version', 0)"
+            ).rowcount
+        if created and legacy_file:
+            self.add(load_legacy_safe_list(legacy_file))
+
+    def _version(self):
+        return self._conn.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()[0]
+
+    def snapshot(self):
+        """Return the current SafeList, re-reading the entries only if the version changed."""
+        with self._lock:
+            version = self._version()
+            if self._snapshot is None or self._snapshot.version != version:
+                entries = [row[0] for row in self._conn.execute("SELECT entry FROM entries ORDER BY entry")]
+                self._snapshot = SafeList(entries, version)
+            return self._snapshot
+
+    def add(self, entries):
+        """Add entries in one transaction; returns how many were new."""
+        rows = [(entry,) for entry in {entry.strip() for entry in entries} if entry]
+        return self._change("INSERT OR IGNORE INTO entries (entry) VALUES (?)", rows)
+
+    def remove(self, entries):
+        """Remove entries in one transaction; returns how many were present."""
+        rows = [(entry.strip(),) for entry in set(entries)]
+        return self._change("DELETE FROM entries WHERE entry = ?", rows)
+
+    def _change(self, statement, rows):
+        if not rows:
+            return 0
+        with self._lock, self._conn:
+            before = self._conn.total_changes
+            self._conn.executemany(statement, rows)
+            changed = self._conn.total_changes - before
+            if changed:
+                self._conn.execute("UPDATE meta SET value = value + 1 WHERE key = 'version'")
+        return changed
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+
+def load_legacy_safe_list(path):
+    if not os.path.exists(path):
+        return []
+    try:
+        with open(path, "r") as f:
+            data = f.read().strip()
+            return json.loads(data) if data else []
+    except (json.JSONDecodeError, IOError) as e:
+        print(f"Warning: Failed to import safe list from {path}: {e}")
+        return []
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_safe_list_store():
+    """Return the process-wide safe-list store, opening it on first use."""
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = SafeListStore()
+        return _store
@@ -0,0 +1,48 @@
+﻿from flask import Blueprint, request, jsonify, abort, session
+
+from safe_list_store import get_safe_list_store
+from scan_store import get_scan_store, PAGE_SIZE
+
+scans_blueprint = Blueprint('scans', __name__)
+
+
+def session_scan(scan_id):
+    """The stored scan, if it belongs to this session."""
+    if session.get('scan_id') != scan_id:
+        abort(404)
+    result = get_scan_store().get(scan_id)
+    if result is None:
+        abort(404)
+    return result
+
+
+@scans_blueprint.route('/scans/<scan_id>/senders')
+def scan_senders(scan_id):
+    """One page of a finished scan's unapproved senders.
+
+    Query parameters: offset, limit, sort (count, bytes, last_seen,
+    first_seen, sender or domain), order (asc or desc), prefix and domain.
+    """
+    result = session_scan(scan_id)
+    offset = request.args.get('offset', 0, type=int)
+    limit = request.args.get('limit', PAGE_SIZE, type=int)
+    total, rows = result.page(
+        get_safe_list_store().snapshot(),
+        offset=offset,
+        limit=limit,
+        sort=request.args.get('sort', 'count'),
+        descending=request.args.get('order', 'desc') == 'desc',
+        prefix=request.args.get('prefix', ''),
+        domain=request.args.get('domain', ''),
+    )
+    return jsonify({'scan': scan_id, 'total': total, 'offset': offset, 'senders': rows})
+
+
+@scans_blueprint.route('/scans/<scan_id>/domains')
+def scan_domains(scan_id):
+    """Per-domain roll-up of a finished scan, largest message count first; ?limit= caps the list."""
+    result = session_scan(scan_id)
+    view = result.view(get_safe_list_store().snapshot())
+    domains = view.domains() if view is not None else []
+    limit = request.args.get('limit', type=int)
+    return jsonify({'scan': scan_id, 'total': len(domains), 'domains': domains[:limit] if limit else domains})
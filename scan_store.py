@@ -0,0 +1,154 @@
+﻿import threading
+import time
+from collections import OrderedDict
+
+from jobs import current_job, get_runner, JobCancelled, FINISHED
+from sender_index import SORT_KEYS, sender_domain
+
+MAX_SCANS = 20  # Finished scans kept for their preview pages; the oldest is dropped first
+PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+
+class ScanResult:
+    """What one scan found, kept server-side under the scan's job id.
+
+    A completed scan keeps its SenderIndex. A cancelled or failed one only
+    keeps the senders it had published, with index None, and the delete step
+    falls back to scanning again.
+
+    Senders added to the safe list after the scan are filtered out per
+    safe-list version; that filtered view and its sorted rows are cached, so
+    paging through 100k senders sorts them once rather than once per page.
+    """
+
+    def __init__(self, scan_id, index=None, senders=()):
+        self.id = scan_id
+        self.index = index
+        self.senders = list(senders)
+        self.created = time.time()
+        self._version = None
+        self._view = None
+        self._partial = []
+        self._rows = {}
+        self._lock = threading.Lock()
+
+    def view(self, safe_list):
+        """The index without senders the safe list now matches; None for a partial result."""
+        with self._lock:
+            return self._refresh(safe_list)
+
+    def _refresh(self, safe_list):
+        if self._version != safe_list.version:
+            self._version = safe_list.version
+            self._rows = {}
+            if self.index is not None:
+                self._view = self.index.without(safe_list.matcher)
+            else:
+                self._view = None
+                self._partial = safe_list.matcher.unsafe(self.senders)
+        return self._view
+
+    def count(self, safe_list):
+        with self._lock:
+            view = self._refresh(safe_list)
+            return len(view) if view is not None else len(self._partial)
+
+    def rows(self, safe_list, sort='count', descending=True):
+        with self._lock:
+            view = self._refresh(safe_list)
+            if view is None:
+                # Only the addresses are known; fall back to sorting by them
+                if sort not in ('sender', 'domain'):
+                    sort = 'sender'
+            elif sort not in SORT_KEYS:
+                sort = 'count'
+            key = (sort, descending)
+            if key not in self._rows:
+                if view is not None:
+                    self._rows[key] = view.rows(sort, descending)
+                else:
+                    rows = [{'sender': sender, 'domain': sender_domain(sender)} for sender in self._partial]
+                    self._rows[key] = sorted(rows, key=lambda row: row[sort], reverse=descending)
+            return self._rows[key]
+
+    def page(self, safe_list, offset=0, limit=PAGE_SIZE, sort='count', descending=True, prefix='', domain=''):
+        """Return (matching row count, rows[offset:offset + limit]) for senders starting with prefix."""
+        rows = self.rows(safe_list, sort, descending)
+        if prefix:
+            prefix = prefix.lower()
+            rows = [row for row in rows if row['sender'].lower().startswith(prefix)]
+        if domain:
+            domain = domain.lower()
+            rows = [row for row in rows if row['domain'] == domain]
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
+        offset = max(0, offset)
+        return len(rows), rows[offset:offset + limit]
+
+
+class ScanStore:
+    """In-process store of finished scans, keyed by scan id, holding the most recent MAX_SCANS."""
+
+    def __init__(self, max_scans=MAX_SCANS):
+        self.max_scans = max_scans
+        self._scans = OrderedDict()
+        self._lock = threading.Lock()
+
+    def put(self, result):
+        with self._lock:
+            self._scans[result.id] = result
+            self._scans.move_to_end(result.id)
+            while len(self._scans) > self.max_scans:
+                self._scans.popitem(last=False)
+        return result
+
+    def get(self, scan_id):
+        with self._lock:
+            return self._scans.get(scan_id)
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_scan_store():
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = ScanStore()
+        return _store
+
+
+def run_scan(scan, *args, **kwargs):
+    """Job body for a scan: run scan(*args, **kwargs), which returns a SenderIndex, and store the result.
+
+    If the scan is cancelled or fails, the senders it published so far are
+    stored instead.
+    """
+    job = current_job()
+    try:
+        index = scan(*args, **kwargs)
+    except (Exception, JobCancelled):
+        get_scan_store().put(ScanResult(job.id, senders=job.items))
+        raise
+    get_scan_store().put(ScanResult(job.id, index))
+    return index
+
+
+def find_scan(scan_id, safe_list):
+    """Return (ScanResult or None, the scan still running or None) for a scan id.
+
+    A running scan is described as {'id', 'start', 'found'}: the unapproved
+    senders published so far and how many items the page has already seen.
+    """
+    if not scan_id:
+        return None, None
+    result = get_scan_store().get(scan_id)
+    if result is not None:
+        return result, None
+    job = get_runner().get(scan_id)
+    if job is None or job.status in FINISHED:
+        # Pruned, or finished between the two lookups; a finished scan is stored before its job ends
+        return get_scan_store().get(scan_id), None
+    items = list(job.items)
+    return None, {'id': job.id, 'start': len(items), 'found': safe_list.matcher.unsafe(items)}
@@ -0,0 +1,349 @@
+﻿import argparse
+import json
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+
+import email_utils
+import pipeline
+from jobs import QUEUED, RUNNING, DONE, FAILED
+from metrics import log
+from safe_list_store import get_safe_list_store
+
+MAX_SWEEPS = 4  # Sweeps running at once across the whole roster
+MAX_CONNECTIONS = 30  # IMAP connections open at once across the whole roster
+OPERATIONS = ('scan', 'dry run', 'delete')
+GMAIL_PROVIDER = "gmail"  # Provider name of accounts swept through the Gmail API
+TOP_SENDERS = 10  # Senders listed per account in a scan report
+REPORT_FILE = "sweep_report.json"
+
+
+class RosterAccount:
+    """One mailbox of the roster, with its own safe list, scan limit and operation.
+
+    backend is 'imap', which needs user and password and may name its own
+    host, port, use_ssl and folders (default: email_utils's IMAP_SERVER and
+    so on), or 'gmail', which needs token_file, the account's own OAuth
+    token, and may name labels (default: gmail_utils.GMAIL_LABELS).
+    connections is the number of IMAP fetch connections the sweep would like;
+    the scheduler may grant fewer. Accounts of one provider share its limits:
+    the provider is the IMAP host, or GMAIL_PROVIDER for the API.
+    """
+
+    def __init__(self, name, backend, safe_list, scan_limit='500', operation='dry run', user=None, password=None,
+                 host=None, port=None, use_ssl=None, connections=email_utils.IMAP_CONNECTIONS, token_file=None,
+                 incremental=False, folders=None, labels=None):
+        if backend not in ('imap', 'gmail'):
+            raise ValueError(f"Account {name}: backend must be 'imap' or 'gmail', not {backend!r}")
+        if operation not in OPERATIONS:
+            raise ValueError(f"Account {name}: operation must be one of {', '.join(OPERATIONS)}")
+        if backend == 'imap' and not (user and password):
+            raise ValueError(f"Account {name}: IMAP accounts need a user and a password")
+        if backend == 'gmail' and not token_file:
+            raise ValueError(f"Account {name}: Gmail accounts need a token_file")
+        self.name = name
+        self.backend = backend
+        self.safe_list = safe_list
+        self.scan_limit = scan_limit
+        self.operation = operation
+        self.user = user
+        self.password = password
+        self.host = host
+        self.port = port
+        self.use_ssl = use_ssl
+        self.connections = max(1, connections)
+        self.token_file = token_file
+        self.incremental = incremental
+        self.folders = folders
+        self.labels = labels
+
+    @classmethod
+    def from_dict(cls, entry, shared_safe_list=None):
+        """An account from its roster entry.
+
+        The entry's safe_list is a list of entries, or "shared" for the apps'
+        safe list store (shared_safe_list, read once per roster). An entry may
+        give password_env, the environment variable holding the password,
+        instead of the password itself.
+        """
+        entry = dict(entry)
+        name = entry.pop('name', None) or entry.get('user') or entry.get('token_file')
+        safe_list = entry.pop('safe_list', None)
+        if safe_list == "shared":
+            safe_list = shared_safe_list if shared_safe_list is not None else get_safe_list_store().snapshot()
+        elif not isinstance(safe_list, list):
+            raise ValueError(f"Account {name}: safe_list must be a list of entries or \"shared\"")
+        password_env = entry.pop('password_env', None)
+        if password_env:
+            entry['password'] = os.environ.get(password_env)
+        try:
+            return cls(name, entry.pop('backend', 'imap'), safe_list, **entry)
+        except TypeError as e:
+            raise ValueError(f"Account {name}: {e}")
+
+    @property
+    def provider(self):
+        if self.backend == 'gmail':
+            return GMAIL_PROVIDER
+        return self.host or email_utils.IMAP_SERVER
+
+    def connections_held(self, connections):
+        """IMAP connections a sweep with `connections` fetch connections keeps open: a main one per folder too."""
+        if self.backend != 'imap':
+            return 0
+        folder_count = len(dict.fromkeys(self.folders or email_utils.IMAP_FOLDERS))
+        return folder_count * (email_utils.folder_connections(connections, folder_count) + 1)
+
+    def open_backend(self, connections, shared_bucket=None):
+        """The MailBackend to sweep, with `connections` fetch connections (IMAP) or drawing on shared_bucket (Gmail)."""
+        if self.backend == 'imap':
+            return email_utils.imap_backend(self.user, self.password, connections, self.folders,
+                                            host=self.host, port=self.port, use_ssl=self.use_ssl)
+        import gmail_utils
+        from gmail_executor import GmailExecutor
+        executor = GmailExecutor(lambda: gmail_utils.authenticate_gmail(self.token_file), shared_bucket=shared_bucket)
+        return gmail_utils.GmailBackend(self.incremental, self.token_file, executor, self.labels)
+
+
+class SweepReport:
+    """Outcome of one account's sweep: its status, timings, what it found or removed, or why it failed."""
+
+    def __init__(self, account):
+        self.account = account
+        self.status = QUEUED
+        self.mailbox = None  # The address the backend reported, once opened
+        self.connections = None  # IMAP fetch connections granted
+        self.result = {}
+        self.error = None
+        self.queued = time.time()
+        self.started = None
+        self.finished = None
+
+    def run(self, connections, shared_bucket=None):
+        account = self.account
+        self.status = RUNNING
+        self.started = time.time()
+        self.connections = connections if account.backend == 'imap' else None
+        backend = None
+        try:
+            backend = account.open_backend(connections, shared_bucket)
+            if account.operation == 'scan':
+                index = pipeline.scan(backend, account.safe_list, account.scan_limit)
+                self.result = {'senders': len(index), 'messages': index.message_count,
+                               'top_senders': index.rows()[:TOP_SENDERS]}
+            elif account.operation == 'dry run':
+                plan = pipeline.dry_run(backend, account.safe_list, account.scan_limit)
+                self.result = {'plan_id': plan.id, 'messages': len(plan), 'senders': len(set(plan.targets.values()))}
+            else:
+                self.result = {'deleted': pipeline.delete(backend, account.safe_list, account.scan_limit)}
+            self.status = DONE
+        except Exception as e:
+            self.status = FAILED
+            self.error = str(e)
+        finally:
+            self.finished = time.time()
+            if backend is not None:
+                self.mailbox = backend.account
+                if account.backend == 'gmail':
+                    backend.executor.shutdown()
+
+    def to_dict(self):
+        return {
+            'name': self.account.name,
+            'backend': self.account.backend,
+            'provider': self.account.provider,
+            'mailbox': self.mailbox,
+            'operation': self.account.operation,
+            'scan_limit': self.account.scan_limit,
+            'status': self.status,
+            'connections': self.connections,
+            'waited': round(self.started - self.queued, 1) if self.started else None,
+            'elapsed': round(self.finished - self.started, 1) if self.finished else None,
+            'result': self.result,
+            'error': self.error,
+        }
+
+
+class SweepScheduler:
+    """Sweeps a roster of accounts concurrently within global and per-provider limits.
+
+    At most max_sweeps sweeps run at once, holding at most max_connections
+    IMAP connections between them (a sweep holds its fetch connections plus
+    one main connection). providers maps a provider to its own limits:
+    'sweeps' and 'connections' as above, and for the Gmail API 'quota', the
+    units per second every account together may use, on top of each
+    account's own per-user quota.
+
+    Accounts wait in one queue per provider, in roster order. Whenever a slot
+    frees up the providers take turns: the first one in rotation whose next
+    account fits within the limits starts it and goes to the back, so a
+    provider at its own cap never holds up the others and one with a long
+    queue cannot crowd them out. An IMAP sweep that wants more connections
+    than are free starts with fewer rather than wait, as long as it gets at
+    least one.
+    """
+
+    def __init__(self, max_sweeps=MAX_SWEEPS, max_connections=MAX_CONNECTIONS, providers=None):
+        if max_sweeps < 1:
+            raise ValueError("max_sweeps must be at least 1")
+        self.max_sweeps = max_sweeps
+        self.max_connections = max_connections
+        self.providers = providers or {}
+        self._running = {}  # Provider -> sweeps running
+        self._connections = {}  # Provider -> IMAP connections held
+        self._buckets = {}  # Provider -> TokenBucket shared by its Gmail accounts
+        self._condition = threading.Condition()
+
+    def _limit(self, provider, name, default):
+        limit = self.providers.get(provider, {}).get(name)
+        return default if limit is None else min(limit, default)
+
+    def _grant(self, account):
+        """IMAP fetch connections account may start with now (0 for Gmail), or None if it has to wait."""
+        provider = account.provider
+        if sum(self._running.values()) >= self.max_sweeps:
+            return None
+        if self._running.get(provider, 0) >= self._limit(provider, 'sweeps', self.max_sweeps):
+            return None
+        if account.backend != 'imap':
+            return 0
+        free = min(self.max_connections - sum(self._connections.values()),
+                   self._limit(provider, 'connections', self.max_connections) - self._connections.get(provider, 0))
+        for granted in range(account.connections, 0, -1):
+            if account.connections_held(granted) <= free:
+                return granted
+        return None
+
+    def _check(self, accounts):
+        for account in accounts:
+            needed = account.connections_held(1)
+            if needed > self._limit(account.provider, 'connections', self.max_connections):
+                raise ValueError(f"Account {account.name}: an IMAP sweep needs at least {needed} connections "
+                                 f"but {account.provider} is limited to fewer")
+            if self._limit(account.provider, 'sweeps', self.max_sweeps) < 1:
+                raise ValueError(f"Account {account.name}: {account.provider} allows no sweeps")
+
+    def _bucket(self, provider):
+        # Called under the condition, so the provider's sweeps all get the same bucket
+        quota = self.providers.get(provider, {}).get('quota')
+        if provider != GMAIL_PROVIDER or not quota:
+            return None
+        if provider not in self._buckets:
+            from gmail_executor import TokenBucket
+            self._buckets[provider] = TokenBucket(quota)
+        return self._buckets[provider]
+
+    def run(self, accounts):
+        """Sweep every account and return their SweepReports, in roster order.
+
+        A sweep that fails is reported as failed; the others carry on.
+        """
+        self._check(accounts)
+        reports = [SweepReport(account) for account in accounts]
+        queues = OrderedDict()
+        for report in reports:
+            queues.setdefault(report.account.provider, deque()).append(report)
+
+        threads = []
+        with self._condition:
+            while any(queues.values()):
+                thread = self._start_next(queues)
+                if thread is None:
+                    self._condition.wait()
+                else:
+                    threads.append(thread)
+        for thread in threads:
+            thread.join()
+        return reports
+
+    def _start_next(self, queues):
+        for provider, waiting in list(queues.items()):
+            if not waiting:
+                continue
+            connections = self._grant(waiting[0].account)
+            if connections is None:
+                continue
+            report = waiting.popleft()
+            queues.move_to_end(provider)
+            self._running[provider] = self._running.get(provider, 0) + 1
+            held = report.account.connections_held(connections)
+            self._connections[provider] = self._connections.get(provider, 0) + held
+            thread = threading.Thread(target=self._sweep, args=(report, connections, held, self._bucket(provider)),
+                                      daemon=True)
+            thread.start()
+            return thread
+        return None
+
+    def _sweep(self, report, connections, held, bucket):
+        account = report.account
+        provider = account.provider
+        log('INFO', f"Sweeping {account.name} ({account.operation}, {provider})")
+        try:
+            report.run(connections, bucket)
+        finally:
+            with self._condition:
+                self._running[provider] -= 1
+                self._connections[provider] -= held
+                self._condition.notify_all()
+        if report.status == FAILED:
+            log('ERROR', f"Sweep of {account.name} failed: {report.error}")
+        else:
+            log('INFO', f"Sweep of {account.name} done in {report.finished - report.started:.1f}s")
+
+
+def load_roster(path):
+    """Read a roster file and return (accounts, limits), limits being SweepScheduler's keyword arguments.
+
+    The file is JSON: {"accounts": [...], "limits": {"sweeps": n,
+    "connections": n}, "providers": {provider: {"sweeps": n, "connections":
+    n, "quota": units}}}; only accounts is required. Each account is a
+    RosterAccount.from_dict entry.
+    """
+    with open(path, "r") as f:
+        roster = json.load(f)
+    entries = roster.get('accounts') or []
+    shared = None
+    if any(entry.get('safe_list') == "shared" for entry in entries):
+        shared = get_safe_list_store().snapshot()
+    accounts = [RosterAccount.from_dict(entry, shared) for entry in entries]
+    names = [account.name for account in accounts]
+    duplicates = sorted({name for name in names if names.count(name) > 1})
+    if duplicates:
+        raise ValueError(f"Account names must be unique: {', '.join(map(str, duplicates))}")
+    limits = roster.get('limits', {})
+    return accounts, {
+        'max_sweeps': limits.get('sweeps', MAX_SWEEPS),
+        'max_connections': limits.get('connections', MAX_CONNECTIONS),
+        'providers': roster.get('providers', {}),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sweep every account of a roster within connection and quota limits.")
+    parser.add_argument("roster", help="roster JSON file (see load_roster)")
+    parser.add_argument("--report", default=REPORT_FILE, help="where to write the per-account JSON report")
+    parser.add_argument("--sweeps", type=int, help="sweeps at once, overriding the roster's limit")
+    parser.add_argument("--connections", type=int, help="IMAP connections at once, overriding the roster's limit")
+    args = parser.parse_args()
+
+    accounts, limits = load_roster(args.roster)
+    if args.sweeps is not None:
+        limits['max_sweeps'] = args.sweeps
+    if args.connections is not None:
+        limits['max_connections'] = args.connections
+    reports = [report.to_dict() for report in SweepScheduler(**limits).run(accounts)]
+
+    with open(args.report, "w") as f:
+        json.dump(reports, f, indent=2)
+    print(f"{'account':<30} {'operation':<10} {'status':<8} {'seconds':>8}  result")
+    for report in reports:
+        result = report['error'] or ", ".join(f"{key} {value}" for key, value in report['result'].items()
+                                              if key != 'top_senders')
+        print(f"{report['name']:<30} {report['operation']:<10} {report['status']:<8} "
+              f"{report['elapsed'] or 0:>8.1f}  {result}")
+    print(f"Report written to {args.report}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+﻿import re
+
+MAX_CRITERIA_LENGTH = 4000  # Well under the ~8000 octet command limit most servers enforce
+MAX_GMAIL_QUERY_LENGTH = 1500  # q= travels URL-encoded in the messages.list GET request
+
+# Entries that name an address or domain: a server-side FROM match on these
+# almost always means the address itself matched, not the display name.
+PUSHDOWN_ENTRY = re.compile(r"^[A-Za-z0-9._%+@-]*[@.][A-Za-z0-9._%+@-]*$")
+
+
+def split_safe_list(safe_list):
+    """Split the safe list into (pushdown, client_side) entries.
+
+    Pushdown entries are plain address or domain fragments that can be sent to
+    the server verbatim. Anything else (bare words that may hit display names,
+    quotes, whitespace or non-ASCII) is ambiguous and left to the client-side
+    matcher.
+    """
+    pushdown, client_side = [], []
+    for entry in sorted(set(safe_list)):
+        if entry.strip("@.") and PUSHDOWN_ENTRY.match(entry):
+            pushdown.append(entry)
+        else:
+            client_side.append(entry)
+    return pushdown, client_side
+
+
+def _chunk_terms(terms, max_length, overhead=0):
+    chunks, chunk, length = [], [], overhead
+    for term in terms:
+        if chunk and length + len(term) + 1 > max_length:
+            chunks.append(chunk)
+            chunk, length = [], overhead
+        chunk.append(term)
+        length += len(term) + 1
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+def compile_imap_criteria(entries, max_length=MAX_CRITERIA_LENGTH):
+    """Compile entries into SEARCH criteria strings matching mail from none of them.
+
+    Each string is a conjunction of NOT FROM keys kept under max_length; a
+    message is a candidate only if it matches every string.
+    """
+    terms = [f'NOT FROM "{entry}"' for entry in entries]
+    return [" ".join(chunk) for chunk in _chunk_terms(terms, max_length)]
+
+
+def compile_gmail_raw_criteria(entries, max_length=MAX_CRITERIA_LENGTH):
+    """Compile entries into X-GM-RAW criteria strings using Gmail search syntax."""
+    terms = [f"-from:{entry}" for entry in entries]
+    overhead = len('X-GM-RAW ""')
+    return [f'X-GM-RAW "{" ".join(chunk)}"' for chunk in _chunk_terms(terms, max_length, overhead)]
+
+
+def compile_gmail_queries(entries, max_length=MAX_GMAIL_QUERY_LENGTH):
+    """Compile entries into messages.list q= expressions matching mail from none of them.
+
+    Like compile_imap_criteria, a message is a candidate only if every
+    expression returns it, so callers intersect the ids each one lists.
+    """
+    terms = [f"-from:{entry}" for entry in entries]
+    return [" ".join(chunk) for chunk in _chunk_terms(terms, max_length)]
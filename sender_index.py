@@ -0,0 +1,132 @@
+﻿from collections import namedtuple
+
+MessageInfo = namedtuple('MessageInfo', ['sender', 'size', 'date'])
+MessageInfo.__doc__ = """What one header fetch tells us about a message.
+
+sender is the From address (None if unparsable), size the message size in
+bytes and date its Unix timestamp; size and date are None when unknown.
+"""
+
+SORT_KEYS = ('count', 'bytes', 'last_seen', 'first_seen', 'sender', 'domain')
+
+
+def sender_domain(sender):
+    return sender.rsplit('@', 1)[-1].lower()
+
+
+class SenderStats:
+    __slots__ = ('sender', 'count', 'bytes', 'first_seen', 'last_seen', 'ids')
+
+    def __init__(self, sender):
+        self.sender = sender
+        self.count = 0
+        self.bytes = 0
+        self.first_seen = None
+        self.last_seen = None
+        self.ids = []
+
+    def add(self, message_id, info):
+        self.count += 1
+        self.bytes += info.size or 0
+        self.ids.append(message_id)
+        if info.date is not None:
+            if self.first_seen is None or info.date < self.first_seen:
+                self.first_seen = info.date
+            if self.last_seen is None or info.date > self.last_seen:
+                self.last_seen = info.date
+
+    def to_dict(self):
+        return {
+            'sender': self.sender,
+            'domain': sender_domain(self.sender),
+            'count': self.count,
+            'bytes': self.bytes,
+            'first_seen': self.first_seen,
+            'last_seen': self.last_seen,
+        }
+
+
+class SenderIndex:
+    """Per-sender aggregate of one scan: message count, total bytes, first/last seen and message ids.
+
+    Built in the same pass that fetches headers, so the preview can sort and
+    filter senders by volume and the delete step can act on the indexed ids
+    without scanning again. uidvalidity is set for IMAP scans; ids are only
+    valid while it is unchanged. account and high_water record whose mailbox
+    was scanned and the newest mail the scan saw, in the backend's terms.
+    """
+
+    def __init__(self, uidvalidity=None, account=None, high_water=None):
+        self.uidvalidity = uidvalidity
+        self.account = account
+        self.high_water = high_water
+        self._senders = {}
+
+    def add(self, message_id, info):
+        """Index one message; returns True if it is the first one from its sender."""
+        if not info.sender:
+            return False
+        stats = self._senders.get(info.sender)
+        is_new = stats is None
+        if is_new:
+            stats = self._senders[info.sender] = SenderStats(info.sender)
+        stats.add(message_id, info)
+        return is_new
+
+    def __len__(self):
+        return len(self._senders)
+
+    def __contains__(self, sender):
+        return sender in self._senders
+
+    @property
+    def message_count(self):
+        return sum(stats.count for stats in self._senders.values())
+
+    def senders(self):
+        return list(self._senders)
+
+    def stats(self, sender):
+        return self._senders.get(sender)
+
+    def without(self, matcher):
+        """A new index without the senders matcher matches, e.g. ones added to the safe list since the scan."""
+        index = SenderIndex(self.uidvalidity, self.account, self.high_water)
+        index._senders = {sender: stats for sender, stats in self._senders.items() if not matcher.matches(sender)}
+        return index
+
+    def rows(self, sort='count', descending=True):
+        """Sender rows as dicts, sorted by one of SORT_KEYS."""
+        if sort not in SORT_KEYS:
+            sort = 'count'
+        rows = [stats.to_dict() for stats in self._senders.values()]
+        # Unknown dates sort as oldest
+        rows.sort(key=lambda row: (row[sort] is not None, row[sort] or 0) if sort in ('first_seen', 'last_seen')
+                  else row[sort], reverse=descending)
+        return rows
+
+    def domains(self):
+        """Roll-up per sender domain, largest message count first."""
+        rollup = {}
+        for stats in self._senders.values():
+            domain = sender_domain(stats.sender)
+            row = rollup.setdefault(domain, {'domain': domain, 'senders': 0, 'count': 0, 'bytes': 0,
+                                             'first_seen': None, 'last_seen': None})
+            row['senders'] += 1
+            row['count'] += stats.count
+            row['bytes'] += stats.bytes
+            if stats.first_seen is not None and (row['first_seen'] is None or stats.first_seen < row['first_seen']):
+                row['first_seen'] = stats.first_seen
+            if stats.last_seen is not None and (row['last_seen'] is None or stats.last_seen > row['last_seen']):
+                row['last_seen'] = stats.last_seen
+        return sorted(rollup.values(), key=lambda row: row['count'], reverse=True)
+
+    def message_ids(self, senders=None):
+        """Indexed message ids from the given senders (default: every sender)."""
+        chosen = self._senders if senders is None else senders
+        ids = []
+        for sender in chosen:
+            stats = self._senders.get(sender)
+            if stats:
+                ids.extend(stats.ids)
+        return ids
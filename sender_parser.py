@@ -0,0 +1,136 @@
+﻿import base64
+import binascii
+import re
+
+FROM_FIELD = re.compile(rb"(?:^|\n)From[ \t]*:([^\n]*(?:\n[ \t][^\n]*)*)", re.IGNORECASE)  # With continuation lines
+FOLD = re.compile(rb"\r?\n[ \t]")
+ENCODED_WORD = re.compile(rb"=\?([^?\s]+)\?([bBqQ])\?([^?\s]*)\?=")
+ENCODED_WORD_GAP = re.compile(rb"(\?=)[ \t]+(=\?)")  # Whitespace between encoded words is not part of the text
+COMMENT = re.compile(rb"\((?:[^()\\]|\\.)*\)")
+QUOTED = re.compile(rb'"(?:[^"\\]|\\.)*"')
+ADDR_SPEC = re.compile(rb"[^\s<>(),;:\"@]+@[^\s<>(),;:\"@]+\.[^\s<>(),;:\"@]+")
+ATOMS = rb'[^\s"()<>,:;@\\]+'
+# A lone addr-spec (perhaps with comments after it), "Name <addr>" or '"Name" <addr>', with no group or list:
+# most From fields. Its address is the last group that took part.
+SIMPLE_VALUE = (rb'[^"()<>,:;@\\]*(?:"[^"\\]*(?:\\.[^"\\]*)*"[^"()<>,:;@\\]*)*<(' + ATOMS + rb'@' + ATOMS + rb')>\s*'
+                rb'|\s*(' + ATOMS + rb'@' + ATOMS + rb'\.' + ATOMS + rb')(?:\s*\([^()\\]*\))*\s*')
+SIMPLE = re.compile(SIMPLE_VALUE)
+# Such a From field in a header block, unfolded. Starting with a literal lets the search skip ahead to it,
+# so the caller checks it starts a line; other spellings of "From:" take the long way.
+SIMPLE_FIELD = re.compile(rb"From:(?:" + SIMPLE_VALUE + rb")(?:\r?\n(?![ \t])|\Z)")
+MAILBOX_SEPARATOR = re.compile(rb",(?![^<]*>)")  # Commas outside angle brackets
+# Bumped whenever parse_sender's results change, so the stores of parsed senders drop what older versions wrote
+PARSER_VERSION = 3
+
+
+def sender_from_headers(raw):
+    """The sender address in a raw header block (bytes or str) holding a From field, or None.
+
+    Continuation lines of the field are unfolded first; see parse_sender for
+    the rest.
+    """
+    if isinstance(raw, str):
+        raw = raw.encode("utf-8", "surrogateescape")
+    if not raw:
+        return None
+    simple = SIMPLE_FIELD.search(raw)
+    if simple and (not simple.start() or raw[simple.start() - 1] == 10):  # "\n", not "Resent-From:"
+        return _normalized(simple[simple.lastindex])
+    match = FROM_FIELD.search(raw)
+    return _parse(match.group(1)) if match else None
+
+
+def parse_sender(value):
+    """The normalized address of a From field value (bytes or str), or None if it has none.
+
+    Handles folded lines, comments, quoted display names, RFC 2047 encoded
+    words (only decoded when the address is not readable without them),
+    lists and group syntax, whose first mailbox is taken. Addresses inside
+    comments or quoted names are never taken. The address is returned
+    without brackets, with its domain lowercased.
+    """
+    if isinstance(value, str):
+        value = value.encode("utf-8", "surrogateescape")
+    if not value:
+        return None
+    simple = SIMPLE.fullmatch(value)
+    if simple:
+        return _normalized(simple[simple.lastindex])
+    return _parse(value)
+
+
+def _parse(value):
+    if b"\n" in value:
+        value = FOLD.sub(b" ", value)
+    address = _find_address(value)
+    if address is None and b"=?" in value:
+        value = decode_encoded_words(value)
+        simple = SIMPLE.fullmatch(value)
+        address = simple[simple.lastindex] if simple else _find_address(value)
+    return _normalized(address) if address is not None else None
+
+
+def _normalized(address):
+    if not address.islower():  # Most often only the local part has capitals, and it keeps them
+        at = address.rfind(b"@")
+        address = address[:at] + address[at:].lower()
+    return address.decode("utf-8", "replace")
+
+
+def _find_address(value):
+    if b"@" not in value:
+        return None
+    # Comments and quoted display names may hold text that looks like an address; only the rest counts
+    while b"(" in value:
+        stripped = COMMENT.sub(b" ", value)  # Innermost first, so nested comments go too
+        if stripped == value:
+            break
+        value = stripped
+    if b'"' in value:
+        value = QUOTED.sub(b" ", value)
+
+    colon = value.find(b":")
+    if colon != -1 and b"<" not in value[:colon]:
+        # Group ("list: a@b.c, D <d@e.f>;"): its mailboxes follow the colon
+        value = value[colon + 1:].split(b";", 1)[0]
+    # The first of several mailboxes with an address; a comma may also sit in an unquoted name, "Doe, J <j@d.com>"
+    mailboxes = MAILBOX_SEPARATOR.split(value) if b"," in value else (value,)
+    for mailbox in mailboxes:
+        address = _mailbox_address(mailbox)
+        if address is not None:
+            return address
+    return None
+
+
+def _mailbox_address(mailbox):
+    start = mailbox.find(b"<")
+    if start != -1:
+        end = mailbox.find(b">", start)
+        if end != -1:
+            address = b"".join(mailbox[start + 1:end].split())  # Obsolete syntax allows spaces: <user @ host>
+            if address.startswith(b"@") and b":" in address:
+                address = address.split(b":", 1)[1]  # Obsolete source route, <@relay:addr>
+            if b"@" in address:
+                return address.removeprefix(b"mailto:")
+    match = ADDR_SPEC.search(mailbox)
+    return match.group(0) if match else None
+
+
+def decode_encoded_words(value):
+    """value with its RFC 2047 encoded words replaced by their UTF-8 text."""
+    if value.count(b"=?") > 1:
+        value = ENCODED_WORD_GAP.sub(rb"\1\2", value)
+    return ENCODED_WORD.sub(_decode_word, value)
+
+
+def _decode_word(match):
+    charset, encoding, text = match.groups()
+    charset = charset.split(b"*", 1)[0].decode("ascii", "replace")  # RFC 2231 language suffix
+    try:
+        if encoding in b"bB":
+            data = base64.b64decode(text + b"=" * (-len(text) % 4))
+        else:
+            data = binascii.a2b_qp(text.replace(b"_", b" "))
+        return data.decode(charset, "replace").encode("utf-8")
+    except (binascii.Error, LookupError, ValueError):
+        return match.group(0)
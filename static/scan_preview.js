@@ -0,0 +1,133 @@
+// Loads a finished scan's unapproved senders from the server a page at a time.
+// The page provides #email-list with data-senders-url, data-domains-url and
+// data-page-size, plus the #sort, #order, #prefix, #domain-list, #domain-filter,
+// #page-status, #prev-page and #next-page controls.
+(function () {
+    const list = document.getElementById('email-list');
+    if (!list || !list.dataset.sendersUrl) {
+        return;
+    }
+    const pageSize = Number(list.dataset.pageSize);
+    const status = document.getElementById('page-status');
+    const prev = document.getElementById('prev-page');
+    const next = document.getElementById('next-page');
+    const domainFilter = document.getElementById('domain-filter');
+    const state = {
+        offset: 0,
+        sort: document.getElementById('sort').value,
+        order: document.getElementById('order').value,
+        prefix: '',
+        domain: '',
+    };
+    let latest = null;
+
+    function formatBytes(bytes) {
+        const units = ['Bytes', 'kB', 'MB', 'GB'];
+        let unit = 0;
+        while (bytes >= 1000 && unit < units.length - 1) {
+            bytes /= 1000;
+            unit += 1;
+        }
+        return unit ? `${bytes.toFixed(1)} ${units[unit]}` : `${bytes} Bytes`;
+    }
+
+    function formatDate(timestamp) {
+        return timestamp ? new Date(timestamp * 1000).toISOString().slice(0, 10) : '';
+    }
+
+    function senderItem(row) {
+        const item = document.createElement('div');
+        item.className = 'email-item';
+        const label = document.createElement('label');
+        const checkbox = document.createElement('input');
+        checkbox.type = 'checkbox';
+        checkbox.name = 'keep';
+        checkbox.value = row.sender;
+        label.append(checkbox, ' ' + row.sender);
+        if (row.count) {
+            const stats = document.createElement('span');
+            stats.className = 'sender-stats';
+            stats.textContent = ` ${row.count} emails, ${formatBytes(row.bytes)}, last ${formatDate(row.last_seen)}`;
+            label.append(stats);
+        }
+        item.append(label);
+        return item;
+    }
+
+    function render(page) {
+        list.replaceChildren(...page.senders.map(senderItem));
+        const shown = page.senders.length;
+        status.textContent = page.total
+            ? `Showing ${page.offset + 1}-${page.offset + shown} of ${page.total}`
+            : 'No senders match';
+        prev.disabled = page.offset === 0;
+        next.disabled = page.offset + shown >= page.total;
+        domainFilter.textContent = state.domain ? `Domain: ${state.domain} ` : '';
+        if (state.domain) {
+            const clear = document.createElement('a');
+            clear.href = '#';
+            clear.textContent = '(all domains)';
+            clear.addEventListener('click', (event) => {
+                event.preventDefault();
+                update({domain: ''});
+            });
+            domainFilter.append(clear);
+        }
+    }
+
+    async function load() {
+        const params = new URLSearchParams({...state, limit: pageSize});
+        const request = fetch(`${list.dataset.sendersUrl}?${params}`).then((response) => response.json());
+        latest = request;
+        const page = await request;
+        if (request === latest) {  // Ignore answers to requests a newer one has replaced
+            render(page);
+        }
+    }
+
+    function update(changes) {
+        Object.assign(state, {offset: 0}, changes);
+        load();
+    }
+
+    async function loadDomains() {
+        const container = document.getElementById('domain-list');
+        if (!container || !list.dataset.domainsUrl) {
+            return;
+        }
+        const rollup = await (await fetch(`${list.dataset.domainsUrl}?limit=50`)).json();
+        for (const row of rollup.domains) {
+            const link = document.createElement('a');
+            link.href = '#';
+            link.textContent = row.domain;
+            link.title = `${row.senders} senders, ${row.count} emails, ${formatBytes(row.bytes)}`;
+            link.addEventListener('click', (event) => {
+                event.preventDefault();
+                update({domain: row.domain});
+            });
+            container.append(link, ` (${row.count}) `);
+        }
+        if (rollup.total > rollup.domains.length) {
+            container.append(`and ${rollup.total - rollup.domains.length} more`);
+        }
+    }
+
+    document.getElementById('sort').addEventListener('change', (event) => update({sort: event.target.value}));
+    document.getElementById('order').addEventListener('change', (event) => update({order: event.target.value}));
+    let typing = null;
+    document.getElementById('prefix').addEventListener('input', (event) => {
+        clearTimeout(typing);
+        typing = setTimeout(() => update({prefix: event.target.value.trim()}), 250);
+    });
+    prev.addEventListener('click', () => {
+        state.offset = Math.max(0, state.offset - pageSize);
+        load();
+    });
+    next.addEventListener('click', () => {
+        state.offset += pageSize;
+        load();
+    });
+
+    load();
+    loadDomains();
+})();